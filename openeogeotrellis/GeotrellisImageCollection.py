@@ -3,16 +3,16 @@ import logging
 import math
 import os
 import pathlib
-import subprocess
+import re
+import shutil
 import tempfile
 import uuid
 from datetime import datetime, date
-from typing import Dict, List, Union, Tuple, Iterable, Callable
+from typing import Any, Dict, List, Union, Tuple, Iterable, Callable
 
 import geopyspark as gps
 import numpy as np
 import pandas as pd
-import pyproj
 import pytz
 from geopyspark import TiledRasterLayer, TMS, Pyramid, Tile, SpaceTimeKey, SpatialKey, Metadata
 from geopyspark.geotrellis import Extent
@@ -35,13 +35,47 @@ import xarray as xr
 from openeo.imagecollection import ImageCollection, CollectionMetadata
 from openeo_driver.save_result import AggregatePolygonResult
 from openeogeotrellis.configparams import ConfigParams
+from openeogeotrellis import geotiff
+from openeogeotrellis import pyramid as lazy_pyramid
+from openeogeotrellis import result_cache
+from openeogeotrellis import timeseries_store
+from openeogeotrellis import zonal_statistics
+from openeogeotrellis.pyramid import LazyPyramid
 from openeogeotrellis.service_registry import SecondaryService, AbstractServiceRegistry
+from openeogeotrellis.spatial_index import PolygonKeyIndex
+from openeogeotrellis.utils import get_transformer, reproject_bounds, reproject_polygon, reproject_polygons
+from openeogeotrellis.zarr_store import ZarrCubeStore
 
 _log = logging.getLogger(__name__)
 
+# map keys that are numbers, as Jackson (Number.toString()) and json.dumps write them
+_NUMBER_KEY = re.compile(r'^-?\d+(\.\d+)?([eE][+-]?\d+)?$|^NaN$|^-?Infinity$')
+
+
+def _with_number_keys(pairs: List[Tuple[str, Any]]) -> dict:
+    """
+    JSON object (a `json.loads` object_pairs_hook) with its keys that are numbers (like the bins of a histogram)
+    converted back from strings: to an int if they have no fraction or exponent, to a float otherwise.
+    """
+    def key(k: str):
+        if not _NUMBER_KEY.match(k):
+            return k
+        return int(k) if k.lstrip('-').isdigit() else float(k)
+
+    return {key(k): v for k, v in pairs}
+
+
+def _shared_with_executors(path: str) -> bool:
+    path = os.path.abspath(path)
+    return any(os.path.commonpath([path, os.path.abspath(d)]) == os.path.abspath(d)
+               for d in ConfigParams().executor_shared_dirs)
+
 
 class GeotrellisTimeSeriesImageCollection(ImageCollection):
 
+    # manifest of the assets written by write_assets
+    ASSETS_MANIFEST = "manifest.json"
+
     def __init__(self, pyramid: Pyramid, service_registry: AbstractServiceRegistry, metadata: CollectionMetadata = None):
         super().__init__(metadata=metadata)
         self.pyramid = pyramid
@@ -53,12 +87,12 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
     def apply_to_levels(self, func):
         """
         Applies a function to each level of the pyramid. The argument provided to the function is of type TiledRasterLayer
+        Levels are evaluated lazily: the function is only applied to a level when that level is accessed.
 
         :param func:
         :return:
         """
-        pyramid = Pyramid({k:func( l ) for k,l in self.pyramid.levels.items()})
-        return GeotrellisTimeSeriesImageCollection(pyramid, self._service_registry, metadata=self.metadata)._with_band_index(self._band_index)
+        return self._with_pyramid(LazyPyramid(self.pyramid, lambda layer, zoom: func(layer)))
 
     def _apply_to_levels_geotrellis_rdd(self, func):
         """
@@ -80,7 +114,10 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
 
             return gps.TiledRasterLayer(layer_type, srdd)
 
-        pyramid = Pyramid({k:create_tilelayer(func( l.srdd.rdd(),k ),l.layer_type,k) for k,l in self.pyramid.levels.items()})
+        return self._with_pyramid(
+            LazyPyramid(self.pyramid, lambda l, k: create_tilelayer(func(l.srdd.rdd(), k), l.layer_type, k)))
+
+    def _with_pyramid(self, pyramid: Pyramid) -> 'GeotrellisTimeSeriesImageCollection':
         return GeotrellisTimeSeriesImageCollection(pyramid, self._service_registry, metadata=self.metadata)._with_band_index(self._band_index)
 
     def _with_band_index(self, band_index):
@@ -112,29 +149,36 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         """Apply a function to the given set of bands in this image collection."""
         #TODO apply .bands(bands)
         #TODO deprecated
-        return self.apply_to_levels(lambda rdd: rdd.convert_data_type(CellType.FLOAT64).map_cells(bandfunction))
+        # consecutive cell functions are fused into a single pass over the tiles,
+        # and the cells are only upcast to float64 if the function needs it
+        pyramid = lazy_pyramid.map_cells_inferred(self.pyramid, bandfunction, num_bands=len(self.metadata.bands))
+        return self._with_pyramid(pyramid)
 
     def apply(self, process:str, arguments = {}) -> 'ImageCollection':
         pysc = gps.get_spark_context()
         return self._apply_to_levels_geotrellis_rdd(lambda rdd,k: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().applyProcess( rdd,process))
 
     def reduce(self, reducer: str, dimension: str) -> 'ImageCollection':
-        from .numpy_aggregators import var_composite, std_composite, min_composite, max_composite, sum_composite
+        from .numpy_aggregators import VarianceCombiner, StandardDeviationCombiner, MinCombiner, MaxCombiner, \
+            SumCombiner, MeanCombiner
 
         reducer = self._normalize_reducer(dimension, reducer)
 
         if reducer == 'Variance':
-            return self._aggregate_over_time_numpy(var_composite)
+            return self._aggregate_over_time_combiner(VarianceCombiner())
         elif reducer == 'StandardDeviation':
-            return self._aggregate_over_time_numpy(std_composite)
+            return self._aggregate_over_time_combiner(StandardDeviationCombiner())
         elif reducer == 'Min':
-            return self._aggregate_over_time_numpy(min_composite)
+            return self._aggregate_over_time_combiner(MinCombiner())
         elif reducer == 'Max':
-            return self._aggregate_over_time_numpy(max_composite)
+            return self._aggregate_over_time_combiner(MaxCombiner())
         elif reducer == 'Sum':
-            return self._aggregate_over_time_numpy(sum_composite)
+            return self._aggregate_over_time_combiner(SumCombiner())
+        elif reducer == 'Mean':
+            return self._aggregate_over_time_combiner(MeanCombiner())
         else:
-            return self.apply_to_levels(lambda layer: layer.to_spatial_layer().aggregate_by_cell(reducer))
+            # exact median/percentiles need the complete time stack
+            return self._aggregate_over_time_numpy(self._numpy_composite(reducer))
 
     def reduce_bands(self,pgVisitor) -> 'ImageCollection':
         """
@@ -143,7 +187,7 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         :return:
         """
         pysc = gps.get_spark_context()
-        float_datacube = self.apply_to_levels(lambda layer : layer.convert_data_type("float32"))
+        float_datacube = self._with_pyramid(lazy_pyramid.convert_data_type(self.pyramid, CellType.FLOAT32))
         result = float_datacube._apply_to_levels_geotrellis_rdd(
             lambda rdd, level: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().mapBands(rdd, pgVisitor.builder))
         return result
@@ -151,15 +195,29 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
     def _normalize_reducer(self, dimension, reducer):
         if dimension != 'temporal':
             raise AttributeError('Reduce process only works on temporal dimension. Requested dimension: ' + str(dimension))
-        if (reducer.upper() in ["MIN", "MAX", "SUM", "MEAN", "VARIANCE"] or reducer.upper() == "SD"):
+        if (reducer.upper() in ["MIN", "MAX", "SUM", "MEAN", "VARIANCE", "MEDIAN"] or reducer.upper() == "SD"):
             if reducer.upper() == "SD":
                 reducer = "StandardDeviation"
             else:
                 reducer = reducer.lower().capitalize()
+        elif re.match(r"^PERCENTILE_\d+(\.\d+)?$", reducer.upper()):
+            # e.g. "percentile_90"
+            reducer = "Percentile_" + reducer.split("_", 1)[1]
         else:
             raise NotImplementedError("The reducer is not supported by the backend: " + reducer)
         return reducer
 
+    @staticmethod
+    def _numpy_composite(reducer: str) -> Callable[[Iterable[Tile]], Tile]:
+        """Get the numpy based reducer of the tiles of a time stack, for reducers not supported by aggregate_by_cell."""
+        from .numpy_aggregators import median_composite, percentile_composite
+
+        if reducer == 'Median':
+            return median_composite
+        elif reducer.startswith('Percentile_'):
+            return percentile_composite(float(reducer.split("_", 1)[1]))
+        return None
+
     @classmethod
     def _mapTransform(cls, layoutDefinition, spatialKey):
         ex = layoutDefinition.extent
@@ -193,102 +251,193 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         return DataCube(the_array)
 
 
-    def apply_tiles_spatiotemporal(self,function) -> ImageCollection:
+    def apply_tiles_spatiotemporal(self,function, max_time_steps: int = None) -> ImageCollection:
         """
         Apply a function to a group of tiles with the same spatial key.
+
+        The tiles are partitioned by spatial key and sorted by (col, row, instant) within the partitions,
+        so each time series is streamed to the function in order without grouping the full series in a shuffle.
+        The result is stored as float64: a probe on a short time series can not tell whether a narrower type is
+        lossless for the real ones (e.g. sums over many years).
+
         :param function:
+        :param max_time_steps: optional maximum number of time steps per function invocation: longer time series
+            are passed as consecutive chunks (for functions that work on temporal windows)
         :return:
         """
 
         #early compile to detect syntax errors
         compiled_code = compile(function,'UDF.py',mode='exec')
 
+        if max_time_steps is not None and max_time_steps < 1:
+            raise ValueError("max_time_steps should be at least 1, but got: " + str(max_time_steps))
+
         def tilefunction(metadata:Metadata, openeo_metadata: CollectionMetadata, tiles:Tuple[gps.SpatialKey, List[Tuple[SpaceTimeKey, Tile]]]):
-            tile_list = list(tiles[1])
-            #sort by instant
-            tile_list.sort(key=lambda tup: tup[0].instant)
+            # tiles are already sorted by instant
+            tile_list = tiles[1]
             dates = map(lambda t: t[0].instant, tile_list)
             arrays = map(lambda t: t[1].cells, tile_list)
             multidim_array = np.array(list(arrays))
 
             extent = GeotrellisTimeSeriesImageCollection._mapTransform(metadata.layout_definition,tile_list[0][0])
 
-            from openeo_udf.api.run_code import run_user_code
-            from openeo_udf.api.datacube import DataCube
-            #new UDF API available
+            from openeogeotrellis.udf import run_udf_on_datacube
 
-            datacube:DataCube = GeotrellisTimeSeriesImageCollection._tile_to_datacube(
+            datacube = GeotrellisTimeSeriesImageCollection._tile_to_datacube(
                 multidim_array,
                 extent=extent,
                 bands_metadata=openeo_metadata.bands,
                 start_times=pd.DatetimeIndex(dates)
             )
 
-            data = UdfData({"EPSG": 900913}, [datacube])
-
-            result_data = run_user_code(function,data)
-            cubes = result_data.get_datacube_list()
-            if len(cubes)!=1:
-                raise ValueError("The provided UDF should return one datacube, but got: "+ str(cubes))
-            result_array:xr.DataArray = cubes[0].array
+            result_array:xr.DataArray = run_udf_on_datacube(function, datacube).array
+            result_cell_type = Tile.dtype_to_cell_type(result_dtype)
             if 't' in result_array.dims:
                 return [(SpaceTimeKey(col=tiles[0].col, row=tiles[0].row,instant=pd.Timestamp(timestamp)),
-                  Tile(array_slice.values, CellType.FLOAT64, tile_list[0][1].no_data_value)) for timestamp, array_slice in result_array.groupby('t')]
+                  Tile(array_slice.values.astype(result_dtype, copy=False), result_cell_type, tile_list[0][1].no_data_value)) for timestamp, array_slice in result_array.groupby('t')]
             else:
-                return [(SpaceTimeKey(col=tiles[0].col, row=tiles[0].row,instant=datetime.now()),
-                  Tile(result_array.values, CellType.FLOAT64, tile_list[0][1].no_data_value))]
-
-
-
+                # a chunk of the time series is labeled with its first instant, to keep the chunk results apart
+                instant = tile_list[0][0].instant if max_time_steps else datetime.now()
+                return [(SpaceTimeKey(col=tiles[0].col, row=tiles[0].row,instant=instant),
+                  Tile(result_array.values.astype(result_dtype, copy=False), result_cell_type, tile_list[0][1].no_data_value))]
+
+        def partition_function(metadata: Metadata, openeo_metadata: CollectionMetadata, sorted_tiles):
+            from itertools import groupby, islice
+
+            # sorted_tiles: ((col, row, instant), (SpaceTimeKey, Tile)), sorted by (col, row, instant)
+            for (col, row), group in groupby(sorted_tiles, key=lambda t: t[0][:2]):
+                spatial_key = gps.SpatialKey(col, row)
+                series = (t[1] for t in group)
+                while True:
+                    chunk = list(islice(series, max_time_steps))
+                    if not chunk:
+                        break
+                    yield from tilefunction(metadata, openeo_metadata, (spatial_key, chunk))
 
         def rdd_function(openeo_metadata: CollectionMetadata, rdd):
+            from pyspark.rdd import portable_hash
+
             floatrdd = rdd.convert_data_type(CellType.FLOAT64).to_numpy_rdd()
-            grouped_by_spatial_key = floatrdd.map(lambda t: (gps.SpatialKey(t[0].col, t[0].row), (t[0], t[1]))).groupByKey()
+            keyed_by_col_row_instant = floatrdd.map(lambda t: ((t[0].col, t[0].row, t[0].instant), (t[0], t[1])))
+            sorted_by_spatial_key = keyed_by_col_row_instant.repartitionAndSortWithinPartitions(
+                numPartitions=floatrdd.getNumPartitions(),
+                partitionFunc=lambda col_row_instant: portable_hash(col_row_instant[:2])
+            )
 
+            metadata = rdd.layer_metadata.to_dict()
+            metadata['cellType'] = CellType.FLOAT64.value
             return gps.TiledRasterLayer.from_numpy_rdd(gps.LayerType.SPACETIME,
-                                                       grouped_by_spatial_key.flatMap(
-                                                    partial(tilefunction, rdd.layer_metadata, openeo_metadata)),
-                                                       rdd.layer_metadata)
+                                                       sorted_by_spatial_key.mapPartitions(
+                                                    partial(partition_function, rdd.layer_metadata, openeo_metadata)),
+                                                       metadata)
+
+        result_dtype = np.dtype(np.float64)
+
         from functools import partial
         return self.apply_to_levels(partial(rdd_function, self.metadata))
 
 
-    def apply_tiles(self, function) -> 'ImageCollection':
-        """Apply a function to the given set of bands in this image collection."""
+    def apply_tiles(self, function, tiles_per_batch: int = None) -> 'ImageCollection':
+        """
+        Apply a function to the given set of bands in this image collection.
+
+        :param function: the UDF code
+        The UDF is first run once on a small probe tile, on the driver while the process graph is evaluated, to infer
+        whether it can run on the native cells and the narrowest cell type of its result (see
+        `pyramid.infer_cell_type`). UDFs with side effects see that extra invocation.
+
+        :param tiles_per_batch: optional number of tiles to pass to a single UDF invocation: the tiles of a partition
+            are then stacked along an extra 'tile' dimension, which the UDF should preserve
+        :return:
+        """
         #TODO apply .bands(bands)
 
-        def tilefunction(metadata: Metadata, openeo_metadata: CollectionMetadata,
-                         geotrellis_tile: Tuple[SpaceTimeKey, Tile]):
+        #early compile to detect syntax errors
+        compile(function,'UDF.py',mode='exec')
 
-            key = geotrellis_tile[0]
-            extent = GeotrellisTimeSeriesImageCollection._mapTransform(metadata.layout_definition,key)
+        if tiles_per_batch is not None and tiles_per_batch < 1:
+            raise ValueError("tiles_per_batch should be at least 1, but got: " + str(tiles_per_batch))
 
-            from openeo_udf.api.run_code import run_user_code
-            from openeo_udf.api.datacube import DataCube
+        def udf_cells(openeo_metadata: CollectionMetadata, cells: np.ndarray, no_data_value) -> np.ndarray:
+            from openeogeotrellis.udf import run_udf_on_datacube
 
-            datacube:DataCube = GeotrellisTimeSeriesImageCollection._tile_to_datacube(
-                geotrellis_tile[1].cells,
-                extent=extent,
+            datacube = GeotrellisTimeSeriesImageCollection._tile_to_datacube(
+                cells,
+                extent=None,
                 bands_metadata=openeo_metadata.bands
             )
+            return run_udf_on_datacube(function, datacube).array.values
+
+        def udf_batch_cells(openeo_metadata: CollectionMetadata, cells: np.ndarray) -> np.ndarray:
+            from openeogeotrellis.udf import run_udf_on_datacube
+            from openeo_udf.api.datacube import DataCube
+
+            coords = {'tile': list(range(cells.shape[0]))}
+            if openeo_metadata.bands:
+                coords['bands'] = [b.name for b in openeo_metadata.bands]
+            stacked = xr.DataArray(cells, coords=coords, dims=('tile', 'bands', 'x', 'y'), name="openEODataChunk")
+
+            result_array:xr.DataArray = run_udf_on_datacube(function, DataCube(stacked)).array
+            if 'tile' not in result_array.dims or result_array.sizes['tile'] != cells.shape[0]:
+                raise ValueError("The provided UDF should preserve the 'tile' dimension, but got dimensions: "
+                                 + str(result_array.dims))
+            return result_array.transpose('tile', *[d for d in result_array.dims if d != 'tile']).values
+
+        def tilefunction(step, geotrellis_tile: Tuple[SpaceTimeKey, Tile]):
+            key, tile = geotrellis_tile
+            cells, no_data_value = step(tile.cells, tile.no_data_value)
+            return key, Tile(cells, Tile.dtype_to_cell_type(cells.dtype), no_data_value)
+
+        def batchfunction(inference: lazy_pyramid.CellTypeInference, openeo_metadata: CollectionMetadata,
+                          geotrellis_tiles: List[Tuple[SpaceTimeKey, Tile]]):
+            from openeogeotrellis.udf import TileBatch
+
+            batch = TileBatch.from_tiles(geotrellis_tiles)
+            if not inference.native:
+                # upcast in one go for the whole batch
+                result_cells = udf_batch_cells(openeo_metadata, batch.to_float64())
+                result_cells = result_cells.astype(inference.cell_type, copy=False)
+                return TileBatch(batch.keys, result_cells, Tile.dtype_to_cell_type(result_cells.dtype), np.nan).tiles()
+
+            result_cells = udf_batch_cells(openeo_metadata, batch.cells)
+            result_tiles = []
+            for key, cells, result in zip(batch.keys, batch.cells, result_cells):
+                result, no_data_value = lazy_pyramid.mask_no_data(result, cells, batch.no_data_value,
+                                                                  inference.cell_type, inference.no_data_bands)
+                result_tiles.append((key, Tile(result, Tile.dtype_to_cell_type(result.dtype), no_data_value)))
+            return result_tiles
+
+        def partition_function(inference: lazy_pyramid.CellTypeInference, openeo_metadata: CollectionMetadata, tiles):
+            from itertools import islice
 
-            data = UdfData({"EPSG": 900913}, [datacube])
+            while True:
+                batch = list(islice(tiles, tiles_per_batch))
+                if not batch:
+                    break
+                yield from batchfunction(inference, openeo_metadata, batch)
 
-            result_data = run_user_code(function,data)
-            cubes = result_data.get_datacube_list()
-            if len(cubes)!=1:
-                raise ValueError("The provided UDF should return one datacube, but got: "+ str(cubes))
-            result_array:xr.DataArray = cubes[0].array
-            print(result_array.dims)
-            return (key,Tile(result_array.values, geotrellis_tile[1].cell_type,geotrellis_tile[1].no_data_value))
+        from functools import partial
 
+        # run the UDF on a probe tile to find out whether it needs the cells as float64, and the result cell type
+        if tiles_per_batch is None:
+            probe_function = partial(udf_cells, self.metadata)
+        else:
+            probe_function = lambda cells, no_data_value: udf_batch_cells(self.metadata, cells[np.newaxis])[0]
+        inference = lazy_pyramid.infer_cell_type(probe_function, lazy_pyramid.cell_type(self.pyramid),
+                                                 num_bands=len(self.metadata.bands))
 
         def rdd_function(openeo_metadata: CollectionMetadata, rdd):
-            return gps.TiledRasterLayer.from_numpy_rdd(rdd.layer_type,
-                                                rdd.convert_data_type(CellType.FLOAT64).to_numpy_rdd().map(
-                                                    partial(tilefunction, rdd.layer_metadata, openeo_metadata)),
-                                                rdd.layer_metadata)
-        from functools import partial
+            # no JVM side conversion: tiles are transferred in their native cell type
+            if tiles_per_batch is None:
+                step = lazy_pyramid.cell_step(partial(udf_cells, openeo_metadata), inference)
+                result_rdd = rdd.to_numpy_rdd().map(partial(tilefunction, step))
+            else:
+                result_rdd = rdd.to_numpy_rdd().mapPartitions(partial(partition_function, inference, openeo_metadata),
+                                                              preservesPartitioning=True)
+            metadata = rdd.layer_metadata.to_dict()
+            metadata['cellType'] = inference.cell_type
+            return gps.TiledRasterLayer.from_numpy_rdd(rdd.layer_type, result_rdd, metadata)
+
         return self.apply_to_levels(partial(rdd_function, self.metadata))
 
     def aggregate_time(self, temporal_window, aggregationfunction) -> Series :
@@ -316,7 +465,16 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         mapped_keys = self._apply_to_levels_geotrellis_rdd(
             lambda rdd,level: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().mapInstantToInterval(rdd,intervals_iso,labels_iso))
         reducer = self._normalize_reducer(dimension, reducer)
-        return mapped_keys.apply_to_levels(lambda rdd: rdd.aggregate_by_cell(reducer))
+        numpy_composite = self._numpy_composite(reducer)
+        if numpy_composite is None:
+            return mapped_keys.apply_to_levels(lambda rdd: rdd.aggregate_by_cell(reducer))
+
+        def aggregate_intervals(layer):
+            grouped_numpy_rdd = layer.convert_data_type(CellType.FLOAT32).to_numpy_rdd().groupByKey()
+            return TiledRasterLayer.from_numpy_rdd(layer.layer_type, grouped_numpy_rdd.mapValues(numpy_composite),
+                                                   layer.layer_metadata)
+
+        return mapped_keys.apply_to_levels(aggregate_intervals)
 
     def _aggregate_over_time_numpy(self, reducer: Callable[[Iterable[Tile]], Tile]) -> 'ImageCollection':
         """
@@ -333,18 +491,21 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
 
         return self.apply_to_levels(aggregate_temporally)
 
+    def _aggregate_over_time_combiner(self, combiner: 'TemporalCombiner') -> 'ImageCollection':
+        """
+        Aggregate over time with mergeable partial states, so the time stack of a key is never shuffled as a whole.
+        :param combiner: a TemporalCombiner
+        :return:
+        """
+        def aggregate_temporally(layer):
+            numpy_rdd = layer.to_spatial_layer().convert_data_type(CellType.FLOAT32).to_numpy_rdd()
 
-    @classmethod
-    def __reproject_polygon(cls, polygon: Union[Polygon, MultiPolygon], srs, dest_srs):
-        from shapely.ops import transform
-        from functools import partial
+            composite = combiner.combine_by_key(numpy_rdd)
+            aggregated_layer = TiledRasterLayer.from_numpy_rdd(gps.LayerType.SPATIAL, composite, layer.layer_metadata)
+            return aggregated_layer
 
-        project = partial(
-            pyproj.transform,
-            pyproj.Proj(srs),  # source coordinate system
-            pyproj.Proj(dest_srs))  # destination coordinate system
+        return self.apply_to_levels(aggregate_temporally)
 
-        return transform(project, polygon)  # apply projection
 
     def merge(self,other:'GeotrellisTimeSeriesImageCollection',overlaps_resolver:str=None):
         #we may need to align datacubes automatically?
@@ -358,7 +519,7 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         if polygon is not None:
             max_level = self.pyramid.levels[self.pyramid.max_zoom]
             layer_crs = max_level.layer_metadata.crs
-            reprojected_polygon = GeotrellisTimeSeriesImageCollection.__reproject_polygon(polygon,"+init="+srs,layer_crs)
+            reprojected_polygon = reproject_polygon(polygon, srs, layer_crs)
             #TODO should we warn when masking generates an empty collection?
             return self.apply_to_levels(lambda rdd: rdd.mask(
                 reprojected_polygon,
@@ -367,9 +528,11 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         elif rastermask is not None:
             pysc = gps.get_spark_context()
             #mask needs to be the same layout as this layer
-            mask_pyramid_levels = {k: l.tile_to_layout(layout=self.pyramid.levels[k]) for k, l in rastermask.pyramid.levels.items()}
+            def mask_level(level):
+                return rastermask.pyramid.levels[level].tile_to_layout(layout=self.pyramid.levels[level])
+
             return self._apply_to_levels_geotrellis_rdd(
-                lambda rdd,level: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().rasterMask(rdd, mask_pyramid_levels[level].srdd.rdd(),replacement))
+                lambda rdd,level: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().rasterMask(rdd, mask_level(level).srdd.rdd(),replacement))
         else:
             raise AttributeError("mask process: either a polygon or a rastermask should be provided.")
 
@@ -399,7 +562,7 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
             result_collection = self._apply_to_levels_geotrellis_rdd(
                 lambda rdd, level: pysc._jvm.org.openeo.geotrellis.OpenEOProcesses().apply_kernel_spatial(rdd,geotrellis_tile))
         if(factor != 1.0):
-            result_collection.pyramid = result_collection.pyramid * factor
+            result_collection = result_collection.apply_to_levels(lambda layer: layer * factor)
         return result_collection
 
     def resample_spatial(
@@ -482,26 +645,50 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
             :param output_max: Maximum output value
             :return An ImageCollection instance
         """
-        rescaled = self.apply_to_levels(lambda layer: layer.normalize(output_min, output_max, input_min, input_max))
+        pending = lazy_pyramid.pending_cell_functions(self.pyramid)
+        if pending is not None and (pending.cell_type or '').startswith('float'):
+            # fuse with the pending cell functions (e.g. apply_pixel) instead of doing a separate normalize pass
+            scale = (output_max - output_min) / (input_max - input_min)
+            rescaled = self._with_pyramid(lazy_pyramid.map_cells(
+                self.pyramid, lambda cells, nd: (cells - input_min) * scale + output_min))
+        else:
+            rescaled = self.apply_to_levels(lambda layer: layer.normalize(output_min, output_max, input_min, input_max))
         output_range = output_max - output_min
         if output_range >1 and type(output_min) == int and type(output_max) == int:
             if output_range < 254 and output_min >= 0:
-                rescaled = rescaled.apply_to_levels(lambda layer: layer.convert_data_type(gps.CellType.UINT8,255))
+                rescaled = rescaled._with_pyramid(lazy_pyramid.convert_data_type(rescaled.pyramid, gps.CellType.UINT8, 255))
             elif output_range < 65535 and output_min >= 0:
-                rescaled = rescaled.apply_to_levels(lambda layer: layer.convert_data_type(gps.CellType.UINT16))
+                rescaled = rescaled._with_pyramid(lazy_pyramid.convert_data_type(rescaled.pyramid, gps.CellType.UINT16))
         return rescaled
 
     def timeseries(self, x, y, srs="EPSG:4326") -> Dict:
+        return self.timeseries_points([x], [y], srs)[(x, y)]
+
+    def timeseries_points(self, xs, ys, srs="EPSG:4326") -> Dict[Tuple[float, float], Dict]:
+        """
+        Timeseries of many points at once: the points are reprojected in one call and sampled in a single pass over
+        the layer.
+
+        :param xs: x coordinates of the points (in srs)
+        :param ys: y coordinates of the points (in srs)
+        :return: the timeseries of every point, by its (x, y)
+        """
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        if xs.shape != ys.shape:
+            raise ValueError("got {x} x and {y} y coordinates".format(x=xs.size, y=ys.size))
+
         max_level = self.pyramid.levels[self.pyramid.max_zoom]
-        (x_layer,y_layer) = pyproj.transform(pyproj.Proj(init=srs),pyproj.Proj(max_level.layer_metadata.crs),x,y)
-        points = [
-            Point(x_layer, y_layer),
-        ]
-        values = max_level.get_point_values(points)
+        xs_layer, ys_layer = get_transformer(srs, max_level.layer_metadata.crs).transform(xs, ys)
+        points = {i: Point(x, y) for i, (x, y) in enumerate(zip(np.atleast_1d(xs_layer), np.atleast_1d(ys_layer)))}
+        values = max_level.get_point_values(points) if points else {}
+
+        return {(float(x), float(y)): self._point_timeseries(values.get(i, (None, None))[1])
+                for i, (x, y) in enumerate(zip(xs, ys))}
+
+    @staticmethod
+    def _point_timeseries(values) -> Dict:
         result = {}
-        if isinstance(values[0][1],List):
-            values = values[0][1]
-        for v in values:
+        for v in values or []:
             if isinstance(v,float):
                 result["NoDate"]=v
             elif "isoformat" in dir(v[0]):
@@ -514,7 +701,30 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
 
         return result
 
-    def zonal_statistics(self, regions, func) -> AggregatePolygonResult:
+    def zonal_statistics(self, regions, func, rank_error: float = None) -> AggregatePolygonResult:
+        """
+        :param func: a statistic, or a list of statistics to compute in a single pass
+        :param rank_error: compute medians and percentiles approximately, with mergeable sketches of this accuracy,
+            instead of collecting all values (defaults to the configured one)
+        """
+        multiple_geometries = isinstance(regions, str) or isinstance(regions, GeometryCollection)
+        if rank_error is None:
+            rank_error = ConfigParams().zonal_statistics_rank_error
+
+        cache = result_cache.get_result_cache()
+        cache_key = result_cache.request_key('zonal_statistics', func, str(regions), rank_error) if cache else None
+        timeseries = cache.get_json(cache_key, object_pairs_hook=_with_number_keys) if cache_key else None
+        if timeseries is None:
+            timeseries = self._zonal_statistics(regions, func, rank_error)
+            if cache_key:
+                cache.put_json(cache_key, timeseries)
+
+        return AggregatePolygonResult(
+            timeseries=timeseries,
+            regions=regions if multiple_geometries else GeometryCollection([regions]),
+        )
+
+    def _zonal_statistics(self, regions, func, rank_error: float = None) -> dict:
         # TODO eliminate code duplication
         def insert_timezone(instant):
             return instant.replace(tzinfo=pytz.UTC) if instant.tzinfo is None else instant
@@ -522,7 +732,27 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         from_vector_file = isinstance(regions, str)
         multiple_geometries = from_vector_file or isinstance(regions, GeometryCollection)
 
-        if func == 'histogram' or func == 'sd':
+        def polygons():
+            if from_vector_file:
+                return self._read_polygons(regions)
+            return list(regions) if multiple_geometries else [regions]
+
+        def statistics_of(statistics: List[str]) -> dict:
+            key = json.dumps({'statistics': statistics, 'rank_error': rank_error}, sort_keys=True)
+            return self._incremental_timeseries(
+                polygons(), key,
+                lambda collection, ps: collection._polygonal_statistics_multiple(ps, statistics, rank_error), dict)
+
+        def statistic_of(statistic: str) -> dict:
+            values = statistics_of([statistic])
+            return {date: [s.get(statistic, []) for s in statistics] for date, statistics in values.items()}
+
+        if isinstance(func, (list, tuple)):
+            return statistics_of(list(func))
+        elif func == 'median' and rank_error is not None:
+            # approximate, with sketches instead of all values of every polygon
+            return statistic_of('median')
+        elif func == 'histogram' or func == 'sd':
             highest_level = self.pyramid.levels[self.pyramid.max_zoom]
             layer_metadata = highest_level.layer_metadata
 
@@ -554,10 +784,7 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
                 self._band_index
             )
 
-            return AggregatePolygonResult(
-                timeseries=self._as_python(stats),
-                regions=regions if multiple_geometries else GeometryCollection([regions]),
-            )
+            return self._as_python(stats)
         elif func == 'median':
             highest_level = self.pyramid.levels[self.pyramid.max_zoom]
             layer_metadata = highest_level.layer_metadata
@@ -588,52 +815,50 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
                     self._band_index
                 )
 
-            return AggregatePolygonResult(
-                timeseries=self._as_python(stats),
-                regions=regions if multiple_geometries else GeometryCollection([regions]),
-            )
-        else:  # defaults to mean, historically
-            if multiple_geometries:
+            return self._as_python(stats)
+        elif func != 'mean':
+            # raises a ValueError for an unknown statistic
+            return statistic_of(zonal_statistics.check_statistics([func])[0])
+        else:
+            if from_vector_file:
                 highest_level = self.pyramid.levels[self.pyramid.max_zoom]
                 layer_metadata = highest_level.layer_metadata
                 scala_data_cube = highest_level.srdd.rdd()
-                polygons_srs = 'EPSG:4326'
                 from_date = insert_timezone(layer_metadata.bounds.minKey.instant)
                 to_date = insert_timezone(layer_metadata.bounds.maxKey.instant)
 
-                with tempfile.NamedTemporaryFile(suffix=".json.tmp") as temp_file:
-                    if from_vector_file:
-                        self._compute_stats_geotrellis().compute_average_timeseries_from_datacube(
-                            scala_data_cube,
-                            regions,
-                            from_date.isoformat(),
-                            to_date.isoformat(),
-                            self._band_index,
-                            temp_file.name
-                        )
-
-                    else:
-                        self._compute_stats_geotrellis().compute_average_timeseries_from_datacube(
-                            scala_data_cube,
-                            [str(ob) for ob in regions],
-                            polygons_srs,
-                            from_date.isoformat(),
-                            to_date.isoformat(),
-                            self._band_index,
-                            temp_file.name
-                        )
-
-                    with open(temp_file.name, encoding='utf-8') as f:
-                        timeseries = json.load(f)
-                return AggregatePolygonResult(
-                    timeseries=timeseries,
-                    regions=regions,
-                )
+                # the JVM writes its result to a file: keep that in memory (tmpfs) where possible
+                temp_dir = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+                with tempfile.NamedTemporaryFile(suffix=".json.tmp", dir=temp_dir) as temp_file:
+                    self._compute_stats_geotrellis().compute_average_timeseries_from_datacube(
+                        scala_data_cube,
+                        regions,
+                        from_date.isoformat(),
+                        to_date.isoformat(),
+                        self._band_index,
+                        temp_file.name
+                    )
+
+                    with open(temp_file.name, 'rb') as f:
+                        timeseries = json.loads(f.read().decode('utf-8'))
+                return timeseries
+            elif multiple_geometries:
+                return self._incremental_timeseries(
+                    list(regions), 'mean', lambda collection, ps: collection._polygonal_mean_timeseries_multiple(ps),
+                    list)
             else:
-                return AggregatePolygonResult(
-                    timeseries=self.polygonal_mean_timeseries(regions),
-                    regions=GeometryCollection([regions]),
-                )
+                return self.polygonal_mean_timeseries(regions)
+
+    @staticmethod
+    def _read_polygons(vector_file: str) -> List[Union[Polygon, MultiPolygon]]:
+        """The polygons of a vector file, reprojected from its CRS to EPSG:4326, like the polygons of a request."""
+        import geopandas as gpd
+
+        features = gpd.read_file(vector_file)
+        # without a CRS, the features are assumed to be in EPSG:4326 already (like GeoJSON)
+        if features.crs:
+            features = features.to_crs(epsg=4326)
+        return list(features.geometry)
 
     def _compute_stats_geotrellis(self):
         jvm = gps.get_spark_context()._gateway.jvm
@@ -647,65 +872,219 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
     def _as_python(self, java_object):
         """
         Converts Java collection objects retrieved from Py4J to their Python counterparts, recursively.
+
+        Rather than fetching every element with a separate Py4J call, the whole collection is serialized to JSON on
+        the JVM and transferred as a single byte array. JSON only has string keys, so keys that are numbers (like the
+        bins of a histogram) are converted back; the statistics have no string keys that look like numbers (their
+        other keys are dates).
         :param java_object: a JavaList or JavaMap
         :return: a Python list or dictionary, respectively
         """
 
         from py4j.java_collections import JavaList, JavaMap
 
-        if isinstance(java_object, JavaList):
-            return [self._as_python(elem) for elem in list(java_object)]
-
-        if isinstance(java_object, JavaMap):
-            return {self._as_python(key): self._as_python(value) for key, value in dict(java_object).items()}
+        if isinstance(java_object, (JavaList, JavaMap)):
+            return json.loads(self._json_mapper().writeValueAsBytes(java_object).decode('utf-8'),
+                              object_pairs_hook=_with_number_keys)
 
         return java_object
 
+    @staticmethod
+    def _json_mapper():
+        jvm = gps.get_spark_context()._gateway.jvm
+        # Jackson is on the classpath of Spark; write NaN as a bare token, which json.loads reads back as a float
+        generator_feature = getattr(jvm.com.fasterxml.jackson.core, "JsonGenerator$Feature")
+        return jvm.com.fasterxml.jackson.databind.ObjectMapper() \
+            .configure(generator_feature.QUOTE_NON_NUMERIC_NUMBERS, False)
+
     def polygonal_mean_timeseries(self, polygon: Union[Polygon, MultiPolygon]) -> Dict:
+        return self._incremental_timeseries([polygon], 'polygonal_mean',
+                                            lambda collection, polygons: collection._polygonal_mean_timeseries(
+                                                polygons[0]), list)
+
+    def _polygonal_mean_timeseries(self, polygon: Union[Polygon, MultiPolygon]) -> Dict:
         max_level = self.pyramid.levels[self.pyramid.max_zoom]
         layer_crs = max_level.layer_metadata.crs
-        reprojected_polygon = GeotrellisTimeSeriesImageCollection.__reproject_polygon(polygon, "+init=EPSG:4326" ,layer_crs)
-
-        #TODO somehow mask function was masking everything, while the approach with direct timeseries computation did not have issues...
-        masked_layer = max_level.mask(reprojected_polygon)
+        reprojected_polygon = reproject_polygon(polygon, "EPSG:4326", layer_crs)
 
-        no_data = masked_layer.layer_metadata.no_data_value
+        # only the tiles that the polygon touches are masked (in Python), the others are skipped altogether
+        index = PolygonKeyIndex([reprojected_polygon], max_level.layer_metadata.layout_definition, layer_crs)
 
-        def combine_cells(acc: List[Tuple[int, int]], tile) -> List[Tuple[int, int]]:  # [(sum, count)]
-            n_bands = len(tile.cells)
+        no_data = max_level.layer_metadata.no_data_value
 
-            if not acc:
-                acc = [(0, 0)] * n_bands
+        def tile_sums_and_counts(pair: Tuple[SpaceTimeKey, Tile]):
+            key, tile = pair
+            inside = index.mask(key.col, key.row, 0)
+            # only look at the cells of tiles that actually have pixels in the polygon
+            if inside.any():
+                yield key.instant, GeotrellisTimeSeriesImageCollection._sums_and_counts(tile.cells, inside, no_data)
 
-            for i in range(n_bands):
-                grid = tile.cells[i]
+        polygon_sums_and_counts = max_level.to_numpy_rdd() \
+            .filter(lambda pair: (pair[0].col, pair[0].row) in index) \
+            .flatMap(tile_sums_and_counts) \
+            .reduceByKey(np.add)
 
-                # special treatment for a UDF layer (NO_DATA is nan so every value, including nan, is not equal to nan)
-                without_no_data = (~np.isnan(grid)) & (grid != no_data)
+        collected = polygon_sums_and_counts.collect()
+        return {timestamp.isoformat(): [self._means(sums_and_counts)] for timestamp, sums_and_counts in collected}
 
-                sum = grid[without_no_data].sum()
-                count = without_no_data.sum()
-
-                acc[i] = acc[i][0] + sum, acc[i][1] + count
+    @staticmethod
+    def _sums_and_counts(cells: np.ndarray, inside: np.ndarray, no_data) -> np.ndarray:
+        """
+        Sum and count of the valid cells inside a mask, for each band: an (n_bands, 2) float64 array.
 
-            return acc
+        :param cells: (n_bands, rows, cols) cells of a tile
+        :param inside: (rows, cols) mask
+        :param no_data: no data value of the cells, in addition to NaN
+        """
+        valid = (inside & ~np.isnan(cells)) if cells.dtype.kind == 'f' else np.broadcast_to(inside, cells.shape)
+        if no_data is not None and not np.isnan(no_data):
+            valid = valid & (cells != no_data)
+        return np.stack([np.where(valid, cells, 0).sum(axis=(1, 2), dtype=np.float64),
+                         np.count_nonzero(valid, axis=(1, 2))], axis=1).astype(np.float64, copy=False)
+
+    @staticmethod
+    def _means(sums_and_counts: np.ndarray) -> List[float]:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums_and_counts[:, 0] / sums_and_counts[:, 1]).tolist()
+
+    def _polygonal_mean_timeseries_multiple(self, polygons: List[Union[Polygon, MultiPolygon]]) -> Dict:
+        """
+        Mean of every band, per polygon and per date: {date: [[band means of polygon 0], [band means of polygon 1], ...]}.
+        Polygons without pixels for a date get an empty list.
+        """
+        max_level = self.pyramid.levels[self.pyramid.max_zoom]
+        layer_crs = max_level.layer_metadata.crs
+        reprojected_polygons = reproject_polygons(polygons, "EPSG:4326", layer_crs)
+
+        index = PolygonKeyIndex(reprojected_polygons, max_level.layer_metadata.layout_definition, layer_crs)
+        no_data = max_level.layer_metadata.no_data_value
+
+        def polygon_sums(pair: Tuple[SpaceTimeKey, Tile]):
+            key, tile = pair
+            # each tile is only tested against the polygons that touch it
+            for polygon_index in index.polygons_for(key.col, key.row):
+                inside = index.mask(key.col, key.row, polygon_index)
+                if inside.any():
+                    yield (key.instant, polygon_index), \
+                          GeotrellisTimeSeriesImageCollection._sums_and_counts(tile.cells, inside, no_data)
+
+        sums_and_counts = max_level.to_numpy_rdd() \
+            .filter(lambda pair: (pair[0].col, pair[0].row) in index) \
+            .flatMap(polygon_sums) \
+            .reduceByKey(np.add) \
+            .collect()
+
+        means_by_timestamp = {}
+        for (timestamp, polygon_index), sum_count in sums_and_counts:
+            means = means_by_timestamp.setdefault(timestamp, [[] for _ in reprojected_polygons])
+            means[polygon_index] = self._means(sum_count)
+
+        return {self._to_utc_iso(timestamp): means for timestamp, means in means_by_timestamp.items()}
+
+    def _polygonal_statistics_multiple(self, polygons: List[Union[Polygon, MultiPolygon]],
+                                       statistics: List[str], rank_error: float = None) -> Dict:
+        """
+        Several statistics of every band, per polygon and per date, from a single pass over the tiles:
+        {date: [{statistic: [band values of polygon 0]}, {statistic: [band values of polygon 1]}, ...]}.
+        The number of valid pixels ("count") is always included. Polygons without pixels for a date get an empty dict.
 
-        def combine_values(l1: List[Tuple[int, int]], l2: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
-            for i in range(len(l2)):
-                l1[i] = l1[i][0] + l2[i][0], l1[i][1] + l2[i][1]
+        :param rank_error: if given, medians and percentiles are approximated with quantile sketches of this accuracy
+        """
+        statistics = zonal_statistics.check_statistics(statistics)
+        if 'count' not in statistics:
+            statistics = ['count'] + statistics
+        keep_values = zonal_statistics.needs_values(statistics)
 
-            return l1
+        max_level = self.pyramid.levels[self.pyramid.max_zoom]
+        layer_crs = max_level.layer_metadata.crs
+        reprojected_polygons = reproject_polygons(polygons, "EPSG:4326", layer_crs)
+
+        index = PolygonKeyIndex(reprojected_polygons, max_level.layer_metadata.layout_definition, layer_crs)
+        no_data = max_level.layer_metadata.no_data_value
+
+        def polygon_statistics(pair: Tuple[SpaceTimeKey, Tile]):
+            key, tile = pair
+            for polygon_index in index.polygons_for(key.col, key.row):
+                inside = index.mask(key.col, key.row, polygon_index)
+                if inside.any():
+                    yield (key.instant, polygon_index), \
+                          zonal_statistics.PolygonStatistics.of_cells(tile.cells, inside, no_data, keep_values,
+                                                                      rank_error)
+
+        merged = max_level.to_numpy_rdd() \
+            .filter(lambda pair: (pair[0].col, pair[0].row) in index) \
+            .flatMap(polygon_statistics) \
+            .reduceByKey(lambda a, b: a.merge(b)) \
+            .mapValues(lambda s: s.result(statistics)) \
+            .collect()
+
+        statistics_by_timestamp = {}
+        for (timestamp, polygon_index), result in merged:
+            statistics_by_timestamp.setdefault(timestamp, [{} for _ in reprojected_polygons])[polygon_index] = result
+
+        return {self._to_utc_iso(timestamp): s for timestamp, s in statistics_by_timestamp.items()}
+
+    def _incremental_timeseries(self, polygons: List[Union[Polygon, MultiPolygon]], statistic: str,
+                                compute: Callable[['GeotrellisTimeSeriesImageCollection', List], Dict],
+                                empty: Callable[[], object]) -> Dict:
+        """
+        Timeseries {date: [value of polygon 0, value of polygon 1, ...]} of a statistic that only computes the dates
+        that are missing from the timeseries store for this collection (and polygon), if there is one, and stores them.
+        Only the dates older than the settling time are marked as computed: more recent ones are computed again.
 
-        polygon_mean_by_timestamp = masked_layer.to_numpy_rdd() \
-            .map(lambda pair: (pair[0].instant, pair[1])) \
-            .aggregateByKey([], combine_cells, combine_values)
+        :param compute: computes the timeseries of some polygons for a collection (filtered to the missing dates)
+        :param empty: the value of a polygon without pixels for a date
+        """
+        store = timeseries_store.get_timeseries_store()
+        collection_key = timeseries_store.request_collection_key() if store else None
+        bounds = self.pyramid.levels[self.pyramid.max_zoom].layer_metadata.bounds
+        if collection_key is None or not hasattr(bounds.minKey, 'instant'):
+            return compute(self, polygons)
+
+        interval = (bounds.minKey.instant, bounds.maxKey.instant)
+        keys = [timeseries_store.polygon_key(polygon) for polygon in polygons]
+        first_index = {}
+        for i, key in enumerate(keys):
+            first_index.setdefault(key, i)
+        stored = store.get_many(collection_key, statistic, list(first_index))
+        entries = {key: stored.get(key, timeseries_store.TimeseriesEntry()) for key in first_index}
+
+        # the polygons that miss the same dates are computed together
+        missing_by_key = {key: timeseries_store.missing_intervals(interval, entry.covered)
+                          for key, entry in entries.items()}
+        groups = {}
+        for key, missing in missing_by_key.items():
+            if missing:
+                groups.setdefault(tuple(missing), []).append(key)
+
+        new_values = {key: {} for key in missing_by_key}
+        for missing, group in groups.items():
+            group_polygons = [polygons[first_index[key]] for key in group]
+            for start, end in missing:
+                timeseries = compute(self.date_range_filter(start, end), group_polygons)
+                for date, values in timeseries.items():
+                    for key, value in zip(group, values):
+                        if value != empty():
+                            new_values[key][date] = value
+
+        covered = timeseries_store.settled(interval, ConfigParams().timeseries_store_settling_time)
+        updated = {key: entries[key].updated(new_values[key], covered)
+                   for key, missing in missing_by_key.items() if missing}
+        if updated:
+            store.put_many(collection_key, statistic, updated)
+        entries.update(updated)
 
-        def to_mean(values: Tuple[int, int]) -> float:
-            sum, count = values
-            return sum / count
+        result = {}
+        for i, key in enumerate(keys):
+            for date, value in entries[key].within(interval).items():
+                result.setdefault(date, [empty() for _ in polygons])[i] = value
+        return result
 
-        collected = polygon_mean_by_timestamp.collect()
-        return {timestamp.isoformat(): [[to_mean(v) for v in values]] for timestamp, values in collected}
+    @staticmethod
+    def _to_utc_iso(timestamp: datetime) -> str:
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(pytz.UTC).replace(tzinfo=None)
+        return timestamp.isoformat() + 'Z'
 
     def download(self,outputfile:str, **format_options) -> str:
         """Extracts a geotiff from this image collection."""
@@ -715,14 +1094,21 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
             _, filename = tempfile.mkstemp(suffix='.oeo-gps-dl')
         else:
             filename = outputfile
-        spatial_rdd = self.pyramid.levels[self.pyramid.max_zoom]
-        if spatial_rdd.layer_type != gps.LayerType.SPATIAL:
-            spatial_rdd = spatial_rdd.to_spatial_layer()
 
-        tiled = format_options.get("format", "GTiff").upper() == "GTIFF" and format_options.get("tiled", False)
+        cache = result_cache.get_result_cache()
+        cache_key = result_cache.request_key('download', format_options) if cache else None
+        if cache_key and cache.get_file(cache_key, filename):
+            _log.info("Serving download from result cache {k}".format(k=cache_key))
+            return filename
 
-        catalog = (format_options.get("format", "GTiff").upper() == "GTIFF" and
-                 format_options.get("parameters", {}).get("catalog", False))
+        self._download(filename, format_options)
+
+        if cache_key:
+            cache.put_file(cache_key, filename)
+        return filename
+
+    def _download(self, filename: str, format_options: dict) -> None:
+        spatial_rdd = self.pyramid.levels[self.pyramid.max_zoom]
 
         xmin, ymin, xmax, ymax = format_options.get('left'), format_options.get('bottom'),\
                                  format_options.get('right'), format_options.get('top')
@@ -730,41 +1116,121 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         if xmin and ymin and xmax and ymax:
             srs = format_options.get('srs', 'EPSG:4326')
 
-            src_crs = "+init=" + srs
             dst_crs = spatial_rdd.layer_metadata.crs
-            crop_bounds = self._reproject_extent(src_crs, dst_crs, xmin, ymin, xmax, ymax)
+            crop_bounds = self._reproject_extent(srs, dst_crs, xmin, ymin, xmax, ymax)
         else:
             crop_bounds = None
 
+        format = format_options.get("format", "GTiff").upper()
+        if format in ["NETCDF", "ZARR"]:
+            # keeps the time dimension
+            self._save_chunked(spatial_rdd, filename, netcdf=format == "NETCDF", crop_bounds=crop_bounds)
+            return
+
+        if spatial_rdd.layer_type != gps.LayerType.SPATIAL:
+            spatial_rdd = spatial_rdd.to_spatial_layer()
+
+        tiled = format_options.get("format", "GTiff").upper() == "GTIFF" and format_options.get("tiled", False)
+
+        cog = (format_options.get("format", "GTiff").upper() == "GTIFF" and
+               (format_options.get("cog", False) or format_options.get("parameters", {}).get("cog", False)))
+
+        catalog = (format_options.get("format", "GTiff").upper() == "GTIFF" and
+                 format_options.get("parameters", {}).get("catalog", False))
+
         if catalog:
-            self._save_on_executors(spatial_rdd, filename)
+            self._save_on_executors(spatial_rdd, filename, crop_bounds)
+        elif cog:
+            self._save_cog(spatial_rdd, filename, crop_bounds)
         elif tiled:
-            self._save_stitched_tiled(spatial_rdd, filename)
+            self._save_stitched_tiled(spatial_rdd, filename, crop_bounds)
         else:
             self._save_stitched(spatial_rdd, filename, crop_bounds)
 
-        return filename
+    def write_assets(self, directory: str) -> Dict[str, dict]:
+        """
+        Writes one GeoTIFF asset per date and tile, directly from the executors into a directory,
+        and a manifest of them (`ASSETS_MANIFEST`) from the driver; no tiles have to be stitched on the driver.
 
-    def _reproject_extent(self, src_crs, dst_crs, xmin, ymin, xmax, ymax):
-        src_proj = pyproj.Proj(src_crs)
-        dst_proj = pyproj.Proj(dst_crs)
-
-        def reproject_point(x, y):
-            return pyproj.transform(
-                src_proj,
-                dst_proj,
-                x, y
-            )
+        :return: the assets, by file name
+        """
+        layer = self.pyramid.levels[self.pyramid.max_zoom]
+        layer_metadata = layer.layer_metadata
+        layout = layer_metadata.layout_definition
+        tile_width = (layout.extent.xmax - layout.extent.xmin) / layout.tileLayout.layoutCols
+        tile_height = (layout.extent.ymax - layout.extent.ymin) / layout.tileLayout.layoutRows
+        crs = layer_metadata.crs
+
+        geotiff_rdd = layer.to_geotiff_rdd(
+            storage_method=gps.StorageMethod.TILED,
+            tile_dimensions=(layout.tileLayout.tileCols, layout.tileLayout.tileRows),
+            compression=gps.Compression.DEFLATE_COMPRESSION
+        )
+
+        def write_asset(item):
+            key, data = item
+            asset = {
+                "type": "image/tiff; application=geotiff",
+                "bbox": [layout.extent.xmin + key.col * tile_width, layout.extent.ymax - (key.row + 1) * tile_height,
+                         layout.extent.xmin + (key.col + 1) * tile_width, layout.extent.ymax - key.row * tile_height],
+                "crs": crs
+            }
+            name = "{c}_{r}.tif".format(c=key.col, r=key.row)
+            if isinstance(key, SpaceTimeKey):
+                instant = key.instant.astimezone(pytz.UTC).replace(tzinfo=None) if key.instant.tzinfo else key.instant
+                asset["datetime"] = instant.isoformat() + 'Z'
+                name = instant.strftime('%Y%m%dT%H%M%SZ') + "_" + name
+
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+            return name, dict(asset, href=name)
 
-        reprojected_xmin, reprojected_ymin = reproject_point(xmin, ymin)
-        reprojected_xmax, reprojected_ymax = reproject_point(xmax, ymax)
+        assets = dict(sorted(geotiff_rdd.map(write_asset).collect()))
+        with open(os.path.join(directory, self.ASSETS_MANIFEST), 'w') as f:
+            json.dump({"assets": assets}, f, indent=2)
+        return assets
+
+    def _reproject_extent(self, src_crs, dst_crs, xmin, ymin, xmax, ymax):
+        reprojected_xmin, reprojected_ymin, reprojected_xmax, reprojected_ymax = \
+            reproject_bounds((xmin, ymin, xmax, ymax), src_crs, dst_crs)
         crop_bounds = \
             Extent(xmin=reprojected_xmin, ymin=reprojected_ymin, xmax=reprojected_xmax, ymax=reprojected_ymax)
         return crop_bounds
 
-    def _save_on_executors(self, spatial_rdd: gps.TiledRasterLayer, path):
+    @staticmethod
+    def _keys_in_crop(layer_metadata: Metadata, crop_bounds: Extent = None) -> Callable[[Any], bool]:
+        """
+        Predicate of the keys of the tiles that intersect the crop bounds (in the CRS of the layer), for the write
+        paths that stream the tiles into Python anyway to leave out the other tiles before they are shuffled to the
+        driver or encoded. Without crop bounds, every key is kept; if they do not intersect the layer, none is.
+        """
+        if not crop_bounds:
+            return lambda key: True
+
+        layout = layer_metadata.layout_definition
+        tile_width = (layout.extent.xmax - layout.extent.xmin) / layout.tileLayout.layoutCols
+        tile_height = (layout.extent.ymax - layout.extent.ymin) / layout.tileLayout.layoutRows
+
+        min_key, max_key = layer_metadata.bounds.minKey, layer_metadata.bounds.maxKey
+        min_col = max(int(math.floor((crop_bounds.xmin - layout.extent.xmin) / tile_width)), min_key.col)
+        max_col = min(int(math.ceil((crop_bounds.xmax - layout.extent.xmin) / tile_width)) - 1, max_key.col)
+        min_row = max(int(math.floor((layout.extent.ymax - crop_bounds.ymax) / tile_height)), min_key.row)
+        max_row = min(int(math.ceil((layout.extent.ymax - crop_bounds.ymin) / tile_height)) - 1, max_key.row)
+        if min_col > max_col or min_row > max_row:
+            return lambda key: False
+
+        def in_crop(key) -> bool:
+            return min_col <= key.col <= max_col and min_row <= key.row <= max_row
+
+        return in_crop
+
+    def _save_on_executors(self, spatial_rdd: gps.TiledRasterLayer, path, crop_bounds=None):
+        in_crop = self._keys_in_crop(spatial_rdd.layer_metadata, crop_bounds)
+        tile_layout = spatial_rdd.layer_metadata.layout_definition.tileLayout
+        # one block per tile, so the merge can copy the compressed blocks as is
         geotiff_rdd = spatial_rdd.to_geotiff_rdd(
             storage_method=gps.StorageMethod.TILED,
+            tile_dimensions=(tile_layout.tileCols, tile_layout.tileRows),
             compression=gps.Compression.DEFLATE_COMPRESSION
         )
 
@@ -777,17 +1243,22 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
             with path.open('wb') as f:
                 f.write(data)
 
-        geotiff_rdd.foreach(write_tiff)
+        geotiff_rdd.filter(lambda item: in_crop(item[0])).foreach(write_tiff)
         tiffs = [str(path.absolute()) for path in basedir.glob('*.tiff')]
+        if not tiffs:
+            # no tiles (in the crop bounds): leave it to saveStitched
+            self._save_stitched(spatial_rdd, path, crop_bounds)
+            return
 
         _log.info("Merging results {t!r}".format(t=tiffs))
-        merge_args = ["gdal_merge.py", "-o", path, "-of", "GTiff", "-co", "COMPRESS=DEFLATE", "-co", "TILED=TRUE"]
-        merge_args += tiffs
-        _log.info("Executing: {a!r}".format(a=merge_args))
-        subprocess.check_call(merge_args, shell=False, env={"GDAL_CACHEMAX": "1024"})
-
+        geotiff.merge(tiffs, str(path))
 
     def _save_stitched(self, spatial_rdd, path, crop_bounds=None):
+        tile_layout = spatial_rdd.layer_metadata.layout_definition.tileLayout
+        if not crop_bounds and tile_layout.tileCols % 16 == 0 and tile_layout.tileRows % 16 == 0 \
+                and self._save_stitched_blocks(spatial_rdd, path):
+            return
+
         jvm = gps.get_spark_context()._gateway.jvm
 
         max_compression = jvm.geotrellis.raster.io.geotiff.compression.DeflateCompression(9)
@@ -798,59 +1269,200 @@ class GeotrellisTimeSeriesImageCollection(ImageCollection):
         else:
             jvm.org.openeo.geotrellis.geotiff.package.saveStitched(spatial_rdd.srdd.rdd(), path, max_compression)
 
-    def _save_stitched_tiled(self, spatial_rdd, filename):
-        import rasterio as rstr
-        from affine import Affine
-        import rasterio._warp as rwarp
-        from math import log
+    def _save_stitched_blocks(self, spatial_rdd, path, compression_level=9) -> bool:
+        """
+        Writes a tiled GeoTIFF with one block per tile: the executors encode and compress the blocks in parallel,
+        the driver only writes the header and the block offsets, and appends the compressed blocks in key order.
+        Returns False (and writes nothing) if the layer has no tiles.
+        """
+        from itertools import chain
 
-        max_level = self.pyramid.levels[self.pyramid.max_zoom]
+        layer_metadata = spatial_rdd.layer_metadata
+        tile_layout = layer_metadata.layout_definition.tileLayout
+
+        def encode(key_tile):
+            key, tile = key_tile
+            return (key.row, key.col), (tile.cells.shape[0], tile.cells.dtype,
+                                        geotiff.encode_block(tile.cells, compression_level))
 
         spatial_rdd = spatial_rdd.persist()
+        try:
+            keys = spatial_rdd.collect_keys()
+            if not keys:
+                return False
+            grid = geotiff.RasterGrid.of_keys(keys, layer_metadata.layout_definition)
+            min_col, min_row = min(k.col for k in keys), min(k.row for k in keys)
+
+            # row major key order matches the order of the blocks in the file
+            blocks = spatial_rdd.to_numpy_rdd().map(encode).sortByKey().toLocalIterator()
+            first = next(blocks)
+            _, (count, dtype, _) = first
+
+            positioned_blocks = ((col - min_col, row - min_row, data)
+                                 for (row, col), (_, _, data) in chain([first], blocks))
+            geotiff.write_blocks(positioned_blocks, path, grid, layer_metadata.crs, dtype, count,
+                                 (tile_layout.tileCols, tile_layout.tileRows), nodata=layer_metadata.no_data_value,
+                                 compression_level=compression_level)
+            return True
+        finally:
+            spatial_rdd.unpersist()
+
+    def _save_chunked(self, layer: gps.TiledRasterLayer, filename, netcdf=False, crop_bounds=None):
+        """
+        Writes a (spatiotemporal) layer as a data cube with time and band dimensions: every tile is a chunk of a Zarr
+        store, that is packed in a zip file (that Zarr reads as a ZipStore), or copied into a NetCDF4 file.
 
-        sorted_keys = sorted(spatial_rdd.collect_keys())
-
-        upper_left_coords = GeotrellisTimeSeriesImageCollection._mapTransform(max_level.layer_metadata.layout_definition, sorted_keys[0])
-        lower_right_coords = GeotrellisTimeSeriesImageCollection._mapTransform(max_level.layer_metadata.layout_definition, sorted_keys[-1])
-
-        data = spatial_rdd.stitch()
-
-        bands, w, h = data.cells.shape
-        nodata = max_level.layer_metadata.no_data_value
-        dtype = data.cells.dtype
-        ex = Extent(xmin=upper_left_coords.left, ymin=lower_right_coords.bottom, xmax=lower_right_coords.right, ymax=upper_left_coords.top)
-        cw, ch = (ex.xmax - ex.xmin) / w, (ex.ymax - ex.ymin) / h
-        overview_level = int(log(w) / log(2) - 8)
-
-        with rstr.io.MemoryFile() as memfile, open(filename, 'wb') as f:
-            with memfile.open(driver='GTiff',
-                              count=bands,
-                              width=w,
-                              height=h,
-                              transform=Affine(cw, 0.0, ex.xmin,
-                                               0.0, -ch, ex.ymax),
-                              crs=rstr.crs.CRS.from_proj4(spatial_rdd.layer_metadata.crs),
-                              nodata=nodata,
-                              dtype=dtype,
-                              compress='lzw',
-                              tiled=True) as mem:
-                windows = list(mem.block_windows(1))
-                for _, w in windows:
-                    segment = data.cells[:, w.row_off:(w.row_off + w.height), w.col_off:(w.col_off + w.width)]
-                    mem.write(segment, window=w)
-                    mask_value = np.all(segment != nodata, axis=0).astype(np.uint8) * 255
-                    mem.write_mask(mask_value, window=w)
-
-                    overviews = [2 ** j for j in range(1, overview_level + 1)]
-                    mem.build_overviews(overviews, rwarp.Resampling.nearest)
-                    mem.update_tags(ns='rio_oveview', resampling=rwarp.Resampling.nearest.value)
+        If the output directory is shared with the executors (`ConfigParams().executor_shared_dirs`), they compress
+        and write the chunks in parallel; otherwise they compress them and stream them to the driver (one partition
+        at a time), that writes them one after the other. A NetCDF4 file is always written by the driver alone.
+        """
+        layer_metadata = layer.layer_metadata
+        in_crop = self._keys_in_crop(layer_metadata, crop_bounds)
+        store_path = tempfile.mkdtemp(prefix='zarr-', dir=os.path.dirname(os.path.abspath(filename)))
 
-            while True:
-                chunk = memfile.read(8192)
-                if not chunk:
-                    break
+        try:
+            layer = layer.persist()
+            try:
+                keys = [key for key in layer.collect_keys() if in_crop(key)]
+                store = ZarrCubeStore.of_keys(store_path, keys, layer_metadata)
+                tiles = layer.to_numpy_rdd().filter(lambda key_tile: in_crop(key_tile[0]))
+
+                if _shared_with_executors(store_path):
+                    def write(key_tile):
+                        key, tile = key_tile
+                        store.write_chunk(key, tile.cells)
+                        return tile.cells.dtype.str, tile.cells.shape[0]
+
+                    written = tiles.map(write).distinct().collect()
+                    missing = [key for key in keys if not os.path.exists(store.chunk_path(key))]
+                    if missing:
+                        raise IOError("The chunks of {n} tiles, like {k}, are missing from {p}: is it shared with the"
+                                      " executors?".format(n=len(missing), k=missing[0], p=store_path))
+                else:
+                    def encode(key_tile):
+                        key, tile = key_tile
+                        return key, tile.cells.dtype.str, tile.cells.shape[0], store.encode_chunk(tile.cells)
+
+                    written = set()
+                    for key, dtype, band_count, data in tiles.map(encode).toLocalIterator():
+                        store.write_encoded_chunk(key, data)
+                        written.add((dtype, band_count))
+                    written = list(written)
+            finally:
+                layer.unpersist()
+
+            bands = self.metadata.bands if self.metadata is not None else []
+            if not keys:
+                # an empty cube: only the metadata tell its cell type and bands
+                written = [(lazy_pyramid._parse_cell_type(layer_metadata.cell_type)[0].str, max(len(bands), 1))]
+            if len(written) != 1:
+                raise ValueError("Expected tiles with the same cell type and bands, but got: {w}".format(w=written))
+            dtype, band_count = written[0]
+
+            band_names = [band.name for band in bands] if len(bands) == band_count \
+                else ["band_{i}".format(i=i) for i in range(band_count)]
+            store.write_metadata(np.dtype(dtype), band_names, layer_metadata.no_data_value)
+
+            if netcdf:
+                store.to_netcdf(filename)
+            else:
+                store.to_zip(filename)
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
+
+    @staticmethod
+    def _tiles_in_key_order(spatial_rdd: gps.TiledRasterLayer, in_crop: Callable[[Any], bool] = None):
+        tiles = spatial_rdd.to_numpy_rdd()
+        if in_crop is not None:
+            tiles = tiles.filter(lambda key_tile: in_crop(key_tile[0]))
+        # row major key order matches the order of the blocks in the file
+        return tiles \
+            .sortBy(lambda key_tile: (key_tile[0].row, key_tile[0].col)) \
+            .toLocalIterator()
+
+    def _save_stitched_tiled(self, spatial_rdd, filename, crop_bounds=None):
+        """
+        Writes a tiled GeoTIFF by streaming the tiles to the driver in key order (one partition at a time)
+        and writing each of them directly into its window of the file on disk.
+        """
+        layer_metadata = spatial_rdd.layer_metadata
+        in_crop = self._keys_in_crop(layer_metadata, crop_bounds)
 
-                f.write(chunk)
+        spatial_rdd = spatial_rdd.persist()
+        try:
+            keys = [key for key in spatial_rdd.collect_keys() if in_crop(key)]
+            if not keys:
+                # no tiles (in the crop bounds): leave it to saveStitched
+                self._save_stitched(spatial_rdd, filename, crop_bounds)
+                return
+            grid = geotiff.RasterGrid.of_keys(keys, layer_metadata.layout_definition)
+            geotiff.write_tiles(self._tiles_in_key_order(spatial_rdd, in_crop), layer_metadata.layout_definition, filename,
+                                grid, layer_metadata.crs, nodata=layer_metadata.no_data_value, build_overviews=True)
+        finally:
+            spatial_rdd.unpersist()
+
+    def _save_cog(self, spatial_rdd, filename, crop_bounds=None):
+        """
+        Writes a Cloud Optimized GeoTIFF: the max zoom level as full resolution image, with the lower zoom levels of
+        the pyramid as its internal overviews, instead of downsampling the full resolution image again.
+        Lower levels that are not at a power of two of the full resolution are not used; if none of them are,
+        GDAL builds the overviews.
+        """
+        layer_metadata = spatial_rdd.layer_metadata
+        in_crop = self._keys_in_crop(layer_metadata, crop_bounds)
+
+        spatial_rdd = spatial_rdd.persist()
+        try:
+            keys = [key for key in spatial_rdd.collect_keys() if in_crop(key)]
+            if not keys:
+                # no tiles (in the crop bounds): leave it to saveStitched
+                self._save_stitched(spatial_rdd, filename, crop_bounds)
+                return
+            grid = geotiff.RasterGrid.of_keys(keys, layer_metadata.layout_definition)
+            tmp_dir = tempfile.mkdtemp(prefix='cog-', dir=os.path.dirname(os.path.abspath(filename)))
+            base = os.path.join(tmp_dir, 'base.tif')
+            overview_levels = self._overview_levels(grid, layer_metadata.crs)
+            geotiff.write_tiles(self._tiles_in_key_order(spatial_rdd, in_crop), layer_metadata.layout_definition, base, grid,
+                                layer_metadata.crs, nodata=layer_metadata.no_data_value, write_mask=False,
+                                build_overviews=not overview_levels)
+        finally:
+            spatial_rdd.unpersist()
+
+        try:
+            overviews = []
+            for factor, level in overview_levels:
+                overview = os.path.join(tmp_dir, 'overview_{f}.tif'.format(f=factor))
+                _log.info("Writing overview {f} of {n} from pyramid level".format(f=factor, n=filename))
+                level_in_crop = self._keys_in_crop(level.layer_metadata, crop_bounds)
+                geotiff.write_tiles(self._tiles_in_key_order(level, level_in_crop),
+                                    level.layer_metadata.layout_definition, overview,
+                                    grid.scaled(factor), layer_metadata.crs, nodata=layer_metadata.no_data_value,
+                                    write_mask=False)
+                overviews.append(overview)
+
+            geotiff.write_cog(base, overviews, filename)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _overview_levels(self, grid: 'geotiff.RasterGrid', crs: str) -> List[Tuple[int, gps.TiledRasterLayer]]:
+        """The (factor, spatial layer) of the pyramid levels that can be used as overviews of the grid."""
+        factors = geotiff.overview_factors(grid)
+        levels = {}
+        for zoom in sorted(self.pyramid.levels.keys(), reverse=True):
+            if zoom == self.pyramid.max_zoom:
+                continue
+            level = self.pyramid.levels[zoom]
+            metadata = level.layer_metadata
+            factor = geotiff.overview_factor(metadata.layout_definition, grid)
+            if factor in factors and factor not in levels and metadata.crs == crs:
+                levels[factor] = level if level.layer_type == gps.LayerType.SPATIAL else level.to_spatial_layer()
+        # overviews can not have gaps
+        overview_levels = []
+        for factor in factors:
+            if factor not in levels:
+                break
+            overview_levels.append((factor, levels[factor]))
+        return overview_levels
 
     def _proxy_tms(self,tms):
         if ConfigParams().is_ci_context:
@@ -101,6 +101,16 @@ class GeoPySparkBackendImplementation(backend.OpenEoBackendImplementation):
                 "GTiff": {
                     "title": "GeoTiff",
                     "gis_data_types": ["raster"],
+                    "parameters": {
+                        "cog": {
+                            "type": "boolean",
+                            "description": "Write a Cloud Optimized GeoTIFF, with the lower zoom levels as overviews."
+                        },
+                        "multiple_files": {
+                            "type": "boolean",
+                            "description": "Batch jobs only: write one GeoTIFF per date and tile, with a manifest."
+                        }
+                    }
                 },
                 "CovJSON": {
                     "gis_data_types": ["other"],  # TODO: also "raster", "vector", "table"?
@@ -108,6 +118,10 @@ class GeoPySparkBackendImplementation(backend.OpenEoBackendImplementation):
                 "NetCDF": {
                     "gis_data_types": ["other"],  # TODO: also "raster", "vector", "table"?
                 },
+                "Zarr": {
+                    "title": "Zarr (zip)",
+                    "gis_data_types": ["raster"],
+                },
             },
         }
 
@@ -249,7 +263,7 @@ class GpsBatchJobs(backend.BatchJobs):
 
             output_dir = self._get_job_output_dir(job_id)
             input_file = output_dir / "in"
-            # TODO: how support multiple output files?
+            # with the "multiple_files" parameter, the job writes its assets and their manifest next to this file
             output_file = output_dir / "out"
             log_file = output_dir / "log"
 
@@ -313,8 +327,15 @@ class GpsBatchJobs(backend.BatchJobs):
         job_info = self.get_job_info(job_id=job_id, user_id=user_id)
         if job_info.status != 'finished':
             raise JobNotFinishedException
+
+        job_dir = self._get_job_output_dir(job_id=job_id)
+        manifest = job_dir / GeotrellisTimeSeriesImageCollection.ASSETS_MANIFEST
+        if manifest.exists():
+            with manifest.open() as f:
+                assets = json.load(f)["assets"]
+            return {name: str(job_dir) for name in assets}
         return {
-            "out": str(self._get_job_output_dir(job_id=job_id))
+            "out": str(job_dir)
         }
 
     def get_log_entries(self, job_id: str, user_id: str, offset: str) -> List[dict]:
@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 
 
 class ConfigParams:
@@ -16,3 +17,26 @@ class ConfigParams:
         self.layer_catalog_metadata_files = env.get("OPENEO_CATALOG_FILES", "layercatalog.json").split(",")
 
         self.require_bounds = env.get("OPENEO_REQUIRE_BOUNDS") != "False"
+
+        # Disk backed cache of synchronous results: disabled if no directory is given
+        self.result_cache_dir = env.get("OPENEO_RESULT_CACHE_DIR")
+        self.result_cache_size = int(env.get("OPENEO_RESULT_CACHE_SIZE", 10 * 1024 ** 3))
+
+        # Rank error of the sketches of approximate zonal medians and percentiles: exact if not given
+        rank_error = env.get("OPENEO_ZONAL_STATISTICS_RANK_ERROR")
+        self.zonal_statistics_rank_error = float(rank_error) if rank_error else None
+
+        # Rasterized polygon masks that are kept in memory by every (executor) process, in bytes
+        self.mask_cache_size = int(env.get("OPENEO_MASK_CACHE_SIZE", 64 * 1024 ** 2))
+
+        # Directories that the executors share with the driver (like the output directory of batch jobs): chunked
+        # results (NetCDF, Zarr) in them are written by the executors instead of being streamed to the driver
+        self.executor_shared_dirs = [d for d in env.get("OPENEO_EXECUTOR_SHARED_DIRS", "").split(",") if d]
+
+        # Persistent store of per polygon timeseries, to only compute new dates: disabled if no directory is given
+        self.timeseries_store_dir = env.get("OPENEO_TIMESERIES_STORE_DIR")
+        # Only dates older than this count as computed (data for more recent ones can still be ingested)
+        self.timeseries_store_settling_time = timedelta(days=float(env.get("OPENEO_TIMESERIES_STORE_SETTLING_DAYS", 7)))
+        # Entries of the store are computed again after this time (to pick up reprocessed data): never if not given
+        ttl = env.get("OPENEO_TIMESERIES_STORE_TTL_DAYS")
+        self.timeseries_store_ttl = timedelta(days=float(ttl)) if ttl else None
@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import sys
 from typing import Dict, List
 
@@ -35,6 +36,17 @@ def _parse(job_specification_file: str) -> Dict:
     return job_specification
 
 
+def _multiple_files(format_options: dict) -> bool:
+    return (format_options.get("parameters") or {}).get("multiple_files", False)
+
+
+def _write_assets(image_collection, output_file: str) -> None:
+    # one asset per date and tile, next to the (single) output file
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    assets = image_collection.write_assets(output_dir)
+    logger.info("wrote %d assets and their manifest to %s" % (len(assets), output_dir))
+
+
 def main(argv: List[str]) -> None:
     logger.debug("argv: {a!r}".format(a=argv))
 
@@ -65,11 +77,18 @@ def main(argv: List[str]) -> None:
 
             if isinstance(result, ImageCollection):
                 format_options = job_specification.get('output', {})
-                result.download(output_file, bbox="", time="", **format_options)
-                logger.info("wrote image collection to %s" % output_file)
+                if _multiple_files(format_options):
+                    _write_assets(result, output_file)
+                else:
+                    result.download(output_file, bbox="", time="", **format_options)
+                    logger.info("wrote image collection to %s" % output_file)
             elif isinstance(result, ImageCollectionResult):
-                result.imagecollection.download(output_file, bbox="", time="", format=result.format, **result.options)
-                logger.info("wrote image collection to %s" % output_file)
+                if _multiple_files(result.options):
+                    _write_assets(result.imagecollection, output_file)
+                else:
+                    result.imagecollection.download(output_file, bbox="", time="", format=result.format,
+                                                    **result.options)
+                    logger.info("wrote image collection to %s" % output_file)
             elif isinstance(result, JSONResult):
                 with open(output_file, 'w') as f:
                     json.dump(result.prepare_for_json(), f)
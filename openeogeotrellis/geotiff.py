@@ -0,0 +1,544 @@
+"""
+Writing (tiled) GeoTIFFs from the tiles of a layer, one tile at a time, and merging GeoTIFFs.
+"""
+import math
+import os
+import struct
+import zlib
+from collections import namedtuple
+from itertools import chain
+from typing import Iterable, List, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+from geopyspark import SpatialKey, Tile
+
+# GDAL data type names of the numpy dtypes of GeoTrellis cell types (int8: see `_gdal_data_type`)
+_GDAL_DATA_TYPES = {
+    'uint8': 'Byte', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+    'float32': 'Float32', 'float64': 'Float64'
+}
+
+
+class RasterGrid(namedtuple('RasterGrid', ['left', 'top', 'cell_width', 'cell_height', 'width', 'height'])):
+    """Pixel grid of a raster: its upper left corner, cell size and size in pixels."""
+
+    @classmethod
+    def of_keys(cls, keys: Iterable[SpatialKey], layout_definition) -> 'RasterGrid':
+        """The grid covering the bounding box of the given keys of a layout definition."""
+        keys = list(keys)
+        min_col, max_col = min(k.col for k in keys), max(k.col for k in keys)
+        min_row, max_row = min(k.row for k in keys), max(k.row for k in keys)
+
+        extent, tile_layout = layout_definition.extent, layout_definition.tileLayout
+        cell_width, cell_height = cell_size(layout_definition)
+        return cls(
+            left=extent.xmin + min_col * tile_layout.tileCols * cell_width,
+            top=extent.ymax - min_row * tile_layout.tileRows * cell_height,
+            cell_width=cell_width,
+            cell_height=cell_height,
+            width=(max_col - min_col + 1) * tile_layout.tileCols,
+            height=(max_row - min_row + 1) * tile_layout.tileRows
+        )
+
+    def scaled(self, factor: int) -> 'RasterGrid':
+        """The grid of the same area at a resolution that is `factor` times coarser (like a GDAL overview)."""
+        return self._replace(cell_width=self.cell_width * factor, cell_height=self.cell_height * factor,
+                             width=int(math.ceil(self.width / factor)), height=int(math.ceil(self.height / factor)))
+
+    @property
+    def transform(self):
+        from affine import Affine
+        return Affine(self.cell_width, 0.0, self.left, 0.0, -self.cell_height, self.top)
+
+
+def cell_size(layout_definition) -> Tuple[float, float]:
+    extent, tile_layout = layout_definition.extent, layout_definition.tileLayout
+    return ((extent.xmax - extent.xmin) / tile_layout.layoutCols / tile_layout.tileCols,
+            (extent.ymax - extent.ymin) / tile_layout.layoutRows / tile_layout.tileRows)
+
+
+def overview_factor(layout_definition, grid: RasterGrid) -> int:
+    """
+    The overview factor (a power of two) of the cells of a layout definition relative to those of a grid,
+    or 0 if the cells are not a power of two times coarser.
+    """
+    cell_width, cell_height = cell_size(layout_definition)
+    factor = cell_width / grid.cell_width
+    power = int(round(math.log(factor, 2))) if factor > 0 else 0
+    if power < 1:
+        return 0
+    same_factor = math.isclose(factor, 2 ** power, rel_tol=1e-6) \
+        and math.isclose(cell_height / grid.cell_height, 2 ** power, rel_tol=1e-6)
+    return 2 ** power if same_factor else 0
+
+
+def overview_factors(grid: RasterGrid) -> List[int]:
+    """The overview factors for a raster: halving the resolution until it is about 256 pixels wide."""
+    overview_level = int(math.log(grid.width) / math.log(2) - 8) if grid.width > 0 else 0
+    return [2 ** j for j in range(1, overview_level + 1)]
+
+
+def write_tiles(tiles: Iterable[Tuple[SpatialKey, Tile]], layout_definition, path: str, grid: RasterGrid, crs: str,
+                nodata=None, write_mask: bool = True, build_overviews: bool = False, **creation_options) -> None:
+    """
+    Writes the tiles of a layer directly into their window of a tiled GeoTIFF on disk, so only one tile at a time
+    has to be in memory. Tiles (or the parts of tiles) outside of the grid are skipped, missing tiles are left as
+    no data. For the best write performance, the tiles should come in row major key order.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.windows import Window
+
+    tiles = iter(tiles)
+    first = next(tiles, None)
+    if first is None:
+        raise ValueError("No tiles to write to " + path)
+
+    tile_rows, tile_cols = first[1].cells.shape[-2:]
+    extent = layout_definition.extent
+    layout_cell_width, layout_cell_height = cell_size(layout_definition)
+    layout_tile_width = layout_cell_width * layout_definition.tileLayout.tileCols
+    layout_tile_height = layout_cell_height * layout_definition.tileLayout.tileRows
+
+    options = dict(compress='lzw', tiled=True)
+    # GeoTIFF block sizes must be multiples of 16; otherwise, GDAL's block cache takes care of the alignment
+    if tile_cols % 16 == 0 and tile_rows % 16 == 0:
+        options.update(blockxsize=tile_cols, blockysize=tile_rows)
+    options.update(creation_options)
+
+    with rasterio.open(path, 'w',
+                       driver='GTiff',
+                       count=first[1].cells.shape[0],
+                       width=grid.width,
+                       height=grid.height,
+                       transform=grid.transform,
+                       crs=rasterio.crs.CRS.from_proj4(crs),
+                       nodata=nodata,
+                       dtype=first[1].cells.dtype,
+                       **options) as dst:
+        for key, tile in chain([first], tiles):
+            col_off = int(round((extent.xmin + key.col * layout_tile_width - grid.left) / grid.cell_width))
+            row_off = int(round((grid.top - (extent.ymax - key.row * layout_tile_height)) / grid.cell_height))
+
+            # clip the tile to the grid
+            col_start, row_start = max(0, -col_off), max(0, -row_off)
+            col_end, row_end = min(tile_cols, grid.width - col_off), min(tile_rows, grid.height - row_off)
+            if col_end <= col_start or row_end <= row_start:
+                continue
+
+            cells = tile.cells[:, row_start:row_end, col_start:col_end]
+            window = Window(col_off=col_off + col_start, row_off=row_off + row_start,
+                            width=col_end - col_start, height=row_end - row_start)
+            dst.write(cells, window=window)
+            if write_mask:
+                mask_value = np.all(cells != nodata, axis=0).astype(np.uint8) * 255
+                dst.write_mask(mask_value, window=window)
+
+        if build_overviews:
+            factors = overview_factors(grid)
+            if factors:
+                dst.build_overviews(factors, Resampling.nearest)
+                dst.update_tags(ns='rio_overview', resampling=Resampling.nearest.name)
+
+
+def _gdal_has_int8() -> bool:
+    import rasterio
+    return tuple(int(v) for v in rasterio.__gdal_version__.split('.')[:2]) >= (3, 7)
+
+
+def _gdal_data_type(dtype: str) -> str:
+    """
+    GDAL data type name of a numpy dtype: GDAL only has a (signed) Int8 type since 3.7, before that int8 is a Byte
+    that is marked signed with PIXELTYPE=SIGNEDBYTE (see `_signed_byte_metadata` and `signed_byte_options`).
+    """
+    if dtype == 'int8':
+        return 'Int8' if _gdal_has_int8() else 'Byte'
+    return _GDAL_DATA_TYPES[dtype]
+
+
+def _signed_byte_metadata(dtype: str) -> str:
+    if dtype == 'int8' and not _gdal_has_int8():
+        return "<Metadata domain=\"IMAGE_STRUCTURE\"><MDI key=\"PIXELTYPE\">SIGNEDBYTE</MDI></Metadata>"
+    return ""
+
+
+def signed_byte_options(dtypes: List[str]) -> dict:
+    """GDAL creation options to keep int8 bands signed when GDAL copies them."""
+    return {'PIXELTYPE': 'SIGNEDBYTE'} if 'int8' in dtypes and not _gdal_has_int8() else {}
+
+
+def _vrt(width: int, height: int, crs, transform, dtypes: List[str], nodata, band_sources) -> str:
+    """VRT (XML) document; `band_sources(band)` gives the sources (XML) of a (1-based) band."""
+    bands = "".join(
+        "<VRTRasterBand dataType=\"{t}\" band=\"{b}\">{m}{n}{s}</VRTRasterBand>".format(
+            t=_gdal_data_type(dtype), b=band, s=band_sources(band), m=_signed_byte_metadata(dtype),
+            n="<NoDataValue>{n!r}</NoDataValue>".format(n=nodata) if nodata is not None else "")
+        for band, dtype in enumerate(dtypes, start=1))
+
+    return "<VRTDataset rasterXSize=\"{w}\" rasterYSize=\"{h}\"><SRS>{s}</SRS><GeoTransform>{g}</GeoTransform>{b}" \
+           "</VRTDataset>".format(w=width, h=height, s=escape(crs.to_wkt()), b=bands,
+                                  g=", ".join(repr(v) for v in transform.to_gdal()))
+
+
+def _source_filename(path: str) -> str:
+    return "<SourceFilename relativeToVRT=\"0\">{f}</SourceFilename>".format(f=escape(path))
+
+
+def overview_vrt(base: str, overviews: List[str]) -> str:
+    """
+    VRT (XML) of a GeoTIFF with the given GeoTIFFs as its overviews,
+    for GDAL to copy them with COPY_SRC_OVERVIEWS.
+    """
+    import rasterio
+
+    def band_sources(band):
+        return "<SimpleSource>{f}<SourceBand>{b}</SourceBand></SimpleSource>".format(f=_source_filename(base), b=band) \
+               + "".join("<Overview>{f}<SourceBand>{b}</SourceBand></Overview>".format(f=_source_filename(o), b=band)
+                         for o in overviews)
+
+    with rasterio.open(base) as src:
+        return _vrt(src.width, src.height, src.crs, src.transform, src.dtypes, src.nodata, band_sources)
+
+
+def write_cog(base: str, overviews: List[str], path: str, block_size: int = 512) -> None:
+    """
+    Writes a Cloud Optimized GeoTIFF with the given GeoTIFFs as overviews (or the overviews of the base GeoTIFF
+    if there are none): tiled, little endian, with all IFDs at the start of the file,
+    followed by the image data from the smallest overview to the full resolution image.
+    """
+    import rasterio
+    import rasterio.shutil
+
+    with rasterio.open(base) as src:
+        dtypes = src.dtypes
+
+    source = base
+    if overviews:
+        source = path + '.vrt'
+        with open(source, 'w') as f:
+            f.write(overview_vrt(base, overviews))
+
+    try:
+        rasterio.shutil.copy(source, path, driver='GTiff', tiled=True, blockxsize=block_size, blockysize=block_size,
+                             compress='deflate', copy_src_overviews=True, endianness='little',
+                             **signed_byte_options(dtypes))
+    finally:
+        if source != base:
+            os.remove(source)
+
+
+# TIFF tags of the layout of a tiled TIFF
+_IMAGE_WIDTH, _IMAGE_LENGTH, _BITS_PER_SAMPLE, _COMPRESSION = 256, 257, 258, 259
+_SAMPLES_PER_PIXEL, _PLANAR_CONFIGURATION, _PREDICTOR = 277, 284, 317
+_TILE_WIDTH, _TILE_LENGTH, _TILE_OFFSETS, _TILE_BYTE_COUNTS, _SAMPLE_FORMAT = 322, 323, 324, 325, 339
+
+# struct formats of the TIFF field types
+_TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd', 16: 'Q', 17: 'q'}
+
+_TiffEntry = namedtuple('_TiffEntry', ['type', 'count', 'position'])
+
+
+class TiffLayout(namedtuple('TiffLayout', [
+    'byte_order', 'big_tiff', 'width', 'height', 'tile_width', 'tile_height', 'encoding', 'tile_offsets',
+    'tile_byte_counts', 'offsets_entry', 'byte_counts_entry'
+])):
+    """
+    Layout of the blocks (tiles) of the first image of a tiled (Big)TIFF: where its compressed blocks are,
+    and how they are encoded (compression, predictor, interleave and sample type).
+    Blocks are in row major order, per band if the bands are not interleaved.
+    """
+
+    @property
+    def tiles_across(self) -> int:
+        return int(math.ceil(self.width / self.tile_width))
+
+    @property
+    def tiles_down(self) -> int:
+        return int(math.ceil(self.height / self.tile_height))
+
+    @property
+    def tiles_per_plane(self) -> int:
+        return self.tiles_across * self.tiles_down
+
+    @property
+    def planes(self) -> int:
+        return len(self.tile_offsets) // self.tiles_per_plane
+
+
+def read_tiff_layout(path: str) -> TiffLayout:
+    """Reads the block layout of the first image of a tiled (Big)TIFF from its header."""
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        try:
+            byte_order = {b'II': '<', b'MM': '>'}[header[:2]]
+        except KeyError:
+            raise ValueError("Not a TIFF file: " + path)
+
+        version = struct.unpack(byte_order + 'H', header[2:4])[0]
+        if version not in [42, 43]:
+            raise ValueError("Not a TIFF file: " + path)
+        big_tiff = version == 43
+        offset_format, count_format, entry_size = ('Q', 'Q', 20) if big_tiff else ('I', 'H', 12)
+
+        ifd_offset = struct.unpack(byte_order + offset_format, header[8:16] if big_tiff else header[4:8])[0]
+        f.seek(ifd_offset)
+        count_size = struct.calcsize(count_format)
+        entry_count = struct.unpack(byte_order + count_format, f.read(count_size))[0]
+        ifd = f.read(entry_count * entry_size)
+
+        entries = {}
+        for i in range(entry_count):
+            entry = ifd[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(byte_order + 'HH', entry[:4])
+            if field_type not in _TIFF_TYPES:
+                continue
+            count = struct.unpack(byte_order + offset_format, entry[4:4 + struct.calcsize(offset_format)])[0]
+            value_offset = 4 + struct.calcsize(offset_format)
+            # values that do not fit in the entry are stored elsewhere
+            if count * struct.calcsize(_TIFF_TYPES[field_type]) > entry_size - value_offset:
+                position = struct.unpack(byte_order + offset_format, entry[value_offset:])[0]
+            else:
+                position = ifd_offset + count_size + i * entry_size + value_offset
+            entries[tag] = _TiffEntry(field_type, count, position)
+
+        def values(tag, default=None):
+            if tag not in entries:
+                if default is None:
+                    raise ValueError("Not a tiled TIFF file: {p} has no tag {t}".format(p=path, t=tag))
+                return default
+            entry = entries[tag]
+            f.seek(entry.position)
+            value_format = byte_order + _TIFF_TYPES[entry.type] * entry.count
+            return list(struct.unpack(value_format, f.read(struct.calcsize(value_format))))
+
+        encoding = (values(_COMPRESSION, [1])[0], values(_PREDICTOR, [1])[0], values(_PLANAR_CONFIGURATION, [1])[0],
+                    tuple(values(_BITS_PER_SAMPLE, [1])), tuple(values(_SAMPLE_FORMAT, [1])),
+                    values(_SAMPLES_PER_PIXEL, [1])[0])
+        return TiffLayout(
+            byte_order=byte_order, big_tiff=big_tiff, width=values(_IMAGE_WIDTH)[0], height=values(_IMAGE_LENGTH)[0],
+            tile_width=values(_TILE_WIDTH)[0], tile_height=values(_TILE_LENGTH)[0], encoding=encoding,
+            tile_offsets=values(_TILE_OFFSETS), tile_byte_counts=values(_TILE_BYTE_COUNTS),
+            offsets_entry=entries[_TILE_OFFSETS], byte_counts_entry=entries[_TILE_BYTE_COUNTS]
+        )
+
+
+_MosaicSource = namedtuple('_MosaicSource', ['path', 'col_off', 'row_off', 'width', 'height'])
+
+
+def _mosaic(sources: List[str]):
+    """The grid, CRS, dtypes, nodata value and the windows of the sources of a mosaic of GeoTIFFs."""
+    import rasterio
+
+    infos = []
+    for path in sources:
+        with rasterio.open(path) as src:
+            infos.append((path, src.bounds, src.res, src.width, src.height, src.crs, src.dtypes, src.nodata))
+
+    _, _, (cell_width, cell_height), _, _, crs, dtypes, nodata = infos[0]
+    left, top = min(info[1].left for info in infos), max(info[1].top for info in infos)
+    right, bottom = max(info[1].right for info in infos), min(info[1].bottom for info in infos)
+    grid = RasterGrid(left=left, top=top, cell_width=cell_width, cell_height=cell_height,
+                      width=int(round((right - left) / cell_width)), height=int(round((top - bottom) / cell_height)))
+
+    windows = [_MosaicSource(path, int(round((bounds.left - left) / cell_width)),
+                             int(round((top - bounds.top) / cell_height)), width, height)
+               for path, bounds, _, width, height, _, _, _ in infos]
+    return grid, crs, dtypes, nodata, windows
+
+
+def mosaic_vrt(sources: List[str]) -> str:
+    """VRT (XML) of the mosaic of GeoTIFFs with the same resolution, CRS and bands."""
+    grid, crs, dtypes, nodata, windows = _mosaic(sources)
+
+    def band_sources(band):
+        return "".join(
+            "<SimpleSource>{f}<SourceBand>{b}</SourceBand><SrcRect xOff=\"0\" yOff=\"0\" xSize=\"{w}\" ySize=\"{h}\"/>"
+            "<DstRect xOff=\"{x}\" yOff=\"{y}\" xSize=\"{w}\" ySize=\"{h}\"/></SimpleSource>"
+            .format(f=_source_filename(s.path), b=band, x=s.col_off, y=s.row_off, w=s.width, h=s.height)
+            for s in windows)
+
+    return _vrt(grid.width, grid.height, crs, grid.transform, dtypes, nodata, band_sources)
+
+
+def merge(sources: List[str], path: str, max_workers: int = None) -> None:
+    """
+    Merges GeoTIFFs with the same resolution, CRS and bands (like the GeoTIFFs of the tiles of a layer) into one
+    tiled GeoTIFF, through a VRT of their mosaic.
+
+    If the sources are tiled GeoTIFFs that are aligned to their blocks and are encoded the same way, their compressed
+    blocks are copied as is, in parallel, without decompressing them. Otherwise, GDAL decodes and encodes the mosaic
+    (with multiple threads).
+    """
+    import rasterio
+    import rasterio.shutil
+
+    if not sources:
+        raise ValueError("No GeoTIFFs to merge into " + path)
+
+    vrt = path + '.vrt'
+    with open(vrt, 'w') as f:
+        f.write(mosaic_vrt(sources))
+
+    try:
+        if not _copy_blocks(sources, vrt, path, max_workers):
+            with rasterio.open(sources[0]) as first:
+                dtypes = first.dtypes
+            rasterio.shutil.copy(vrt, path, driver='GTiff', tiled=True, compress='deflate', bigtiff='if_safer',
+                                 num_threads='all_cpus', **signed_byte_options(dtypes))
+    finally:
+        os.remove(vrt)
+
+
+# GDAL COMPRESS creation options of TIFF compression codes
+_GDAL_COMPRESSION = {1: 'none', 5: 'lzw', 8: 'deflate', 32946: 'deflate', 32773: 'packbits', 34925: 'lzma',
+                     50000: 'zstd'}
+
+
+def _copy_blocks(sources: List[str], vrt: str, path: str, max_workers: int = None) -> bool:
+    """
+    Creates an empty (sparse) tiled GeoTIFF of the mosaic with the same encoding as the sources, appends the
+    compressed blocks of the sources to it and points its tile offsets to them.
+    Returns False (and writes nothing) if that is not possible.
+    """
+    import rasterio
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            layouts = list(executor.map(read_tiff_layout, sources))
+        except ValueError:
+            return False
+
+        first = layouts[0]
+        (compression, predictor, planar_configuration, _, _, _) = first.encoding
+        block_shape = (first.tile_width, first.tile_height)
+        if compression not in _GDAL_COMPRESSION or first.tile_width % 16 or first.tile_height % 16 or \
+                any(layout.encoding != first.encoding or (layout.tile_width, layout.tile_height) != block_shape
+                    for layout in layouts):
+            return False
+
+        with rasterio.open(vrt) as mosaic:
+            profile = mosaic.profile
+        _, _, _, _, windows = _mosaic(sources)
+        if any(s.col_off % first.tile_width or s.row_off % first.tile_height or
+               (s.width % first.tile_width and s.col_off + s.width != profile['width']) or
+               (s.height % first.tile_height and s.row_off + s.height != profile['height'])
+               for s in windows):
+            return False
+
+        profile.update(driver='GTiff', tiled=True, blockxsize=first.tile_width, blockysize=first.tile_height,
+                       compress=_GDAL_COMPRESSION[compression], predictor=predictor, sparse_ok=True,
+                       interleave='pixel' if planar_configuration == 1 else 'band', bigtiff='if_safer')
+        with rasterio.open(path, 'w', **profile):
+            pass
+
+        target = read_tiff_layout(path)
+        if target.encoding != first.encoding or (target.tile_width, target.tile_height) != block_shape:
+            os.remove(path)
+            return False
+
+        # lay out the blocks of the sources one after the other at the end of the file
+        offsets, byte_counts = list(target.tile_offsets), list(target.tile_byte_counts)
+        copies = []
+        end = os.path.getsize(path)
+        for source, layout in zip(windows, layouts):
+            col_start, row_start = source.col_off // first.tile_width, source.row_off // first.tile_height
+            for i, (offset, byte_count) in enumerate(zip(layout.tile_offsets, layout.tile_byte_counts)):
+                if byte_count == 0:
+                    continue
+                plane, block = divmod(i, layout.tiles_per_plane)
+                row, col = divmod(block, layout.tiles_across)
+                target_index = plane * target.tiles_per_plane + (row_start + row) * target.tiles_across \
+                    + col_start + col
+                offsets[target_index], byte_counts[target_index] = end, byte_count
+                copies.append((source.path, offset, byte_count, end))
+                end += byte_count
+
+        if not target.big_tiff and end >= 2 ** 32:
+            os.remove(path)
+            return False
+
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            def copy(source_path, blocks):
+                with open(source_path, 'rb') as src:
+                    for _, offset, byte_count, target_offset in blocks:
+                        os.pwrite(fd, os.pread(src.fileno(), byte_count, offset), target_offset)
+
+            blocks_by_source = {}
+            for block in copies:
+                blocks_by_source.setdefault(block[0], []).append(block)
+            for result in [executor.submit(copy, source_path, blocks)
+                           for source_path, blocks in blocks_by_source.items()]:
+                result.result()
+
+            _write_values(fd, target.byte_order, target.offsets_entry, offsets)
+            _write_values(fd, target.byte_order, target.byte_counts_entry, byte_counts)
+        finally:
+            os.close(fd)
+
+    return True
+
+
+def _write_values(fd: int, byte_order: str, entry: _TiffEntry, values: List[int]) -> None:
+    os.pwrite(fd, struct.pack(byte_order + _TIFF_TYPES[entry.type] * entry.count, *values), entry.position)
+
+
+def block_dtype(dtype: np.dtype) -> np.dtype:
+    """The dtype of the blocks of a GeoTIFF for cells of the given dtype (GeoTIFF has no bit or signed byte cells)."""
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    if dtype == np.int8:
+        return np.dtype(np.int16)
+    return dtype
+
+
+def encode_block(cells: np.ndarray, compression_level: int = 6) -> bytes:
+    """
+    Encodes the cells (bands, rows, cols) of a tile as a block of a tiled GeoTIFF written by `write_blocks`:
+    pixel interleaved, little endian and deflate compressed.
+    """
+    dtype = block_dtype(cells.dtype).newbyteorder('<')
+    return zlib.compress(np.ascontiguousarray(np.moveaxis(cells, 0, -1), dtype=dtype).tobytes(), compression_level)
+
+
+def write_blocks(blocks: Iterable[Tuple[int, int, bytes]], path: str, grid: RasterGrid, crs: str, dtype: np.dtype,
+                 count: int, block_shape: Tuple[int, int], nodata=None, compression_level: int = 6) -> None:
+    """
+    Writes a tiled GeoTIFF from the (block col, block row, bytes) of blocks that were encoded (in parallel) with
+    `encode_block`: GDAL writes the header and an empty block offset table, the blocks are appended
+    in the order they come, and the offset table is pointed to them. Missing blocks are no data.
+    """
+    import rasterio
+
+    block_cols, block_rows = block_shape
+    if block_cols % 16 or block_rows % 16:
+        raise ValueError("GeoTIFF block sizes must be multiples of 16, but got: {b}".format(b=block_shape))
+
+    with rasterio.open(path, 'w', driver='GTiff', count=count, width=grid.width, height=grid.height,
+                       transform=grid.transform, crs=rasterio.crs.CRS.from_proj4(crs), nodata=nodata,
+                       dtype=block_dtype(dtype), tiled=True, blockxsize=block_cols, blockysize=block_rows,
+                       compress='deflate', zlevel=compression_level, predictor=1, interleave='pixel', sparse_ok=True,
+                       bigtiff='if_safer'):
+        pass
+
+    layout = read_tiff_layout(path)
+    if layout.byte_order != '<' or layout.planes != 1:
+        raise ValueError("Unexpected block layout of " + path)
+
+    offsets, byte_counts = list(layout.tile_offsets), list(layout.tile_byte_counts)
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        for block_col, block_row, data in blocks:
+            if not layout.big_tiff and end + len(data) >= 2 ** 32:
+                raise ValueError("Blocks do not fit in " + path)
+            index = block_row * layout.tiles_across + block_col
+            f.write(data)
+            offsets[index], byte_counts[index] = end, len(data)
+            end += len(data)
+
+        f.flush()
+        _write_values(f.fileno(), layout.byte_order, layout.offsets_entry, offsets)
+        _write_values(f.fileno(), layout.byte_order, layout.byte_counts_entry, byte_counts)
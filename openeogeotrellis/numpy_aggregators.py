@@ -1,41 +1,269 @@
+import abc
+import warnings
+
 import geopyspark as gps
-from typing import Iterable
+from typing import Iterable, Callable
 import numpy as np
 
 
-def max_composite(tiles: Iterable[gps.Tile]):
-    return composite(np.fmax, tiles)  # ignores NaNs (<=> maximum)
+def max_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
+    return composite(lambda stack: np.fmax.reduce(stack, axis=0), tiles, keep_cell_type=True)  # ignores NaN
+
 
+def min_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
+    return composite(lambda stack: np.fmin.reduce(stack, axis=0), tiles, keep_cell_type=True)  # ignores NaN
 
-def min_composite(tiles: Iterable[gps.Tile]):
-    return composite(np.fmin, tiles)  # ignores NaN (<=> minimum)
 
+def sum_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
+    return composite(lambda stack: np.nansum(stack, axis=0), tiles)
 
-def sum_composite(tiles: Iterable[gps.Tile]):
-    def fadd(a_cells, b_cells):
-        return np.add(np.nan_to_num(a_cells), np.nan_to_num(b_cells))
 
-    return composite(fadd, tiles)  # ignores NaN (<=> add)
+def mean_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
+    return composite(lambda stack: np.nanmean(stack, axis=0), tiles)
 
 
 def var_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
-    cube = np.array([tile.cells for tile in tiles])
-    reduced = np.nanvar(cube, axis=0)  # ignores NaN (<=> var)
-    first_tile = next(iter(tiles))
-    return gps.Tile(cells=reduced, cell_type=first_tile.cell_type, no_data_value=first_tile.no_data_value)
+    return composite(lambda stack: np.nanvar(stack, axis=0), tiles)
 
 
 def std_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
-    cube = np.array([tile.cells for tile in tiles])
-    reduced = np.nanstd(cube, axis=0)  # ignores NaN (<=> std)
-    first_tile = next(iter(tiles))
-    return gps.Tile(cells=reduced, cell_type=first_tile.cell_type, no_data_value=first_tile.no_data_value)
-
-
-def composite(func, tiles: Iterable[gps.Tile]):
-    from functools import reduce
-    cells = [tile.cells for tile in tiles]
-    first_tile = next(iter(tiles))
-    reduced = reduce(func, cells)
-    print(reduced)
-    return gps.Tile(cells=reduced, cell_type=first_tile.cell_type, no_data_value=first_tile.no_data_value)
+    return composite(lambda stack: np.nanstd(stack, axis=0), tiles)
+
+
+def median_composite(tiles: Iterable[gps.Tile]) -> gps.Tile:
+    # the stack is ours, so it can be partially sorted in place
+    return composite(lambda stack: np.nanmedian(stack, axis=0, overwrite_input=True), tiles)
+
+
+def percentile_composite(percentile: float) -> Callable[[Iterable[gps.Tile]], gps.Tile]:
+    if not 0 <= percentile <= 100:
+        raise ValueError("Percentile should be between 0 and 100, but got: {p!r}".format(p=percentile))
+
+    def reducer(tiles: Iterable[gps.Tile]) -> gps.Tile:
+        return composite(lambda stack: np.nanpercentile(stack, percentile, axis=0, overwrite_input=True), tiles)
+
+    return reducer
+
+
+def composite(func: Callable[[np.ndarray], np.ndarray], tiles: Iterable[gps.Tile], keep_cell_type=False) -> gps.Tile:
+    """
+    Reduce tiles cell-wise along a new first axis.
+
+    :param func: NaN-ignoring reduction of a (time, bands, rows, cols) stack over axis 0
+    :param tiles: tiles to reduce, only iterated once
+    :param keep_cell_type: output the cell type of the input (e.g. for min and max) instead of float32
+    """
+    tiles = list(tiles)  # references only, the cells are copied once: into the stack
+    first_tile = tiles[0]
+
+    stack = np.empty((len(tiles),) + first_tile.cells.shape, dtype=np.float64)
+    for i, tile in enumerate(tiles):
+        _masked(tile.cells, tile.no_data_value, out=stack[i])
+
+    # all-NaN pixels are expected: they just become no data (NaN) in the result
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        reduced = func(stack)
+
+    if keep_cell_type:
+        return _typed_tile(reduced, first_tile.cells.dtype, first_tile.cell_type, first_tile.no_data_value)
+    return _float_tile(reduced, first_tile.no_data_value)
+
+
+def _masked(cells: np.ndarray, no_data_value, out: np.ndarray = None) -> np.ndarray:
+    """Float64 copy of the cells with NaN for the no data cells."""
+    if out is None:
+        out = np.empty(cells.shape, dtype=np.float64)
+    out[...] = cells
+    if no_data_value is not None and not np.isnan(no_data_value):
+        out[cells == no_data_value] = np.nan
+    return out
+
+
+def _float_tile(cells: np.ndarray, no_data_value) -> gps.Tile:
+    return _typed_tile(cells, np.float32, 'FLOAT', no_data_value)
+
+
+def _typed_tile(cells: np.ndarray, dtype, cell_type: str, no_data_value) -> gps.Tile:
+    return gps.Tile(cells=_unmasked(cells, dtype, no_data_value), cell_type=cell_type, no_data_value=no_data_value)
+
+
+def _unmasked(cells: np.ndarray, dtype, no_data_value) -> np.ndarray:
+    """Inverse of `_masked`: cast to the given dtype, with the no data value for NaN cells."""
+    no_data = np.isnan(cells)
+    if np.dtype(dtype).kind == 'f':
+        result = cells.astype(dtype)
+    else:
+        result = np.where(no_data, 0, cells).astype(dtype)
+    if no_data_value is not None and not np.isnan(no_data_value):
+        result[no_data] = no_data_value
+    return result
+
+
+class TemporalCombiner(metaclass=abc.ABCMeta):
+    """
+    Mergeable, per-cell partial aggregation of tiles, to be used with `combineByKey`.
+
+    Instead of shuffling the complete time stack of a key, only one partial state per key and partition is shuffled.
+    No data cells are ignored, like in the composite functions above.
+    """
+
+    @abc.abstractmethod
+    def create(self, tile: gps.Tile):
+        pass
+
+    @abc.abstractmethod
+    def merge_value(self, state, tile: gps.Tile):
+        pass
+
+    @abc.abstractmethod
+    def merge_combiners(self, state, other):
+        pass
+
+    @abc.abstractmethod
+    def finish(self, state) -> gps.Tile:
+        pass
+
+    def combine_by_key(self, numpy_rdd):
+        """Reduce an RDD of (key, Tile) to a single Tile per key."""
+        return numpy_rdd.combineByKey(self.create, self.merge_value, self.merge_combiners).mapValues(self.finish)
+
+
+class _CompositeCombiner(TemporalCombiner):
+    """
+    State: ((dtype, cell type, no data value) of the first tile, cells), merged cell-wise with a NaN-ignoring ufunc.
+
+    :param keep_cell_type: output the cell type of the input (e.g. for min and max) instead of float32,
+        like `composite`
+    """
+
+    def __init__(self, ufunc, keep_cell_type=False):
+        self._ufunc = ufunc
+        self._keep_cell_type = keep_cell_type
+
+    @staticmethod
+    def _tile_type(tile: gps.Tile) -> tuple:
+        return tile.cells.dtype, tile.cell_type, tile.no_data_value
+
+    def create(self, tile):
+        return self._tile_type(tile), _masked(tile.cells, tile.no_data_value)
+
+    def merge_value(self, state, tile):
+        cells = state[1]
+        self._ufunc(cells, _masked(tile.cells, tile.no_data_value), out=cells)
+        return state
+
+    def merge_combiners(self, state, other):
+        cells = state[1]
+        self._ufunc(cells, other[1], out=cells)
+        return state
+
+    def finish(self, state):
+        (dtype, cell_type, no_data_value), cells = state
+        if self._keep_cell_type:
+            return _typed_tile(cells, dtype, cell_type, no_data_value)
+        return _float_tile(cells, no_data_value)
+
+
+class MinCombiner(_CompositeCombiner):
+    def __init__(self):
+        super().__init__(np.fmin, keep_cell_type=True)
+
+
+class MaxCombiner(_CompositeCombiner):
+    def __init__(self):
+        super().__init__(np.fmax, keep_cell_type=True)
+
+
+class SumCombiner(_CompositeCombiner):
+    def __init__(self):
+        super().__init__(np.add)
+
+    def create(self, tile):
+        return self._tile_type(tile), np.nan_to_num(_masked(tile.cells, tile.no_data_value), copy=False)
+
+    def merge_value(self, state, tile):
+        cells = state[1]
+        cells += np.nan_to_num(_masked(tile.cells, tile.no_data_value), copy=False)
+        return state
+
+
+class MeanCombiner(TemporalCombiner):
+    """State: (no_data_value, count, sum)"""
+
+    def create(self, tile):
+        values = _masked(tile.cells, tile.no_data_value)
+        valid = ~np.isnan(values)
+        return tile.no_data_value, valid.astype(np.float64), np.where(valid, values, 0.0)
+
+    def merge_value(self, state, tile):
+        _, count, total = state
+        values = _masked(tile.cells, tile.no_data_value)
+        valid = ~np.isnan(values)
+        count += valid
+        total += np.where(valid, values, 0.0)
+        return state
+
+    def merge_combiners(self, state, other):
+        _, count, total = state
+        count += other[1]
+        total += other[2]
+        return state
+
+    def finish(self, state):
+        no_data_value, count, total = state
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+        return _float_tile(mean, no_data_value)
+
+
+class VarianceCombiner(TemporalCombiner):
+    """
+    Population variance (like `np.nanvar`), with Welford's online update for single tiles
+    and the parallel formula of Chan et al. to merge partial states.
+
+    State: (no_data_value, count, mean, M2)
+    """
+
+    def create(self, tile):
+        values = _masked(tile.cells, tile.no_data_value)
+        valid = ~np.isnan(values)
+        count = valid.astype(np.float64)
+        return tile.no_data_value, count, np.where(valid, values, 0.0), np.zeros_like(count)
+
+    def merge_value(self, state, tile):
+        _, count, mean, m2 = state
+        values = _masked(tile.cells, tile.no_data_value)
+        valid = ~np.isnan(values)
+        values = np.where(valid, values, 0.0)
+        count += valid
+        delta = np.where(valid, values - mean, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean += np.where(valid, delta / count, 0.0)
+        m2 += delta * np.where(valid, values - mean, 0.0)
+        return state
+
+    def merge_combiners(self, state, other):
+        _, count, mean, m2 = state
+        _, other_count, other_mean, other_m2 = other
+        total = count + other_count
+        delta = other_mean - mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean += np.where(total > 0, delta * other_count / total, 0.0)
+            m2 += other_m2 + np.where(total > 0, delta ** 2 * count * other_count / total, 0.0)
+        count += other_count
+        return state
+
+    def _variance(self, state) -> np.ndarray:
+        _, count, _, m2 = state
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, m2 / count, np.nan)
+
+    def finish(self, state):
+        return _float_tile(self._variance(state), no_data_value=state[0])
+
+
+class StandardDeviationCombiner(VarianceCombiner):
+
+    def finish(self, state):
+        return _float_tile(np.sqrt(self._variance(state)), no_data_value=state[0])
@@ -0,0 +1,407 @@
+from collections import namedtuple
+from collections.abc import Mapping
+from typing import Callable, Iterable, List, Tuple, Union
+
+import numpy as np
+from geopyspark import Pyramid, TiledRasterLayer, Tile
+from geopyspark.geotrellis.constants import CellType
+from geopyspark.geotrellis.layer import CachableLayer
+
+LevelFunction = Callable[[TiledRasterLayer, int], TiledRasterLayer]
+# A per-pixel function in the style of `TiledRasterLayer.map_cells`: (cells, no_data_value) -> cells
+CellFunction = Callable[[np.ndarray, Union[int, float, None]], np.ndarray]
+_CellStep = Callable[[np.ndarray, Union[int, float, None]], Tuple[np.ndarray, Union[int, float, None]]]
+
+# GeoTrellis constant no data values of the non-raw integer cell types
+_CONSTANT_NO_DATA = {'int8': -128, 'uint8': 0, 'int16': -32768, 'uint16': 0, 'int32': -2147483648}
+_FLOAT_CELL_TYPES = ['float32', 'float64']
+# size (rows and columns) of the probe tile used to infer result cell types
+_PROBE_SIZE = 16
+
+
+class _LazyLevels(Mapping):
+    """
+    Read-only mapping of zoom level to TiledRasterLayer that only builds a level on first access.
+    """
+
+    def __init__(self, zoom_levels: Iterable[int], materialize: Callable[[int], TiledRasterLayer]):
+        self._zoom_levels = sorted(zoom_levels)
+        self._materialize = materialize
+        self._materialized = {}
+
+    def __getitem__(self, zoom: int) -> TiledRasterLayer:
+        if zoom not in self._materialized:
+            if zoom not in self._zoom_levels:
+                raise KeyError(zoom)
+            self._materialized[zoom] = self._materialize(zoom)
+        return self._materialized[zoom]
+
+    def __contains__(self, zoom) -> bool:
+        # Don't go through __getitem__ like the default implementation: a membership test should not materialize.
+        return zoom in self._zoom_levels
+
+    def __iter__(self):
+        return iter(self._zoom_levels)
+
+    def __len__(self) -> int:
+        return len(self._zoom_levels)
+
+    def is_materialized(self, zoom: int) -> bool:
+        return zoom in self._materialized
+
+
+class LazyPyramid(Pyramid):
+    """
+    Pyramid that records a function to apply to each level of a parent pyramid,
+    but only evaluates it for a level when that level is actually accessed.
+
+    Chaining LazyPyramids builds up a per-level function chain: accessing e.g. `pyramid.levels[pyramid.max_zoom]`
+    only creates the TiledRasterLayers of the max zoom level along that chain, lower levels are left untouched.
+    """
+
+    def __init__(self, parent: Pyramid, func: LevelFunction):
+        # Note: we deliberately don't call `Pyramid.__init__` as it eagerly accesses the max zoom level.
+        CachableLayer.__init__(self)
+        self.histogram = None
+        self._parent = parent
+        self._func = func
+        self._levels = _LazyLevels(parent.levels.keys(), self._materialize)
+
+    def _materialize(self, zoom: int) -> TiledRasterLayer:
+        return self._func(self._parent.levels[zoom], zoom)
+
+    @property
+    def levels(self) -> _LazyLevels:
+        return self._levels
+
+    @property
+    def max_zoom(self) -> int:
+        return max(self._levels)
+
+    @property
+    def pysc(self):
+        return self._parent.pysc
+
+    @property
+    def layer_type(self):
+        # The level function can change the layer type (e.g. `to_spatial_layer`), so we have to look at a real level.
+        return self._levels[self.max_zoom].layer_type
+
+    def apply(self, func: LevelFunction) -> 'LazyPyramid':
+        """Lazily apply a function (taking a layer and its zoom level) to each level of this pyramid."""
+        return LazyPyramid(self, func)
+
+    @property
+    def pending_cell_functions(self) -> Union['CellFunctionChain', None]:
+        """The chain of fusable cell functions this pyramid ends with, if any."""
+        return self._func if isinstance(self._func, CellFunctionChain) else None
+
+    def __str__(self):
+        return "LazyPyramid(max_zoom={}, num_levels={}, is_cached={})".format(
+            self.max_zoom, len(self.levels), self.is_cached)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CellFunctionChain:
+    """
+    Consecutive cell-local operations that are evaluated in a single Python pass over the tiles of a layer
+    (one `to_numpy_rdd`/`from_numpy_rdd` round trip), instead of one RDD map stage per operation.
+
+    Cell type conversions are part of the chain, so they don't need a separate `convert_data_type` pass either.
+    """
+
+    def __init__(self, steps: List[_CellStep] = None, cell_type: str = None):
+        self._steps = list(steps or [])
+        # GeoTrellis cell type (as in the layer metadata) of the result, or None to keep the cell type of the input
+        self._cell_type = cell_type
+
+    @property
+    def cell_type(self) -> Union[str, None]:
+        return self._cell_type
+
+    def then(self, function: CellFunction) -> 'CellFunctionChain':
+        def step(cells, no_data_value):
+            return function(cells, no_data_value), no_data_value
+
+        return CellFunctionChain(self._steps + [step], self._cell_type)
+
+    def then_step(self, step: _CellStep, cell_type: str) -> 'CellFunctionChain':
+        """Append a step that produces cells of the given cell type."""
+        return CellFunctionChain(self._steps + [step], cell_type)
+
+    def convert_data_type(self, cell_type: Union[str, CellType], no_data_value=None) -> 'CellFunctionChain':
+        cell_type = CellType(cell_type).value
+        if no_data_value is not None:
+            cell_type = CellType.create_user_defined_celltype(cell_type, no_data_value)
+        return CellFunctionChain(self._steps + [_cast_step(cell_type)], cell_type)
+
+    def __call__(self, layer: TiledRasterLayer, zoom: int) -> TiledRasterLayer:
+        steps = self._steps
+        cell_type = self._cell_type
+
+        def tile_function(tile: Tile) -> Tile:
+            cells, no_data_value = tile.cells, tile.no_data_value
+            for step in steps:
+                cells, no_data_value = step(cells, no_data_value)
+            if cell_type is None:
+                return Tile(cells, tile.cell_type, no_data_value)
+            # make sure the tiles match the cell type of the layer metadata, whatever the user functions returned
+            cells, no_data_value = _cast_step(cell_type)(cells, no_data_value)
+            return Tile(cells, Tile.dtype_to_cell_type(cells.dtype), no_data_value)
+
+        metadata = layer.layer_metadata.to_dict()
+        if cell_type is not None:
+            metadata['cellType'] = cell_type
+
+        numpy_rdd = layer.to_numpy_rdd().mapValues(tile_function)
+        return TiledRasterLayer.from_numpy_rdd(layer.layer_type, numpy_rdd, metadata, layer.zoom_level)
+
+
+def _parse_cell_type(cell_type: str) -> Tuple[np.dtype, Union[int, float, None]]:
+    """Get numpy dtype and no data value of a GeoTrellis cell type like 'float32', 'uint8raw' or 'int16ud-1'."""
+    base, _, user_defined = cell_type.partition('ud')
+    if base.endswith('raw'):
+        base = base[:-len('raw')]
+        no_data_value = None
+    elif user_defined:
+        no_data_value = float(user_defined) if base.startswith('float') else int(float(user_defined))
+    elif base.startswith('float'):
+        no_data_value = np.nan
+    else:
+        no_data_value = _CONSTANT_NO_DATA.get(base)
+    return np.dtype('bool' if base == 'bool' else base), no_data_value
+
+
+def _same_no_data_value(a, b) -> bool:
+    if a is None or b is None:
+        return a is b
+    return a == b or (np.isnan(a) and np.isnan(b))
+
+
+def _is_no_data(cells: np.ndarray, no_data_value) -> np.ndarray:
+    no_data = np.isnan(cells) if cells.dtype.kind == 'f' else np.zeros(cells.shape, dtype=bool)
+    if no_data_value is not None and not np.isnan(no_data_value):
+        no_data |= cells == no_data_value
+    return no_data
+
+
+def _cast_step(cell_type: str) -> _CellStep:
+    dtype, target_no_data_value = _parse_cell_type(cell_type)
+
+    def step(cells: np.ndarray, no_data_value):
+        if cells.dtype == dtype and _same_no_data_value(no_data_value, target_no_data_value):
+            return cells, no_data_value
+        no_data = _is_no_data(cells, no_data_value)
+        with np.errstate(invalid='ignore'):
+            converted = cells.astype(dtype)
+        if target_no_data_value is not None and no_data.any():
+            converted[no_data] = target_no_data_value
+        return converted, target_no_data_value
+
+    return step
+
+
+def pending_cell_functions(pyramid: Pyramid) -> Union[CellFunctionChain, None]:
+    """Get the chain of cell functions that is still pending (not yet evaluated) on a pyramid, if any."""
+    return pyramid.pending_cell_functions if isinstance(pyramid, LazyPyramid) else None
+
+
+def map_cells(pyramid: Pyramid, function: CellFunction, cell_type: Union[str, CellType] = None) -> LazyPyramid:
+    """
+    Lazily apply a per-pixel function to each level of a pyramid, optionally after converting to a given cell type.
+    The function is fused with cell functions that are still pending on the pyramid.
+    """
+    chain = pending_cell_functions(pyramid)
+    if chain is None:
+        parent, chain = pyramid, CellFunctionChain()
+    else:
+        parent = pyramid._parent
+    if cell_type is not None:
+        chain = chain.convert_data_type(cell_type)
+    return LazyPyramid(parent, chain.then(function))
+
+
+def convert_data_type(pyramid: Pyramid, cell_type: Union[str, CellType], no_data_value=None) -> LazyPyramid:
+    """
+    Lazily convert each level of a pyramid to a given cell type.
+    If the pyramid ends with pending cell functions, the conversion is done in that same pass.
+    """
+    chain = pending_cell_functions(pyramid)
+    if chain is None:
+        return LazyPyramid(pyramid, lambda layer, zoom: layer.convert_data_type(cell_type, no_data_value))
+    return LazyPyramid(pyramid._parent, chain.convert_data_type(cell_type, no_data_value))
+
+
+def cell_type(pyramid: Pyramid) -> str:
+    """Get the GeoTrellis cell type of (the levels of) a pyramid, without evaluating pending cell functions."""
+    chain = pending_cell_functions(pyramid)
+    if chain is not None:
+        return chain.cell_type if chain.cell_type is not None else cell_type(pyramid._parent)
+    return pyramid.levels[pyramid.max_zoom].layer_metadata.cell_type
+
+
+def _probe_cells(dtype: np.dtype, no_data_value, shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Deterministic probe tile with the extremes of the dtype, small values and no data.
+    Every band gets the values in a different order, so band combinations vary as well.
+    """
+    if dtype.kind == 'f':
+        values = [-1e6, -1000.0, -2.5, -1.0, -0.5, 0.0, 0.1, 0.25, 1 / 3, 0.5, 1.0, 2.0, 3.0, 100.0, 1000.0, 1e6]
+    elif dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        values = [info.min, info.min + 1, -100, -2, -1, 0, 1, 2, 3, 7, 100, 255, info.max - 1, info.max]
+        values = [v for v in values if info.min <= v <= info.max]
+    else:
+        values = [0, 1]
+    if no_data_value is not None:
+        values.append(no_data_value)
+
+    random = np.random.RandomState(0)
+    num_cells = int(np.prod(shape[1:]))
+    bands = [random.permutation(np.resize(np.array(values, dtype=dtype), num_cells)) for _ in range(shape[0])]
+    return np.stack(bands).reshape(shape)
+
+
+def _result_cell_type(dtype: np.dtype, input_cell_type: str) -> Union[str, None]:
+    """Cell type for the result of a function on native cells, or None if it's not a GeoTrellis cell type."""
+    if dtype == _parse_cell_type(input_cell_type)[0]:
+        return input_cell_type
+    if dtype.name in _CONSTANT_NO_DATA or dtype.name in _FLOAT_CELL_TYPES:
+        return dtype.name
+    return None
+
+
+def _widest_float_needed(dtype: np.dtype) -> str:
+    """
+    Float cell type that holds every value of a dtype exactly: results are never stored in a narrower float type,
+    as a probe tile can't show that real data survives the narrowing.
+    """
+    if dtype.kind == 'f':
+        return 'float32' if dtype.itemsize <= 4 else 'float64'
+    if dtype.kind in 'iu' and dtype.itemsize >= 4:
+        return 'float64'
+    return 'float32'
+
+
+def _to_float64(cells: np.ndarray, no_data_value) -> np.ndarray:
+    return _cast_step('float64')(cells, no_data_value)[0]
+
+
+def _equal(a: np.ndarray, b: np.ndarray) -> bool:
+    return a.shape == b.shape and bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+
+
+CellTypeInference = namedtuple('CellTypeInference', ['native', 'cell_type', 'no_data_bands'])
+CellTypeInference.__doc__ = """
+How to run a cell function: on the native cells (or on the cells upcast to float64), the cell type of the result,
+and the bands of which no data propagates to the result when running on the native cells.
+"""
+
+
+def mask_no_data(result, cells: np.ndarray, no_data_value, cell_type: str,
+                 no_data_bands: List[int] = None) -> Tuple[np.ndarray, Union[int, float, None]]:
+    """
+    Cast the result of a cell function on native cells to the given cell type,
+    with no data wherever one of the given bands (first dimension) of the input cells is no data.
+    """
+    result = np.asarray(result)
+    dtype, target_no_data_value = _parse_cell_type(cell_type)
+    if result.dtype != dtype:
+        result = _cast_step(cell_type)(result, None)[0]
+    if no_data_bands is not None:
+        cells = cells[[b for b in no_data_bands if b < cells.shape[0]]]
+    no_data = _is_no_data(cells, no_data_value).any(axis=0)
+    if target_no_data_value is not None and result.shape[-2:] == no_data.shape and no_data.any():
+        if np.shares_memory(result, cells):
+            result = result.copy()
+        result[..., no_data] = target_no_data_value
+    return result, target_no_data_value
+
+
+def cell_step(function: CellFunction, inference: CellTypeInference) -> _CellStep:
+    """Step that applies a cell function as inferred by `infer_cell_type`."""
+    cast = _cast_step(inference.cell_type)
+
+    def native_step(cells, no_data_value):
+        return mask_no_data(function(cells, no_data_value), cells, no_data_value, inference.cell_type,
+                            inference.no_data_bands)
+
+    def float_step(cells, no_data_value):
+        result = np.asarray(function(_to_float64(cells, no_data_value), np.nan), dtype=np.float64)
+        return cast(result, np.nan)
+
+    return native_step if inference.native else float_step
+
+
+def _propagated_no_data_bands(reference: np.ndarray, probe: np.ndarray, no_data_value) -> List[int]:
+    """Bands of which every no data cell results in NaN in the (float64) reference result."""
+    nan = np.isnan(reference)
+    bands = []
+    for band, cells in enumerate(probe):
+        no_data = _is_no_data(cells, no_data_value)
+        if nan.shape[-2:] == no_data.shape and no_data.any() and np.all(nan[..., no_data]):
+            bands.append(band)
+    return bands
+
+
+def infer_cell_type(function: CellFunction, input_cell_type: str, num_bands: int = 1,
+                    allow_native: bool = True) -> CellTypeInference:
+    """
+    Infer the narrowest cell type for the result of a cell function, by running it on a small probe tile.
+
+    The function is first run on the probe tile upcast to float64, with no data as NaN: that is the reference.
+    If running it on the native cells gives exactly the same result (e.g. no integer overflow or truncation),
+    the function doesn't need the upcast. Otherwise the reference result is stored as float32 if that is lossless,
+    and as float64 if not. Float results are never narrower than the input: float64 (and 32 bit integer) input
+    gives float64 results.
+
+    :param allow_native: whether to try running the function on the native cells, or only infer the float type
+    """
+    dtype, no_data_value = _parse_cell_type(input_cell_type)
+    probe = _probe_cells(dtype, no_data_value, (max(num_bands, 1), _PROBE_SIZE, _PROBE_SIZE))
+
+    try:
+        with np.errstate(all='ignore'):
+            reference = np.asarray(function(_to_float64(probe, no_data_value), np.nan), dtype=np.float64)
+    except Exception:
+        # let the function fail on the real data, if it does
+        return CellTypeInference(False, 'float64', None)
+
+    with np.errstate(all='ignore'):
+        float_cell_type = 'float32' if _widest_float_needed(dtype) == 'float32' \
+            and _equal(reference, reference.astype(np.float32).astype(np.float64)) else 'float64'
+
+    if not allow_native:
+        return CellTypeInference(False, float_cell_type, None)
+
+    try:
+        with np.errstate(all='ignore'):
+            native = np.asarray(function(probe.copy(), no_data_value))
+        result_cell_type = _result_cell_type(native.dtype, input_cell_type)
+        if result_cell_type == 'float64':
+            result_cell_type = float_cell_type
+        if result_cell_type is not None:
+            no_data_bands = _propagated_no_data_bands(reference, probe, no_data_value)
+            native, native_no_data_value = mask_no_data(native, probe, no_data_value, result_cell_type, no_data_bands)
+            if _equal(reference, _to_float64(native, native_no_data_value)):
+                return CellTypeInference(True, result_cell_type, no_data_bands)
+    except Exception:
+        pass
+
+    return CellTypeInference(False, float_cell_type, None)
+
+
+def map_cells_inferred(pyramid: Pyramid, function: CellFunction, num_bands: int = 1) -> LazyPyramid:
+    """
+    Like `map_cells`, but only upcasts the cells to float64 if the function needs it,
+    and stores the result in the narrowest cell type, as inferred with `infer_cell_type`.
+    """
+    inference = infer_cell_type(function, cell_type(pyramid), num_bands)
+    chain = pending_cell_functions(pyramid)
+    if chain is None:
+        parent, chain = pyramid, CellFunctionChain()
+    else:
+        parent = pyramid._parent
+    return LazyPyramid(parent, chain.then_step(cell_step(function, inference), inference.cell_type))
@@ -0,0 +1,196 @@
+"""
+Disk backed cache of the results of synchronous requests (downloads and timeseries), keyed by a canonical hash of
+the process graph of the request, the collections it loads and the catalog metadata of those collections.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Union
+
+_log = logging.getLogger(__name__)
+
+_COLLECTION_PROCESSES = ['load_collection', 'get_collection']
+
+
+def canonical_hash(value) -> str:
+    """SHA-256 of the canonical JSON of a value: sorted keys, no whitespace."""
+    data = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def collection_ids(process_graph: Union[dict, list]) -> set:
+    """The ids of the collections loaded by a process graph, including its callbacks."""
+    ids = set()
+    if isinstance(process_graph, dict):
+        if process_graph.get('process_id') in _COLLECTION_PROCESSES:
+            arguments = process_graph.get('arguments', {})
+            ids.add(arguments.get('id', arguments.get('name')))
+        for value in process_graph.values():
+            ids.update(collection_ids(value))
+    elif isinstance(process_graph, list):
+        for value in process_graph:
+            ids.update(collection_ids(value))
+    return ids
+
+
+def process_graph_key(request: dict, collection_metadata: Callable[[str], dict], *extra) -> str:
+    """
+    Cache key of a request with a process graph: changes if the request changes, or the catalog metadata
+    (the "version") of one of its collections.
+    """
+    versions = {collection_id: canonical_hash(collection_metadata(collection_id))
+                for collection_id in sorted(collection_ids(request), key=str)}
+    return canonical_hash({'request': request, 'collections': versions, 'extra': list(extra)})
+
+
+class ResultCache:
+    """
+    Content addressed cache of result files in a directory, with a size budget: the least recently used entries
+    are evicted first.
+
+    Safe to use from multiple threads: entries are written to a temporary file and moved into place, and are opened
+    while holding the lock, so an entry that is evicted while it is being read stays readable.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # entries of a previous process, least recently used first
+        files = [e for e in os.scandir(directory) if e.is_file() and not e.name.startswith('.')]
+        self._sizes = OrderedDict(
+            (e.name, e.stat().st_size) for e in sorted(files, key=lambda e: e.stat().st_mtime))
+        self._total_bytes = sum(self._sizes.values())
+        with self._lock:
+            self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._sizes
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key)
+
+    def _open(self, key: str):
+        with self._lock:
+            if key not in self._sizes:
+                return None
+            try:
+                f = open(self._path(key), 'rb')
+            except FileNotFoundError:
+                # removed by someone else
+                self._total_bytes -= self._sizes.pop(key)
+                return None
+            self._sizes.move_to_end(key)
+            os.utime(self._path(key))
+            return f
+
+    def _store(self, key: str, write: Callable) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self._directory, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            size = os.path.getsize(tmp)
+            if size > self._max_bytes:
+                _log.info("Not caching result {k}: {s} bytes exceeds the cache size".format(k=key, s=size))
+                os.remove(tmp)
+                return
+            with self._lock:
+                os.replace(tmp, self._path(key))
+                self._total_bytes += size - self._sizes.pop(key, 0)
+                self._sizes[key] = size
+                self._evict()
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _evict(self) -> None:
+        while self._total_bytes > self._max_bytes and self._sizes:
+            key, size = self._sizes.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get_file(self, key: str, path: str) -> bool:
+        """Copies the cached result file to the given path; returns False if it is not cached."""
+        f = self._open(key)
+        if f is None:
+            return False
+        with f, open(path, 'wb') as target:
+            shutil.copyfileobj(f, target)
+        return True
+
+    def put_file(self, key: str, path: str) -> None:
+        with open(path, 'rb') as source:
+            self._store(key, lambda f: shutil.copyfileobj(source, f))
+
+    def get_json(self, key: str, object_pairs_hook=None):
+        f = self._open(key)
+        if f is None:
+            return None
+        with f:
+            return json.loads(f.read().decode('utf-8'), object_pairs_hook=object_pairs_hook)
+
+    def put_json(self, key: str, value) -> None:
+        # numpy scalars in the results are written as their Python values
+        data = json.dumps(value, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+        self._store(key, lambda f: f.write(data.encode('utf-8')))
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """The result cache of this process, or None if no cache directory is configured."""
+    global _result_cache
+    from openeogeotrellis.configparams import ConfigParams
+
+    config = ConfigParams()
+    if not config.result_cache_dir:
+        return None
+    with _result_cache_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(config.result_cache_dir, config.result_cache_size)
+        return _result_cache
+
+
+def request_key(*extra, transform: Callable[[dict], dict] = None) -> Optional[str]:
+    """
+    Cache key of a result of the process graph of the current (synchronous) request, or None if there is no such
+    request (e.g. in a batch job), or if any of its collections is unknown.
+
+    :param transform: applied to the request first, e.g. to leave out the parts that should not be part of the key
+    """
+    from flask import has_request_context, request
+
+    if not has_request_context() or request.method != 'POST':
+        return None
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or 'process_graph' not in body:
+        return None
+    if transform is not None:
+        body = transform(body)
+
+    from openeogeotrellis.layercatalog import get_layer_catalog
+    catalog = get_layer_catalog()
+    try:
+        return process_graph_key(body, lambda c: catalog.get_collection_metadata(c, strip_private=False), *extra)
+    except Exception:
+        _log.warning("Not caching result of request with unknown collection", exc_info=True)
+        return None
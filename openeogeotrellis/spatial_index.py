@@ -0,0 +1,175 @@
+"""
+Spatial index from polygons to the tiles (SpatialKeys) of a layout that they touch.
+"""
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+from shapely.geometry import box
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+
+
+class MaskCache:
+    """
+    LRU cache of rasterized polygon masks, packed as bitsets (one bit per pixel), with a size budget in bytes.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._masks = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._masks.get(key)
+            if entry is None:
+                return None
+            self._masks.move_to_end(key)
+        shape, bits = entry
+        return np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+    def put(self, key: Hashable, mask: np.ndarray) -> None:
+        bits = np.packbits(mask)
+        with self._lock:
+            if key in self._masks:
+                self._total_bytes -= self._masks.pop(key)[1].nbytes
+            self._masks[key] = (mask.shape, bits)
+            self._total_bytes += bits.nbytes
+            while self._total_bytes > self._max_bytes and self._masks:
+                self._total_bytes -= self._masks.popitem(last=False)[1][1].nbytes
+
+
+_mask_cache = None
+_mask_cache_lock = threading.Lock()
+
+
+def get_mask_cache() -> MaskCache:
+    """The mask cache of this (executor) process, shared by all indices and requests."""
+    global _mask_cache
+    from openeogeotrellis.configparams import ConfigParams
+
+    with _mask_cache_lock:
+        if _mask_cache is None:
+            _mask_cache = MaskCache(ConfigParams().mask_cache_size)
+        return _mask_cache
+
+
+class PolygonKeyIndex:
+    """
+    Maps the (col, row) of every SpatialKey of a layout definition to the polygons that intersect that tile,
+    so tiles are only tested against the polygons that touch them, and tiles without any polygon can be skipped.
+
+    The polygons should be in the CRS of the layout. The STRtree is only used to build the index (on the driver):
+    it is not pickled along with the index.
+
+    Masks are cached by (polygon, CRS, layout definition, key), so the same polygons are not rasterized again for
+    another request on a collection with the same layout.
+    """
+
+    def __init__(self, polygons: List[BaseGeometry], layout_definition, crs: str = None):
+        self._polygons = list(polygons)
+
+        extent = layout_definition.extent
+        tile_layout = layout_definition.tileLayout
+        self._xmin, self._ymax = extent.xmin, extent.ymax
+        self._tile_width = (extent.xmax - extent.xmin) / tile_layout.layoutCols
+        self._tile_height = (extent.ymax - extent.ymin) / tile_layout.layoutRows
+        self._layout_cols, self._layout_rows = tile_layout.layoutCols, tile_layout.layoutRows
+        self._tile_cols, self._tile_rows = tile_layout.tileCols, tile_layout.tileRows
+        self._layout_key = (crs, extent.xmin, extent.ymin, extent.xmax, extent.ymax, self._layout_cols,
+                            self._layout_rows, self._tile_cols, self._tile_rows)
+        self._polygon_hashes = [hashlib.sha1(p.wkb if not p.is_empty else b'').hexdigest() for p in self._polygons]
+
+        self._tree = STRtree(self._polygons)
+        self._index_by_id = {id(p): i for i, p in enumerate(self._polygons)}
+        self._polygons_by_key = self._build()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_tree']
+        del state['_index_by_id']
+        return state
+
+    def _build(self) -> Dict[Tuple[int, int], List[int]]:
+        candidate_keys = set()
+        for polygon in self._polygons:
+            if polygon.is_empty:
+                continue
+            min_col, min_row, max_col, max_row = self._key_range(*polygon.bounds)
+            candidate_keys.update((col, row) for col in range(min_col, max_col + 1)
+                                  for row in range(min_row, max_row + 1))
+
+        polygons_by_key = {}
+        for col, row in candidate_keys:
+            tile = box(*self.key_extent(col, row))
+            touching = sorted(i for i in self._query(tile) if self._polygons[i].intersects(tile))
+            if touching:
+                polygons_by_key[(col, row)] = touching
+        return polygons_by_key
+
+    def _query(self, geometry: BaseGeometry) -> List[int]:
+        # Shapely 2 returns the indices of the geometries, older versions the geometries themselves
+        return [int(g) if isinstance(g, (int, np.integer)) else self._index_by_id[id(g)]
+                for g in self._tree.query(geometry)]
+
+    def _key_range(self, xmin, ymin, xmax, ymax) -> Tuple[int, int, int, int]:
+        def clamp(value, upper):
+            return min(max(value, 0), upper - 1)
+
+        min_col = clamp(int(math.floor((xmin - self._xmin) / self._tile_width)), self._layout_cols)
+        max_col = clamp(int(math.floor((xmax - self._xmin) / self._tile_width)), self._layout_cols)
+        min_row = clamp(int(math.floor((self._ymax - ymax) / self._tile_height)), self._layout_rows)
+        max_row = clamp(int(math.floor((self._ymax - ymin) / self._tile_height)), self._layout_rows)
+        return min_col, min_row, max_col, max_row
+
+    @property
+    def polygons(self) -> List[BaseGeometry]:
+        return self._polygons
+
+    def keys(self) -> Set[Tuple[int, int]]:
+        """The (col, row) of the tiles that are touched by at least one polygon."""
+        return set(self._polygons_by_key.keys())
+
+    def __contains__(self, col_row: Tuple[int, int]) -> bool:
+        return col_row in self._polygons_by_key
+
+    def polygons_for(self, col: int, row: int) -> List[int]:
+        """Indices of the polygons that intersect the tile at (col, row)."""
+        return self._polygons_by_key.get((col, row), [])
+
+    def key_extent(self, col: int, row: int) -> Tuple[float, float, float, float]:
+        """(xmin, ymin, xmax, ymax) of the tile at (col, row)."""
+        xmin = self._xmin + col * self._tile_width
+        ymax = self._ymax - row * self._tile_height
+        return xmin, ymax - self._tile_height, xmin + self._tile_width, ymax
+
+    def mask(self, col: int, row: int, polygon_index: int) -> np.ndarray:
+        """Boolean (rows, cols) array that is True for the pixels of the tile at (col, row) inside the polygon."""
+        cache = get_mask_cache()
+        cache_key = (self._polygon_hashes[polygon_index], self._layout_key, col, row)
+        mask = cache.get(cache_key)
+        if mask is None:
+            mask = self._rasterize(col, row, polygon_index)
+            cache.put(cache_key, mask)
+        return mask
+
+    def _rasterize(self, col: int, row: int, polygon_index: int) -> np.ndarray:
+        from affine import Affine
+        from rasterio.features import geometry_mask
+
+        xmin, _, _, ymax = self.key_extent(col, row)
+        transform = Affine(self._tile_width / self._tile_cols, 0, xmin, 0, -self._tile_height / self._tile_rows, ymax)
+        return geometry_mask([self._polygons[polygon_index]], out_shape=(self._tile_rows, self._tile_cols),
+                             transform=transform, invert=True)
@@ -0,0 +1,216 @@
+"""
+Persistent store of timeseries results per (collection, statistic, polygon), so a request for a date range that
+only grew since the last one only has to compute the new dates.
+
+Every entry holds the values by date, and the time intervals that were computed: dates without a value in those
+intervals have no data, and are not computed again either. Only dates older than a settling time count as computed,
+because data of recent dates can still be ingested; entries expire after a time to live, and can be invalidated, to
+pick up reprocessed data.
+"""
+import abc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pytz
+from dateutil.parser import parse
+from shapely.geometry.base import BaseGeometry
+
+from openeogeotrellis import result_cache
+
+Interval = Tuple[datetime, datetime]
+
+# instants of GeoTrellis keys have a millisecond resolution
+_RESOLUTION = timedelta(milliseconds=1)
+
+
+def polygon_key(polygon: BaseGeometry) -> str:
+    return hashlib.sha1(polygon.wkb if not polygon.is_empty else b'').hexdigest()
+
+
+def _utc(instant: datetime) -> datetime:
+    return instant.replace(tzinfo=pytz.UTC) if instant.tzinfo is None else instant.astimezone(pytz.UTC)
+
+
+def missing_intervals(interval: Interval, covered: Iterable[Interval]) -> List[Interval]:
+    """The parts of an (inclusive) interval that are not covered by any of the (inclusive) covered intervals."""
+    missing = [(_utc(interval[0]), _utc(interval[1]))]
+    for covered_start, covered_end in covered:
+        covered_start, covered_end = _utc(covered_start), _utc(covered_end)
+        remaining = []
+        for start, end in missing:
+            if covered_end < start or end < covered_start:
+                remaining.append((start, end))
+                continue
+            if start < covered_start:
+                remaining.append((start, covered_start - _RESOLUTION))
+            if covered_end < end:
+                remaining.append((covered_end + _RESOLUTION, end))
+        missing = remaining
+    return missing
+
+
+def settled(interval: Interval, settling_time: timedelta, now: datetime = None) -> Optional[Interval]:
+    """The part of an interval that is older than the settling time (before now), None if there is none."""
+    start = _utc(interval[0])
+    end = min(_utc(interval[1]), _utc(now or datetime.now(pytz.UTC)) - settling_time)
+    return (start, end) if start <= end else None
+
+
+def merge_intervals(intervals: Iterable[Interval]) -> List[Interval]:
+    """Merges overlapping and adjacent intervals."""
+    merged = []
+    for start, end in sorted((_utc(s), _utc(e)) for s, e in intervals):
+        if merged and start <= merged[-1][1] + _RESOLUTION:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class TimeseriesEntry:
+    """
+    The values of a polygon by date (as returned by the request), the intervals they were computed for, and when
+    the entry was created.
+    """
+
+    def __init__(self, values: Dict[str, object] = None, covered: List[Interval] = None, created: datetime = None):
+        self.values = dict(values or {})
+        self.covered = merge_intervals(covered or [])
+        self.created = _utc(created or datetime.now(pytz.UTC))
+
+    def within(self, interval: Interval) -> Dict[str, object]:
+        start, end = _utc(interval[0]), _utc(interval[1])
+        return {date: value for date, value in self.values.items() if start <= _utc(parse(date)) <= end}
+
+    def updated(self, values: Dict[str, object], interval: Optional[Interval]) -> 'TimeseriesEntry':
+        """With the values of an interval added, and that interval covered (unless it is None)."""
+        covered = self.covered + ([interval] if interval is not None else [])
+        return TimeseriesEntry(dict(self.values, **values), covered, self.created)
+
+    def to_dict(self) -> dict:
+        return {'values': self.values, 'covered': [[s.isoformat(), e.isoformat()] for s, e in self.covered],
+                'created': self.created.isoformat()}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'TimeseriesEntry':
+        return cls(d['values'], [(parse(s), parse(e)) for s, e in d['covered']], parse(d['created']))
+
+
+class TimeseriesStore(metaclass=abc.ABCMeta):
+    """Base class of the timeseries stores, with the entries of a collection and statistic by polygon key."""
+
+    @abc.abstractmethod
+    def get(self, collection: str, statistic: str, polygon: str) -> Optional[TimeseriesEntry]:
+        pass
+
+    @abc.abstractmethod
+    def put(self, collection: str, statistic: str, polygon: str, entry: TimeseriesEntry) -> None:
+        pass
+
+    @abc.abstractmethod
+    def invalidate(self, collection: str = None) -> None:
+        """Removes the entries of a collection (e.g. after it was reprocessed), or all entries."""
+        pass
+
+    def get_many(self, collection: str, statistic: str, polygons: List[str]) -> Dict[str, TimeseriesEntry]:
+        entries = {polygon: self.get(collection, statistic, polygon) for polygon in polygons}
+        return {polygon: entry for polygon, entry in entries.items() if entry is not None}
+
+    def put_many(self, collection: str, statistic: str, entries: Dict[str, TimeseriesEntry]) -> None:
+        for polygon, entry in entries.items():
+            self.put(collection, statistic, polygon, entry)
+
+
+class FileTimeseriesStore(TimeseriesStore):
+    """
+    Stores every entry as a JSON file: {directory}/{collection}/{statistic}/{polygon}.json
+    Entries that were created longer than the time to live ago are ignored (and replaced), if there is one.
+    """
+
+    def __init__(self, directory: str, ttl: timedelta = None):
+        self._directory = directory
+        self._ttl = ttl
+
+    def _path(self, collection: str, statistic: str, polygon: str) -> str:
+        statistic = hashlib.sha1(statistic.encode('utf-8')).hexdigest()
+        return os.path.join(self._directory, collection, statistic, polygon + '.json')
+
+    def get(self, collection: str, statistic: str, polygon: str) -> Optional[TimeseriesEntry]:
+        try:
+            with open(self._path(collection, statistic, polygon), encoding='utf-8') as f:
+                entry = TimeseriesEntry.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        if self._ttl is not None and entry.created < datetime.now(pytz.UTC) - self._ttl:
+            return None
+        return entry
+
+    def put(self, collection: str, statistic: str, polygon: str, entry: TimeseriesEntry) -> None:
+        path = self._path(collection, statistic, polygon)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # concurrent requests for the same polygon each write a complete file, the last one wins
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry.to_dict(), f, default=lambda v: v.item() if hasattr(v, 'item') else str(v))
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def invalidate(self, collection: str = None) -> None:
+        shutil.rmtree(os.path.join(self._directory, collection) if collection is not None else self._directory,
+                      ignore_errors=True)
+
+
+_timeseries_store = None
+_timeseries_store_lock = threading.Lock()
+
+
+def get_timeseries_store() -> Optional[TimeseriesStore]:
+    """The timeseries store of this process, or None if no store directory is configured."""
+    global _timeseries_store
+    from openeogeotrellis.configparams import ConfigParams
+
+    config = ConfigParams()
+    if not config.timeseries_store_dir:
+        return None
+    with _timeseries_store_lock:
+        if _timeseries_store is None:
+            _timeseries_store = FileTimeseriesStore(config.timeseries_store_dir, config.timeseries_store_ttl)
+        return _timeseries_store
+
+
+# arguments that select dates or polygons rather than define the collection
+_DATE_ARGUMENTS = {'filter_temporal': ['extent'], 'filter_daterange': ['extent', 'from', 'to']}
+_POLYGON_PROCESSES = ['zonal_statistics', 'aggregate_polygon', 'aggregate_zonal']
+
+
+def _without_dates_and_polygons(value):
+    if isinstance(value, list):
+        return [_without_dates_and_polygons(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    value = {key: _without_dates_and_polygons(v) for key, v in value.items()}
+    process_id = value.get('process_id')
+    if process_id is not None and isinstance(value.get('arguments'), dict):
+        ignored = ['temporal_extent'] + _DATE_ARGUMENTS.get(process_id, [])
+        if process_id in _POLYGON_PROCESSES:
+            ignored += ['polygons', 'regions']
+        value['arguments'] = {key: v for key, v in value['arguments'].items() if key not in ignored}
+    return value
+
+
+def request_collection_key() -> Optional[str]:
+    """
+    Key of the collection of the process graph of the current request, regardless of its date range and polygons:
+    None if there is no such request.
+    """
+    return result_cache.request_key(transform=_without_dates_and_polygons)
@@ -0,0 +1,123 @@
+"""
+Helpers to run user defined functions (UDFs) on executors.
+"""
+import functools
+import inspect
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from geopyspark import Tile
+
+try:
+    from openeo_udf.api.base import UdfData, SpatialExtent
+except ImportError as e:
+    from openeo_udf.api.udf_data import UdfData
+    from openeo_udf.api.spatial_extent import SpatialExtent
+
+from openeo_udf.api.datacube import DataCube
+
+_UDF_MODULE = '__udf__'
+
+
+@functools.lru_cache(maxsize=16)
+def load_udf(code: str) -> dict:
+    """
+    Execute the UDF source code and return its namespace.
+    Cached, so the code is only compiled and executed once per (executor) process.
+    """
+    namespace = {
+        '__name__': _UDF_MODULE,
+        'numpy': np,
+        'np': np,
+        'xarray': xr,
+        'pandas': pd,
+        'DataCube': DataCube,
+        'UdfData': UdfData,
+        'SpatialExtent': SpatialExtent,
+    }
+    exec(compile(code, 'UDF.py', mode='exec'), namespace)
+    return namespace
+
+
+def _find_udf_function(namespace: dict):
+    """Find the entry point of a UDF: a data cube mapping function, or a function that takes a UdfData object."""
+    for name in ['apply_datacube', 'apply_hypercube']:
+        if callable(namespace.get(name)):
+            return name, namespace[name]
+
+    for name, func in namespace.items():
+        if not inspect.isfunction(func) or func.__module__ != _UDF_MODULE:
+            # skip imported functions
+            continue
+        params = list(inspect.signature(func).parameters.values())
+        if len(params) == 1 and params[0].annotation in [UdfData, 'UdfData', 'openeo_udf.api.udf_data.UdfData']:
+            return name, func
+
+    return None, None
+
+
+def run_udf_on_datacube(code: str, datacube: DataCube, context: dict = None) -> DataCube:
+    """Run the UDF on a single data cube and return the single resulting data cube."""
+    name, func = _find_udf_function(load_udf(code))
+
+    if name in ['apply_datacube', 'apply_hypercube']:
+        result = func(datacube, context or {})
+        if not isinstance(result, DataCube):
+            raise ValueError("The provided UDF did not return a DataCube, but got: " + str(result))
+        return result
+
+    data = UdfData({"EPSG": 900913}, [datacube])
+    if func is not None:
+        func(data)
+    else:
+        # unknown UDF signature: let the UDF framework figure it out
+        from openeo_udf.api.run_code import run_user_code
+        data = run_user_code(code, data)
+
+    cubes = data.get_datacube_list()
+    if len(cubes) != 1:
+        raise ValueError("The provided UDF should return one datacube, but got: " + str(cubes))
+    return cubes[0]
+
+
+class TileBatch:
+    """
+    Columnar batch of tiles with the same shape and cell type: a column of keys,
+    and the cells of all tiles in one contiguous buffer of their native dtype.
+
+    Tiles are only copied once, into the buffer; the tiles of a batch are views on it.
+    """
+
+    def __init__(self, keys: List, cells: np.ndarray, cell_type: str, no_data_value=None):
+        if len(keys) != cells.shape[0]:
+            raise ValueError("Expected {n} tiles in the cells buffer, but got: {s}".format(n=len(keys), s=cells.shape))
+        self.keys = keys
+        self.cells = cells
+        self.cell_type = cell_type
+        self.no_data_value = no_data_value
+
+    @classmethod
+    def from_tiles(cls, tiles: List[Tuple[object, Tile]]) -> 'TileBatch':
+        first = tiles[0][1]
+        cells = np.empty((len(tiles),) + first.cells.shape, dtype=first.cells.dtype)
+        for i, (_, tile) in enumerate(tiles):
+            cells[i] = tile.cells
+        return cls([key for key, _ in tiles], cells, first.cell_type, first.no_data_value)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def tiles(self) -> Iterator[Tuple[object, Tile]]:
+        for key, cells in zip(self.keys, self.cells):
+            yield key, Tile(cells, self.cell_type, self.no_data_value)
+
+    def to_float64(self) -> np.ndarray:
+        """Get the cells as float64, with no data cells set to NaN."""
+        if self.cells.dtype == np.float64:
+            return self.cells
+        cells = self.cells.astype(np.float64)
+        if self.no_data_value is not None and not np.isnan(self.no_data_value):
+            cells[self.cells == self.no_data_value] = np.nan
+        return cells
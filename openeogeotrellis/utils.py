@@ -1,10 +1,16 @@
 import collections
+import functools
 import logging
 import os
+from typing import List, Tuple, Union
+
+import numpy as np
+import pyproj
 import pytz
 from dateutil.parser import parse
 
 from py4j.java_gateway import JavaGateway
+from shapely.geometry import MultiPolygon, Polygon
 
 logger = logging.getLogger("openeo")
 
@@ -80,3 +86,62 @@ def normalize_date(date_string):
             date = date.replace(tzinfo=pytz.UTC)
         return date.isoformat()
     return None
+
+
+@functools.lru_cache(maxsize=64)
+def get_transformer(src_crs: str, dst_crs: str) -> pyproj.Transformer:
+    """
+    Transformer between two CRSs (EPSG codes or proj4 strings), with coordinates in x/y (lon/lat) order.
+    Creating one is expensive, so they are cached for the whole process, least recently used ones are dropped first.
+    """
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def reproject_bounds(bounds: Tuple[float, float, float, float], src_crs: str, dst_crs: str) -> Tuple[float, ...]:
+    """Reprojects the lower left and upper right corner of (xmin, ymin, xmax, ymax) bounds."""
+    xmin, ymin, xmax, ymax = bounds
+    xs, ys = get_transformer(src_crs, dst_crs).transform(np.array([xmin, xmax]), np.array([ymin, ymax]))
+    return float(xs[0]), float(ys[0]), float(xs[1]), float(ys[1])
+
+
+def reproject_polygons(polygons: List[Union[Polygon, MultiPolygon]], src_crs: str, dst_crs: str) \
+        -> List[Union[Polygon, MultiPolygon]]:
+    """
+    Reprojects polygons with a single transform call for the coordinates of all of their rings, instead of one call
+    per coordinate.
+    """
+    rings = []
+
+    def collect(polygon: Polygon) -> None:
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            coords = np.asarray(ring.coords, dtype=float)
+            rings.append(coords.reshape(len(coords), -1)[:, :2])
+
+    for geometry in polygons:
+        if geometry.is_empty:
+            continue
+        elif isinstance(geometry, Polygon):
+            collect(geometry)
+        elif isinstance(geometry, MultiPolygon):
+            for polygon in geometry.geoms:
+                collect(polygon)
+        else:
+            raise ValueError("expected a Polygon or MultiPolygon but got {g}".format(g=geometry.geom_type))
+
+    if not rings:
+        return list(polygons)
+
+    coordinates = np.concatenate(rings)
+    xs, ys = get_transformer(src_crs, dst_crs).transform(coordinates[:, 0], coordinates[:, 1])
+    reprojected = iter(np.split(np.column_stack([xs, ys]), np.cumsum([len(r) for r in rings])[:-1]))
+
+    def rebuild(polygon: Polygon) -> Polygon:
+        exterior = next(reprojected)
+        return Polygon(exterior, [next(reprojected) for _ in polygon.interiors])
+
+    return [g if g.is_empty else rebuild(g) if isinstance(g, Polygon) else MultiPolygon([rebuild(p) for p in g.geoms])
+            for g in polygons]
+
+
+def reproject_polygon(polygon: Union[Polygon, MultiPolygon], src_crs: str, dst_crs: str) -> Union[Polygon, MultiPolygon]:
+    return reproject_polygons([polygon], src_crs, dst_crs)[0]
@@ -0,0 +1,188 @@
+"""
+Chunked storage of (spatiotemporal) data cubes in the Zarr (v2) format, with the time and band dimensions.
+
+Every tile of a layer is one chunk of the cube: executors compress their chunks in parallel, and write them into the
+store themselves if it is on a file system they share with the driver; otherwise the driver writes the compressed
+chunks as they are streamed to it. The driver writes the metadata.
+"""
+import json
+import os
+import zipfile
+import zlib
+from datetime import datetime
+from typing import List, Union
+
+import numpy as np
+from geopyspark import SpaceTimeKey, SpatialKey
+
+from openeogeotrellis.geotiff import RasterGrid, cell_size
+
+_EPOCH = datetime(1970, 1, 1)
+
+_CELLS = 'cells'
+
+
+class ZarrCubeStore:
+    """
+    Zarr store (a directory) of a data cube with dimensions (t, bands, y, x), or (bands, y, x) without times.
+    The chunks are (1, bands, tile rows, tile cols): one tile of a layer at one instant.
+    """
+
+    def __init__(self, path: str, grid: RasterGrid, crs: str, tile_shape, key_origin, times: List[datetime] = None,
+                 compression_level: int = 6):
+        self.path = path
+        self.grid = grid
+        self.crs = crs
+        self.tile_rows, self.tile_cols = tile_shape
+        self.min_col, self.min_row = key_origin
+        self.times = sorted(times) if times is not None else None
+        self.compression_level = compression_level
+        self._time_indices = {t: i for i, t in enumerate(self.times)} if self.times is not None else None
+
+    @classmethod
+    def of_keys(cls, path: str, keys: List[Union[SpatialKey, SpaceTimeKey]], layer_metadata,
+                compression_level: int = 6) -> 'ZarrCubeStore':
+        layout_definition = layer_metadata.layout_definition
+        tile_layout = layout_definition.tileLayout
+        if not keys:
+            # an empty cube: without times and pixels
+            extent = layout_definition.extent
+            grid = RasterGrid(extent.xmin, extent.ymax, *cell_size(layout_definition), width=0, height=0)
+            times = [] if isinstance(layer_metadata.bounds.minKey, SpaceTimeKey) else None
+            return cls(path, grid, layer_metadata.crs, (tile_layout.tileRows, tile_layout.tileCols), (0, 0), times,
+                       compression_level)
+        times = sorted({key.instant for key in keys}) if keys and isinstance(keys[0], SpaceTimeKey) else None
+        return cls(path, RasterGrid.of_keys(keys, layout_definition), layer_metadata.crs,
+                   (tile_layout.tileRows, tile_layout.tileCols),
+                   (min(k.col for k in keys), min(k.row for k in keys)), times, compression_level)
+
+    @property
+    def dimensions(self) -> List[str]:
+        return (['t'] if self.times is not None else []) + ['bands', 'y', 'x']
+
+    def _chunk_index(self, key: Union[SpatialKey, SpaceTimeKey]) -> List[int]:
+        spatial = [0, key.row - self.min_row, key.col - self.min_col]
+        return ([self._time_indices[key.instant]] if self.times is not None else []) + spatial
+
+    def encode_chunk(self, cells: np.ndarray) -> bytes:
+        """Compresses the cells (bands, rows, cols) of a tile as a chunk (on an executor)."""
+        return zlib.compress(np.ascontiguousarray(cells).tobytes(), self.compression_level)
+
+    def chunk_path(self, key: Union[SpatialKey, SpaceTimeKey]) -> str:
+        return os.path.join(self.path, _CELLS, ".".join(str(i) for i in self._chunk_index(key)))
+
+    def write_encoded_chunk(self, key: Union[SpatialKey, SpaceTimeKey], data: bytes) -> None:
+        """Writes the compressed chunk of the tile of a key."""
+        os.makedirs(os.path.join(self.path, _CELLS), exist_ok=True)
+        with open(self.chunk_path(key), 'wb') as f:
+            f.write(data)
+
+    def write_chunk(self, key: Union[SpatialKey, SpaceTimeKey], cells: np.ndarray) -> None:
+        """Writes the cells (bands, rows, cols) of the tile of a key as its chunk."""
+        self.write_encoded_chunk(key, self.encode_chunk(cells))
+
+    def write_metadata(self, dtype: np.dtype, band_names: List[str], nodata=None) -> None:
+        """Writes the metadata and the coordinates of the cube (on the driver), after its chunks are written."""
+        dtype = np.dtype(dtype)
+        shape = ([len(self.times)] if self.times is not None else []) + \
+                [len(band_names), self.grid.height, self.grid.width]
+        chunks = ([1] if self.times is not None else []) + [len(band_names), self.tile_rows, self.tile_cols]
+
+        metadata = {'.zgroup': {'zarr_format': 2}, '.zattrs': {'crs': self.crs}}
+        self._array_metadata(metadata, _CELLS, dtype, shape, chunks, self.dimensions, _fill_value(dtype, nodata))
+
+        x = self.grid.left + (np.arange(self.grid.width) + 0.5) * self.grid.cell_width
+        y = self.grid.top - (np.arange(self.grid.height) + 0.5) * self.grid.cell_height
+        coordinates = {'x': x, 'y': y, 'bands': np.array(band_names, dtype=np.str_)}
+        if self.times is not None:
+            coordinates['t'] = np.array([int((t - _EPOCH).total_seconds()) for t in self.times], dtype=np.int64)
+
+        for name, values in coordinates.items():
+            self._array_metadata(metadata, name, values.dtype, list(values.shape), list(values.shape), [name], None)
+            with open(os.path.join(self.path, name, '0'), 'wb') as f:
+                f.write(zlib.compress(values.tobytes(), self.compression_level))
+        if self.times is not None:
+            metadata['t/.zattrs'].update(units='seconds since 1970-01-01', calendar='proleptic_gregorian')
+
+        for key, value in metadata.items():
+            with open(os.path.join(self.path, key), 'w') as f:
+                json.dump(value, f)
+        # consolidated metadata, to open the store with a single read
+        with open(os.path.join(self.path, '.zmetadata'), 'w') as f:
+            json.dump({'zarr_consolidated_format': 1, 'metadata': metadata}, f)
+
+    def _array_metadata(self, metadata: dict, name: str, dtype: np.dtype, shape, chunks, dimensions, fill_value):
+        os.makedirs(os.path.join(self.path, name), exist_ok=True)
+        metadata[name + '/.zarray'] = {
+            'zarr_format': 2, 'shape': shape, 'chunks': chunks, 'dtype': dtype.str, 'order': 'C',
+            'compressor': {'id': 'zlib', 'level': self.compression_level}, 'fill_value': fill_value, 'filters': None
+        }
+        metadata[name + '/.zattrs'] = {'_ARRAY_DIMENSIONS': dimensions}
+
+    def to_zip(self, path: str) -> None:
+        """Packs the store in a zip file (that Zarr reads as a ZipStore), without compressing its chunks again."""
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for directory, _, files in os.walk(self.path):
+                for name in files:
+                    if name.startswith('.') and name not in ['.zgroup', '.zattrs', '.zarray', '.zmetadata']:
+                        continue
+                    file = os.path.join(directory, name)
+                    archive.write(file, os.path.relpath(file, self.path))
+
+    def to_netcdf(self, path: str) -> None:
+        """
+        Copies the store into a NetCDF4 file, one chunk at a time. NetCDF4 (HDF5) files can not be written
+        concurrently, so this part runs on the driver, and decompresses and compresses every chunk again serially.
+        """
+        from netCDF4 import Dataset
+
+        with open(os.path.join(self.path, _CELLS, '.zarray')) as f:
+            array = json.load(f)
+        with open(os.path.join(self.path, 'bands', '.zarray')) as f:
+            band_dtype = np.dtype(json.load(f)['dtype'])
+        dtype = np.dtype(array['dtype'])
+        band_names = self._read_coordinate('bands', band_dtype)
+
+        with Dataset(path, 'w', format='NETCDF4') as dataset:
+            dataset.crs = self.crs
+            dataset.createDimension('x', self.grid.width)
+            dataset.createDimension('y', self.grid.height)
+            dataset.createDimension('bands', len(band_names))
+            dataset.createVariable('x', 'f8', ('x',))[:] = self._read_coordinate('x', np.float64)
+            dataset.createVariable('y', 'f8', ('y',))[:] = self._read_coordinate('y', np.float64)
+            bands = dataset.createVariable('bands', str, ('bands',))
+            for i, name in enumerate(band_names):
+                bands[i] = str(name)
+            if self.times is not None:
+                dataset.createDimension('t', len(self.times))
+                t = dataset.createVariable('t', 'i8', ('t',))
+                t.units, t.calendar = 'seconds since 1970-01-01', 'proleptic_gregorian'
+                t[:] = self._read_coordinate('t', np.int64)
+
+            fill_value = array['fill_value']
+            cells = dataset.createVariable(_CELLS, dtype, tuple(self.dimensions), zlib=True,
+                                           complevel=self.compression_level, chunksizes=array['chunks'],
+                                           fill_value=dtype.type(float(fill_value)) if fill_value is not None else None)
+            for name in os.listdir(os.path.join(self.path, _CELLS)):
+                if name.startswith('.'):
+                    continue
+                index = [int(i) for i in name.split('.')]
+                with open(os.path.join(self.path, _CELLS, name), 'rb') as f:
+                    chunk = np.frombuffer(zlib.decompress(f.read()), dtype=dtype).reshape(array['chunks'])
+                row, col = index[-2] * self.tile_rows, index[-1] * self.tile_cols
+                region = tuple(slice(i, i + 1) for i in index[:-3]) + (
+                    slice(None), slice(row, min(row + self.tile_rows, self.grid.height)),
+                    slice(col, min(col + self.tile_cols, self.grid.width)))
+                cells[region] = chunk[..., :region[-2].stop - row, :region[-1].stop - col]
+
+    def _read_coordinate(self, name: str, dtype: np.dtype) -> np.ndarray:
+        with open(os.path.join(self.path, name, '0'), 'rb') as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=dtype)
+
+
+def _fill_value(dtype: np.dtype, nodata):
+    if nodata is None:
+        return None
+    if dtype.kind == 'f':
+        return 'NaN' if np.isnan(nodata) else float(nodata)
+    return int(nodata)
@@ -0,0 +1,202 @@
+"""
+Statistics of the cells of polygons, for every band at once, that are computed in a single pass over the tiles
+and merged across tiles (and partitions) with `reduceByKey`.
+"""
+import math
+import re
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+STATISTICS = ['count', 'sum', 'mean', 'variance', 'sd', 'min', 'max', 'median']
+
+# percentiles, e.g. "p10" or "p97.5"
+_PERCENTILE = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
+
+def check_statistics(statistics: List[str]) -> List[str]:
+    unsupported = [s for s in statistics if s not in STATISTICS and _percentile(s) is None]
+    if unsupported or not statistics:
+        raise ValueError("Unsupported zonal statistics {u!r}, should be a non empty list of {s!r} or percentiles "
+                         "like 'p90'".format(u=unsupported, s=STATISTICS))
+    return list(statistics)
+
+
+def _percentile(statistic: str) -> Optional[float]:
+    match = _PERCENTILE.match(statistic)
+    if match and 0 <= float(match.group(1)) <= 100:
+        return float(match.group(1))
+    return None
+
+
+def _quantile(statistic: str) -> Optional[float]:
+    """The quantile (between 0 and 1) of a median or percentile statistic, None for other statistics."""
+    if statistic == 'median':
+        return 0.5
+    percentile = _percentile(statistic)
+    return percentile / 100 if percentile is not None else None
+
+
+class QuantileSketch:
+    """
+    Mergeable sketch of the quantiles of a stream of values (KLL, by Karnin, Lang and Liberty), in a memory that only
+    depends on the accuracy: a quantile is off by (approximately) at most the rank error, as a fraction of the count.
+
+    Level h holds items with a weight of 2^h. When a level exceeds its capacity, it is sorted and every other item is
+    promoted to the next level, starting at the first or second item. Levels below the top get geometrically smaller
+    capacities.
+
+    That offset has to be random: an offset that merely alternates starts the same way in every partial sketch, which
+    biases the quantiles of many merged sketches. It is taken from a checksum of the compacted items instead of a
+    random generator, so results can still be reproduced. The capacity of the top level (k = 6 / rank error) keeps the
+    worst rank error below the requested one with a margin (about 0.6 of it, measured on normal, uniform, exponential,
+    sorted and integer data, merged from up to 5000 parts).
+    """
+
+    def __init__(self, rank_error: float = 0.01):
+        if not 0 < rank_error < 1:
+            raise ValueError("Rank error should be between 0 and 1, but got: {e!r}".format(e=rank_error))
+        self.k = max(8, int(math.ceil(6 / rank_error)))
+        self.levels = [np.empty(0)]
+        self.count = 0
+
+    def _capacity(self, level: int) -> int:
+        return max(2, int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+    def update(self, values: np.ndarray) -> 'QuantileSketch':
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += values.size
+        self._compress()
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        self.levels.extend(np.empty(0) for _ in range(len(other.levels) - len(self.levels)))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.size > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays behind
+                kept, items = (items[-1:], items[:-1]) if items.size % 2 else (items[:0], items)
+                offset = zlib.crc32(items.tobytes()) & 1
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[offset::2]])
+            level += 1
+
+    def quantile(self, q: float) -> float:
+        """The (approximate) q-th quantile (between 0 and 1), NaN if the sketch is empty."""
+        if self.count == 0:
+            return np.nan
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(l.size, 2.0 ** h) for h, l in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        rank = q * cumulative[-1]
+        return float(items[order][min(np.searchsorted(cumulative, rank), len(order) - 1)])
+
+
+class PolygonStatistics:
+    """
+    Mergeable statistics of the valid (not no data, not NaN) cells of a polygon, for every band: the count,
+    mean and M2 (for the variance, merged with the parallel formula of Chan et al.), min and max.
+
+    The median and percentiles need the values themselves: they are only kept if asked for, or summarized in a
+    `QuantileSketch` per band if an approximation is good enough.
+    """
+
+    def __init__(self, count: np.ndarray, mean: np.ndarray, m2: np.ndarray, minimum: np.ndarray,
+                 maximum: np.ndarray, values: List[List[np.ndarray]] = None, sketches: List[QuantileSketch] = None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = minimum
+        self.max = maximum
+        self.values = values
+        self.sketches = sketches
+
+    @classmethod
+    def of_cells(cls, cells: np.ndarray, inside: np.ndarray, no_data, keep_values=False,
+                 rank_error: float = None) -> 'PolygonStatistics':
+        """
+        :param cells: (n_bands, rows, cols) cells of a tile
+        :param inside: (rows, cols) mask of the polygon
+        :param no_data: no data value of the cells, in addition to NaN
+        :param keep_values: keep the valid values, for the median and percentiles
+        :param rank_error: keep a quantile sketch with this accuracy instead of the values themselves
+        """
+        valid = (inside & ~np.isnan(cells)) if cells.dtype.kind == 'f' else np.broadcast_to(inside, cells.shape)
+        if no_data is not None and not np.isnan(no_data):
+            valid = valid & (cells != no_data)
+
+        values = cells.astype(np.float64, copy=False)
+        count = np.count_nonzero(valid, axis=(1, 2)).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.where(valid, values, 0.0).sum(axis=(1, 2)) / count, 0.0)
+        m2 = np.where(valid, (values - mean[:, None, None]) ** 2, 0.0).sum(axis=(1, 2))
+        minimum = np.where(valid, values, np.inf).min(axis=(1, 2))
+        maximum = np.where(valid, values, -np.inf).max(axis=(1, 2))
+        kept, sketches = None, None
+        if keep_values and rank_error is not None:
+            sketches = [QuantileSketch(rank_error).update(band[band_valid]) for band, band_valid in zip(values, valid)]
+        elif keep_values:
+            kept = [[band[band_valid]] for band, band_valid in zip(values, valid)]
+        return cls(count, mean, m2, minimum, maximum, kept, sketches)
+
+    def merge(self, other: 'PolygonStatistics') -> 'PolygonStatistics':
+        """Merges the statistics of another part of the polygon into these."""
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = self.mean + np.where(total > 0, delta * other.count / total, 0.0)
+            self.m2 = self.m2 + other.m2 + np.where(total > 0, delta ** 2 * self.count * other.count / total, 0.0)
+        self.count = total
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        if self.values is not None:
+            # concatenated only once, in `result`
+            for band_values, other_band_values in zip(self.values, other.values):
+                band_values.extend(other_band_values)
+        if self.sketches is not None:
+            for sketch, other_sketch in zip(self.sketches, other.sketches):
+                sketch.merge(other_sketch)
+        return self
+
+    def result(self, statistics: List[str]) -> Dict[str, List[float]]:
+        """The requested statistics, by name, with a value for every band (NaN if there are no valid cells)."""
+        empty = self.count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(empty, np.nan, self.m2 / self.count)
+        values = {
+            'count': lambda: self.count.astype(np.int64),
+            'sum': lambda: self.mean * self.count,
+            'mean': lambda: np.where(empty, np.nan, self.mean),
+            'variance': lambda: variance,
+            'sd': lambda: np.sqrt(variance),
+            'min': lambda: np.where(empty, np.nan, self.min),
+            'max': lambda: np.where(empty, np.nan, self.max),
+        }
+
+        def quantiles(q: float) -> np.ndarray:
+            if self.sketches is not None:
+                return np.array([sketch.quantile(q) for sketch in self.sketches])
+            return np.array([np.quantile(np.concatenate(v), q) if n > 0 else np.nan
+                             for v, n in zip(self.values, self.count)])
+
+        return {statistic: (values[statistic]() if _quantile(statistic) is None
+                            else quantiles(_quantile(statistic))).tolist()
+                for statistic in statistics}
+
+
+def needs_values(statistics: List[str]) -> bool:
+    return any(_quantile(s) is not None for s in statistics)
@@ -42,6 +42,8 @@ setup(
         'gunicorn==19.9.0',
         'kazoo==2.4.0',
         'flask-cors',
-        'rasterio==1.1.1'
+        'rasterio==1.1.1',
+        'pyproj>=2.2.0',
+        'netCDF4'
     ],
 )
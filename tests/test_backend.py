@@ -1,3 +1,5 @@
+import json
+
 from openeogeotrellis.backend import GpsBatchJobs
 
 
@@ -84,3 +86,23 @@ def test_extract_application_id():
 19/07/10 15:58:11 INFO Client: Application report for application_1562328661428_5542 (state: RUNNING)
     """
     assert GpsBatchJobs._extract_application_id(yarn_log) == "application_1562328661428_5542"
+
+
+def test_get_results_from_manifest(tmp_path):
+    from unittest import mock
+
+    with (tmp_path / "manifest.json").open('w') as f:
+        json.dump({"assets": {
+            "20170925T000000Z_0_0.tif": {"href": "20170925T000000Z_0_0.tif"},
+            "20170925T000000Z_1_0.tif": {"href": "20170925T000000Z_1_0.tif"},
+        }}, f)
+
+    batch_jobs = GpsBatchJobs()
+    with mock.patch.object(batch_jobs, 'get_job_info', return_value=mock.Mock(status='finished')), \
+            mock.patch.object(batch_jobs, '_get_job_output_dir', return_value=tmp_path):
+        results = batch_jobs.get_results(job_id="j0b", user_id="us3r")
+
+    assert results == {
+        "20170925T000000Z_0_0.tif": str(tmp_path),
+        "20170925T000000Z_1_0.tif": str(tmp_path),
+    }
@@ -1,6 +1,8 @@
 import datetime
+import os
 from pathlib import Path
 from unittest import TestCase,skip
+from unittest import mock
 
 import geopyspark as gps
 import numpy as np
@@ -136,10 +138,155 @@ class TestDownload(TestCase):
         print(geotiffs)
         #TODO how can we verify downloaded geotiffs, preferably without introducing a dependency on another library.
 
-    #skipped because gdal_merge.py is not available on jenkins and Travis
-    @skip
     def test_download_as_catalog(self):
         input = self.create_spacetime_layer()
 
         imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
-        imagecollection.download("catalogresult.tiff",format="GTIFF",parameters={"catalog":True})
\ No newline at end of file
+        path = str(self.temp_folder / "catalogresult.tiff")
+        imagecollection.download(path,format="GTIFF",parameters={"catalog":True})
+
+        import rasterio
+        with rasterio.open(path) as ds:
+            assert (ds.count, ds.height, ds.width) == (2, 8, 8)
+            assert ds.bounds == (0.0, 0.0, 4.0, 4.0)
+            cells = ds.read()
+            assert np.all(cells[0] == 1)
+            assert np.all(cells[1] == 2)
+
+    def test_download_tiled_geotiff(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_tiled_result.geotiff")
+        imagecollection.download(path, format="GTIFF", tiled=True)
+
+        import rasterio
+        with rasterio.open(path) as ds:
+            assert (ds.count, ds.height, ds.width) == (2, 8, 8)
+            assert ds.bounds == (0.0, 0.0, 4.0, 4.0)
+            cells = ds.read()
+            assert np.all(cells[0] == 1)
+            assert np.all(cells[1] == 2)
+
+    def test_download_cog(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_cog_result.geotiff")
+        imagecollection.download(path, format="GTIFF", parameters={"cog": True})
+
+        import rasterio
+        with rasterio.open(path) as ds:
+            assert (ds.count, ds.height, ds.width) == (2, 8, 8)
+            assert ds.bounds == (0.0, 0.0, 4.0, 4.0)
+            assert ds.profile['tiled']
+            cells = ds.read()
+            assert np.all(cells[0] == 1)
+            assert np.all(cells[1] == 2)
+
+    def test_download_netcdf(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_result.nc")
+        imagecollection.download(path, format="NetCDF")
+
+        from netCDF4 import Dataset
+        with Dataset(path) as dataset:
+            cells = dataset.variables["cells"]
+            assert cells.dimensions == ("t", "bands", "y", "x")
+            assert cells.shape == (1, 2, 8, 8)
+            assert np.all(cells[0, 0] == 1)
+            assert np.all(cells[0, 1] == 2)
+
+    def test_download_netcdf_written_by_executors(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_executors_result.nc")
+        with mock.patch.dict(os.environ, {"OPENEO_EXECUTOR_SHARED_DIRS": str(self.temp_folder)}):
+            imagecollection.download(path, format="NetCDF")
+
+        from netCDF4 import Dataset
+        with Dataset(path) as dataset:
+            cells = dataset.variables["cells"]
+            assert cells.shape == (1, 2, 8, 8)
+            assert np.all(cells[0, 0] == 1)
+            assert np.all(cells[0, 1] == 2)
+
+    def test_download_netcdf_of_empty_layer(self):
+        empty = self.create_spacetime_layer().filter_by_times([datetime.datetime(2000, 1, 1)])
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: empty}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_empty_result.nc")
+        imagecollection.download(path, format="NetCDF")
+
+        from netCDF4 import Dataset
+        with Dataset(path) as dataset:
+            cells = dataset.variables["cells"]
+            assert cells.dimensions == ("t", "bands", "y", "x")
+            assert cells.shape == (0, 1, 0, 0)
+
+    def test_download_tiled_geotiff_cropped_to_keys(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_tiled_cropped_result.geotiff")
+        # only touches the bottom left tile
+        imagecollection.download(path, format="GTIFF", tiled=True, left=0.5, bottom=0.5, right=1.5, top=1.5,
+                                 srs="EPSG:4326")
+
+        import rasterio
+        with rasterio.open(path) as ds:
+            assert (ds.count, ds.height, ds.width) == (2, 4, 4)
+            assert ds.bounds == (0.0, 0.0, 2.0, 2.0)
+
+    def test_download_tiled_geotiff_cropped_outside_of_layer(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        path = str(self.temp_folder / "test_download_tiled_cropped_outside_result.geotiff")
+
+        in_crop = imagecollection._keys_in_crop(input.layer_metadata, gps.Extent(10.0, 10.0, 11.0, 11.0))
+        assert not any(in_crop(key) for key in input.collect_keys())
+
+        # no tiles to write: like without tiling, saveStitched crops the layer
+        with mock.patch.object(imagecollection, '_save_stitched') as save_stitched:
+            imagecollection.download(path, format="GTIFF", tiled=True, left=10, bottom=10, right=11, top=11,
+                                     srs="EPSG:4326")
+
+        save_stitched.assert_called_once()
+        _, _, crop_bounds = save_stitched.call_args[0]
+        self.assertAlmostEqual(crop_bounds.xmin, 10.0)
+        self.assertAlmostEqual(crop_bounds.ymax, 11.0)
+
+    def test_save_stitched_blocks_of_empty_layer(self):
+        empty = self.create_spacetime_layer().filter_by_times([datetime.datetime(2000, 1, 1)]).to_spatial_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: empty}), InMemoryServiceRegistry())
+        path = self.temp_folder / "test_save_stitched_blocks_empty.geotiff"
+
+        # falls back to saveStitched
+        assert not imagecollection._save_stitched_blocks(empty, str(path))
+        assert not path.exists()
+
+    def test_write_assets(self):
+        input = self.create_spacetime_layer()
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: input}), InMemoryServiceRegistry())
+        directory = self.temp_folder / "assets"
+        directory.mkdir(exist_ok=True)
+        assets = imagecollection.write_assets(str(directory))
+
+        assert sorted(assets.keys()) == ["20170925T113700Z_0_0.tif", "20170925T113700Z_0_1.tif",
+                                         "20170925T113700Z_1_0.tif", "20170925T113700Z_1_1.tif"]
+        asset = assets["20170925T113700Z_0_1.tif"]
+        assert asset["bbox"] == [0.0, 0.0, 2.0, 2.0]
+        assert asset["datetime"] == "2017-09-25T11:37:00Z"
+
+        import json
+        with (directory / "manifest.json").open() as f:
+            assert json.load(f)["assets"] == assets
+
+        import rasterio
+        with rasterio.open(str(directory / "20170925T113700Z_0_1.tif")) as ds:
+            assert (ds.count, ds.height, ds.width) == (2, 4, 4)
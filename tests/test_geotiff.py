@@ -0,0 +1,146 @@
+import numpy as np
+import rasterio
+from geopyspark import SpatialKey, Tile
+from geopyspark.geotrellis import Extent, LayoutDefinition, TileLayout
+
+from openeogeotrellis.geotiff import RasterGrid, encode_block, merge, overview_factor, read_tiff_layout, write_blocks, \
+    write_cog, write_tiles
+
+CRS = '+proj=longlat +datum=WGS84 +no_defs '
+
+# 4x4 tiles of 256x256 pixels of 1 by 1
+layout_definition = LayoutDefinition(Extent(0.0, 0.0, 1024.0, 1024.0), TileLayout(4, 4, 256, 256))
+# the same extent at half the resolution: 2x2 tiles of 256x256 pixels of 2 by 2
+half_resolution = LayoutDefinition(Extent(0.0, 0.0, 1024.0, 1024.0), TileLayout(2, 2, 256, 256))
+
+
+def _tiles(layout_cols, layout_rows, value):
+    cells = np.full((1, 256, 256), value, dtype=np.int16)
+    return [(SpatialKey(col, row), Tile(cells, 'int16', -1)) for row in range(layout_rows)
+            for col in range(layout_cols)]
+
+
+def test_grid_of_keys():
+    grid = RasterGrid.of_keys([SpatialKey(1, 1), SpatialKey(2, 3)], layout_definition)
+
+    assert grid == RasterGrid(left=256.0, top=768.0, cell_width=1.0, cell_height=1.0, width=512, height=768)
+    assert grid.scaled(2) == RasterGrid(left=256.0, top=768.0, cell_width=2.0, cell_height=2.0, width=256,
+                                        height=384)
+
+
+def test_overview_factor():
+    grid = RasterGrid.of_keys([SpatialKey(0, 0)], layout_definition)
+
+    assert overview_factor(half_resolution, grid) == 2
+    assert overview_factor(layout_definition, grid) == 0
+    assert overview_factor(LayoutDefinition(Extent(0.0, 0.0, 1024.0, 1024.0), TileLayout(3, 3, 256, 256)), grid) == 0
+
+
+def test_write_tiles_clips_to_grid(tmp_path):
+    grid = RasterGrid(left=128.0, top=1024.0, cell_width=1.0, cell_height=1.0, width=256, height=256)
+    path = str(tmp_path / "clipped.tif")
+
+    write_tiles(_tiles(2, 1, 3), layout_definition, path, grid, CRS, nodata=-1)
+
+    with rasterio.open(path) as ds:
+        assert (ds.count, ds.height, ds.width) == (1, 256, 256)
+        assert ds.bounds == (128.0, 768.0, 384.0, 1024.0)
+        assert np.all(ds.read(1) == 3)
+
+
+def test_write_cog_with_pyramid_level_as_overview(tmp_path):
+    grid = RasterGrid.of_keys([key for key, _ in _tiles(4, 4, 1)], layout_definition)
+    base, overview, cog = (str(tmp_path / name) for name in ["base.tif", "overview.tif", "cog.tif"])
+
+    write_tiles(_tiles(4, 4, 1), layout_definition, base, grid, CRS, nodata=-1, write_mask=False)
+    # a different value, to tell the overview apart from a downsampled base image
+    write_tiles(_tiles(2, 2, 2), half_resolution, overview, grid.scaled(2), CRS, nodata=-1, write_mask=False)
+    write_cog(base, [overview], cog)
+
+    with rasterio.open(cog) as ds:
+        assert (ds.height, ds.width) == (1024, 1024)
+        assert ds.overviews(1) == [2]
+        assert ds.block_shapes == [(512, 512)]
+        assert np.all(ds.read(1) == 1)
+        assert np.all(ds.read(1, out_shape=(512, 512)) == 2)
+
+    with open(cog, 'rb') as f:
+        assert f.read(2) == b'II'  # little endian
+
+
+def test_write_cog_keeps_int8_signed(tmp_path):
+    def tiles(layout_cols, layout_rows):
+        cells = np.full((1, 256, 256), -1, dtype=np.int8)
+        return [(key, Tile(cells, 'int8', -128)) for key, _ in _tiles(layout_cols, layout_rows, 0)]
+
+    grid = RasterGrid.of_keys([key for key, _ in tiles(4, 4)], layout_definition)
+    base, overview, cog = (str(tmp_path / name) for name in ["base.tif", "overview.tif", "cog.tif"])
+
+    write_tiles(tiles(4, 4), layout_definition, base, grid, CRS, nodata=-128, write_mask=False)
+    write_tiles(tiles(2, 2), half_resolution, overview, grid.scaled(2), CRS, nodata=-128, write_mask=False)
+    write_cog(base, [overview], cog)
+
+    with rasterio.open(cog) as ds:
+        assert ds.dtypes == ('int8',)
+        assert ds.nodata == -128
+        assert np.all(ds.read(1) == -1)
+        assert np.all(ds.read(1, out_shape=(512, 512)) == -1)
+
+
+def _write_geotiff(path, cells, col_off, **options):
+    profile = dict(driver='GTiff', count=cells.shape[0], height=cells.shape[1], width=cells.shape[2],
+                   dtype=cells.dtype, crs='EPSG:4326', nodata=-1,
+                   transform=rasterio.transform.from_origin(col_off, 0.0, 1.0, 1.0), **options)
+    with rasterio.open(path, 'w', **profile) as ds:
+        ds.write(cells)
+    return path
+
+
+def test_merge_copies_blocks(tmp_path):
+    cells = [np.random.randint(0, 100, (2, 256, 256)).astype(np.int16) for _ in range(3)]
+    sources = [_write_geotiff(str(tmp_path / "{i}.tif".format(i=i)), c, i * 256, tiled=True, blockxsize=256,
+                              blockysize=256, compress='deflate') for i, c in enumerate(cells)]
+    path = str(tmp_path / "merged.tif")
+
+    merge(sources, path)
+
+    layout = read_tiff_layout(path)
+    source_layout = read_tiff_layout(sources[1])
+    assert layout.tile_byte_counts[1] == source_layout.tile_byte_counts[0]
+    with rasterio.open(path) as ds:
+        assert (ds.count, ds.height, ds.width) == (2, 256, 768)
+        assert ds.nodata == -1
+        assert np.array_equal(ds.read(), np.concatenate(cells, axis=2))
+
+
+def test_merge_striped(tmp_path):
+    sources = [_write_geotiff(str(tmp_path / "{i}.tif".format(i=i)), np.full((1, 100, 100), i, dtype=np.int16),
+                              i * 100) for i in range(2)]
+    path = str(tmp_path / "merged.tif")
+
+    merge(sources, path)
+
+    with rasterio.open(path) as ds:
+        assert (ds.count, ds.height, ds.width) == (1, 100, 200)
+        assert np.all(ds.read(1)[:, :100] == 0)
+        assert np.all(ds.read(1)[:, 100:] == 1)
+
+
+def test_write_blocks(tmp_path):
+    layout = LayoutDefinition(Extent(0.0, 0.0, 64.0, 64.0), TileLayout(4, 4, 16, 16))
+    keys = [SpatialKey(0, 1), SpatialKey(2, 1), SpatialKey(0, 2), SpatialKey(1, 2)]
+    cells = {key: np.full((2, 16, 16), key.col * 10 + key.row, dtype=np.float32) for key in keys}
+    path = str(tmp_path / "blocks.tif")
+
+    # the top middle block is missing
+    blocks = [(key.col, key.row - 1, encode_block(cells[key])) for key in keys]
+    write_blocks(blocks, path, RasterGrid.of_keys(keys, layout), CRS, np.dtype(np.float32), 2, (16, 16), nodata=-1.0)
+
+    with rasterio.open(path) as ds:
+        assert (ds.count, ds.height, ds.width) == (2, 32, 48)
+        assert ds.bounds == (0.0, 16.0, 48.0, 48.0)
+        assert ds.block_shapes == [(16, 16), (16, 16)]
+        data = ds.read()
+        assert np.all(data[:, 16:, 16:32] == 12)
+        assert np.all(data[:, :16, 32:] == 21)
+        assert np.all(data[:, :16, 16:32] == -1.0)
@@ -150,6 +150,16 @@ class TestMultipleDates(TestCase):
         self.assertEqual(0.0, stitched.cells[0][0][0])
         self.assertAlmostEqual(0.4714045, stitched.cells[0][0][1])
 
+        stitched = imagecollection.reduce("median", "temporal").pyramid.levels[0].stitch()
+        print(stitched)
+        self.assertEqual(2.0, stitched.cells[0][0][0])
+        self.assertEqual(1.0, stitched.cells[0][0][1])
+
+        stitched = imagecollection.reduce("percentile_100", "temporal").pyramid.levels[0].stitch()
+        print(stitched)
+        self.assertEqual(2.0, stitched.cells[0][0][0])
+        self.assertEqual(2.0, stitched.cells[0][0][1])
+
     def test_reduce_all_data(self):
         input = Pyramid({0: self._single_pixel_layer({
             datetime.datetime.strptime("2016-04-24T04:00:00Z", '%Y-%m-%dT%H:%M:%SZ'): 1.0,
@@ -335,6 +345,55 @@ class TestMultipleDates(TestCase):
         self.assertEqual(6, stitched.cells[0][0][5])
         self.assertEqual(4, stitched.cells[0][5][6])
 
+    def test_apply_spatiotemporal_max_time_steps(self):
+        import openeo_udf.functions
+
+        input = Pyramid({0: self.tiled_raster_rdd})
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(input, InMemoryServiceRegistry(), {
+            "bands": [
+                {
+                    "band_id": "2",
+                    "name": "blue",
+                    "wavelength_nm": 496.6,
+                    "res_m": 10,
+                    "scale": 0.0001,
+                    "offset": 0,
+                    "type": "int16",
+                    "unit": "1"
+                }]
+        })
+        import os
+        dir = os.path.dirname(openeo_udf.functions.__file__)
+        file_name = os.path.join(dir, "datacube_reduce_time_sum.py")
+        with open(file_name, "r")  as f:
+            udf_code = f.read()
+
+        # time windows of one time step: one result per input tile, labeled with the instant of that tile
+        result = imagecollection.apply_tiles_spatiotemporal(udf_code, max_time_steps=1)
+        local_tiles = result.pyramid.levels[0].to_numpy_rdd().collect()
+        self.assertEqual(len(TestMultipleDates.layer), len(local_tiles))
+        self.assertEqual(
+            sorted((k.col, k.row, k.instant) for k, _ in TestMultipleDates.layer),
+            sorted((k.col, k.row, k.instant) for k, _ in local_tiles)
+        )
+
+    def test_apply_tiles_batched(self):
+        input = Pyramid({0: self.tiled_raster_rdd})
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(input, InMemoryServiceRegistry())
+        udf_code = """
+def apply_datacube(cube: DataCube, context: dict) -> DataCube:
+    return DataCube(cube.array * 2)
+"""
+
+        expected = dict(imagecollection.apply_tiles(udf_code).pyramid.levels[0].to_numpy_rdd().collect())
+        batched = imagecollection.apply_tiles(udf_code, tiles_per_batch=3).pyramid.levels[0].to_numpy_rdd().collect()
+
+        self.assertEqual(len(expected), len(batched))
+        for key, tile in batched:
+            np.testing.assert_array_equal(expected[key].cells, tile.cells)
+
     def test_apply_dimension_spatiotemporal(self):
 
         input = Pyramid({0: self.tiled_raster_rdd})
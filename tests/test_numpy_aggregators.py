@@ -0,0 +1,117 @@
+import warnings
+from functools import reduce
+
+import geopyspark as gps
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal
+
+from openeogeotrellis.numpy_aggregators import MinCombiner, MaxCombiner, SumCombiner, MeanCombiner, \
+    VarianceCombiner, StandardDeviationCombiner, min_composite, max_composite, sum_composite, mean_composite, \
+    var_composite, std_composite, median_composite, percentile_composite
+
+
+def _tiles(n=7, seed=42):
+    rs = np.random.RandomState(seed)
+    cells = rs.uniform(-10, 10, size=(n, 1, 3, 4)).astype(np.float32)
+    cells[rs.uniform(size=cells.shape) < 0.3] = np.nan
+    cells[:, 0, 0, 0] = np.nan  # a cell without any data
+    return [gps.Tile(c, 'FLOAT', np.nan) for c in cells], cells
+
+
+def _combine(combiner, tiles, partitions):
+    """Mimic `combineByKey` over the given partitioning of the tiles."""
+    states = []
+    for part in np.array_split(np.arange(len(tiles)), partitions):
+        state = combiner.create(tiles[part[0]])
+        for i in part[1:]:
+            state = combiner.merge_value(state, tiles[i])
+        states.append(state)
+    return combiner.finish(reduce(combiner.merge_combiners, states))
+
+
+@pytest.mark.parametrize("partitions", [1, 2, 3, 7])
+@pytest.mark.parametrize(["combiner", "expected"], [
+    (MinCombiner(), lambda c: np.nanmin(c, axis=0)),
+    (MaxCombiner(), lambda c: np.nanmax(c, axis=0)),
+    (SumCombiner(), lambda c: np.nansum(c, axis=0)),
+    (MeanCombiner(), lambda c: np.nanmean(c, axis=0)),
+    (VarianceCombiner(), lambda c: np.nanvar(c, axis=0)),
+    (StandardDeviationCombiner(), lambda c: np.nanstd(c, axis=0)),
+])
+def test_temporal_combiners(combiner, expected, partitions):
+    tiles, cells = _tiles()
+    result = _combine(combiner, tiles, partitions)
+    with warnings.catch_warnings():
+        # all-NaN cells
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        assert_array_almost_equal(result.cells, expected(cells.astype(np.float64)), decimal=4)
+    assert result.cells.dtype == np.float32
+
+
+@pytest.mark.parametrize(["composite", "expected"], [
+    (min_composite, lambda c: np.nanmin(c, axis=0)),
+    (max_composite, lambda c: np.nanmax(c, axis=0)),
+    (sum_composite, lambda c: np.nansum(c, axis=0)),
+    (mean_composite, lambda c: np.nanmean(c, axis=0)),
+    (var_composite, lambda c: np.nanvar(c, axis=0)),
+    (std_composite, lambda c: np.nanstd(c, axis=0)),
+    (median_composite, lambda c: np.nanmedian(c, axis=0)),
+    (percentile_composite(90), lambda c: np.nanpercentile(c, 90, axis=0)),
+])
+def test_composites_on_iterator(composite, expected):
+    tiles, cells = _tiles()
+    with warnings.catch_warnings():
+        # the cell without any data must not warn
+        warnings.simplefilter("error", category=RuntimeWarning)
+        result = composite(iter(tiles))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        assert_array_almost_equal(result.cells, expected(cells.astype(np.float64)), decimal=4)
+
+
+def test_composite_no_data_value():
+    tiles = [
+        gps.Tile(np.array([[[1, -1, 5], [-1, -1, 3]]], dtype=np.int16), 'SHORT', -1),
+        gps.Tile(np.array([[[3, 2, -1], [-1, 4, 3]]], dtype=np.int16), 'SHORT', -1),
+        gps.Tile(np.array([[[2, 6, -1], [-1, 9, 3]]], dtype=np.int16), 'SHORT', -1),
+    ]
+
+    maximum = max_composite(tiles)
+    assert maximum.cells.dtype == np.int16
+    assert maximum.cell_type == 'SHORT'
+    np.testing.assert_array_equal(maximum.cells, [[[3, 6, 5], [-1, 9, 3]]])
+
+    mean = mean_composite(tiles)
+    assert mean.cells.dtype == np.float32
+    assert mean.cell_type == 'FLOAT'
+    assert_array_almost_equal(mean.cells, [[[2, 4, 5], [-1, 6.5, 3]]])
+
+    median = median_composite(tiles)
+    assert_array_almost_equal(median.cells, [[[2, 4, 5], [-1, 6.5, 3]]])
+
+
+def test_combiner_no_data_value():
+    tiles = [
+        gps.Tile(np.array([[[1, -1], [-1, 5]]], dtype=np.int16), 'SHORT', -1),
+        gps.Tile(np.array([[[3, 2], [-1, 5]]], dtype=np.int16), 'SHORT', -1),
+    ]
+    result = _combine(MeanCombiner(), tiles, partitions=2)
+    assert_array_almost_equal(result.cells, [[[2, 2], [-1, 5]]])
+
+    maximum = _combine(MaxCombiner(), tiles, partitions=2)
+    assert maximum.cells.dtype == np.int16
+    assert maximum.cell_type == 'SHORT'
+    np.testing.assert_array_equal(maximum.cells, [[[3, 2], [-1, 5]]])
+
+    minimum = _combine(MinCombiner(), tiles, partitions=1)
+    assert minimum.cells.dtype == np.int16
+    np.testing.assert_array_equal(minimum.cells, [[[1, 2], [-1, 5]]])
+
+    total = _combine(SumCombiner(), tiles, partitions=2)
+    assert total.cells.dtype == np.float32
+
+
+def test_percentile_out_of_range():
+    with pytest.raises(ValueError):
+        percentile_composite(101)
@@ -0,0 +1,142 @@
+from collections import namedtuple
+
+import geopyspark as gps
+import numpy as np
+from geopyspark.geotrellis.constants import CellType
+
+from openeogeotrellis.pyramid import LazyPyramid, CellFunctionChain, map_cells, convert_data_type, infer_cell_type, \
+    cell_step
+
+FakeLayer = namedtuple("FakeLayer", ["name", "layer_type", "pysc"])
+
+
+def _pyramid(zoom_levels=(0, 1, 2)) -> gps.Pyramid:
+    return gps.Pyramid({z: FakeLayer("L{z}".format(z=z), gps.LayerType.SPACETIME, None) for z in zoom_levels})
+
+
+def test_lazy_pyramid_only_materializes_accessed_levels():
+    calls = []
+
+    def func(layer, zoom):
+        calls.append(zoom)
+        return layer._replace(name=layer.name + "f")
+
+    pyramid = LazyPyramid(_pyramid(), func)
+    assert calls == []
+    assert pyramid.max_zoom == 2
+    assert sorted(pyramid.levels.keys()) == [0, 1, 2]
+    assert 1 in pyramid.levels
+    assert 5 not in pyramid.levels
+    assert calls == []
+
+    assert pyramid.levels[pyramid.max_zoom].name == "L2f"
+    assert pyramid.levels[pyramid.max_zoom].name == "L2f"
+    assert calls == [2]
+
+
+def test_lazy_pyramid_chain():
+    calls = []
+
+    def func(suffix):
+        def apply(layer, zoom):
+            calls.append((suffix, zoom))
+            return layer._replace(name=layer.name + suffix)
+
+        return apply
+
+    pyramid = LazyPyramid(_pyramid(), func("a")).apply(func("b")).apply(func("c"))
+    assert pyramid.levels[0].name == "L0abc"
+    assert calls == [("a", 0), ("b", 0), ("c", 0)]
+    assert pyramid.layer_type == gps.LayerType.SPACETIME
+    assert calls == [("a", 0), ("b", 0), ("c", 0), ("a", 2), ("b", 2), ("c", 2)]
+    assert {k: l.name for k, l in pyramid.levels.items()} == {0: "L0abc", 1: "L1abc", 2: "L2abc"}
+
+
+def test_lazy_pyramid_change_layer_type():
+    pyramid = LazyPyramid(_pyramid(), lambda layer, zoom: layer._replace(layer_type=gps.LayerType.SPATIAL))
+    assert pyramid.layer_type == gps.LayerType.SPATIAL
+
+
+def test_map_cells_fuses_consecutive_cell_functions():
+    source = _pyramid()
+    fused = map_cells(map_cells(source, lambda cells, nd: cells + 1, cell_type=CellType.FLOAT64),
+                      lambda cells, nd: cells * 2)
+    fused = convert_data_type(fused, CellType.UINT8, 255)
+
+    assert fused._parent is source
+    assert fused.pending_cell_functions.cell_type == "uint8ud255"
+
+
+def test_convert_data_type_without_pending_cell_functions():
+    source = LazyPyramid(_pyramid(), lambda layer, zoom: layer)
+    converted = convert_data_type(source, CellType.FLOAT32)
+    assert converted._parent is source
+    assert converted.pending_cell_functions is None
+
+
+def test_cell_function_chain_steps():
+    chain = CellFunctionChain() \
+        .convert_data_type(CellType.FLOAT64) \
+        .then(lambda cells, nd: cells * 10) \
+        .convert_data_type(CellType.UINT8, 255)
+
+    cells = np.array([[[1, -1], [2, 3]]], dtype=np.int16)
+    no_data_value = -1
+    for step in chain._steps:
+        cells, no_data_value = step(cells, no_data_value)
+
+    assert cells.dtype == np.uint8
+    assert no_data_value == 255
+    np.testing.assert_array_equal(cells, [[[10, 255], [20, 30]]])
+
+
+def test_infer_cell_type_keeps_native_cell_type():
+    inference = infer_cell_type(lambda cells, nd: cells[0], "int16", num_bands=2)
+    assert inference.native
+    assert inference.cell_type == "int16"
+    assert inference.no_data_bands == [0]
+
+
+def test_infer_cell_type_upcasts_on_overflow():
+    inference = infer_cell_type(lambda cells, nd: cells[0] + cells[1], "int16", num_bands=2)
+    assert not inference.native
+    assert inference.cell_type == "float32"
+
+
+def test_infer_cell_type_narrowest_float():
+    assert infer_cell_type(lambda cells, nd: cells[0] * 0.5, "uint8") == (True, "float32", [0])
+    assert infer_cell_type(lambda cells, nd: cells[0] * 0.1, "uint8").cell_type == "float64"
+    assert infer_cell_type(lambda cells, nd: cells[0], "float64").cell_type == "float64"
+
+
+def test_infer_cell_type_never_narrows_float64():
+    for function in [lambda cells, nd: cells[0] + 1, lambda cells, nd: cells[0] * 2,
+                     lambda cells, nd: np.fmax(cells[0], cells[1]), lambda cells, nd: cells[0] > 0.5]:
+        for allow_native in [True, False]:
+            inference = infer_cell_type(function, "float64", num_bands=2, allow_native=allow_native)
+            assert inference.cell_type in ["float64", "bool"]
+
+    assert infer_cell_type(lambda cells, nd: cells[0] + 1, "int32").cell_type == "float64"
+    assert infer_cell_type(lambda cells, nd: cells[0] * 2, "float32").cell_type == "float32"
+
+    function = lambda cells, nd: cells[0] + 1
+    cells = np.array([[[0.1, 1 / 3], [123456.789012345, np.nan]]], dtype=np.float64)
+    result, _ = cell_step(function, infer_cell_type(function, "float64"))(cells, np.nan)
+    assert result.dtype == np.float64
+    np.testing.assert_array_equal(result, cells[0] + 1)
+
+
+def test_infer_cell_type_only_float():
+    inference = infer_cell_type(lambda cells, nd: cells[0], "int16", allow_native=False)
+    assert inference == (False, "float32", None)
+
+
+def test_cell_step_native_masks_no_data():
+    function = lambda cells, nd: cells[0] // 2
+    step = cell_step(function, infer_cell_type(function, "int16", num_bands=2))
+
+    cells = np.array([[[4, -32768], [6, 8]], [[1, 2], [-32768, 3]]], dtype=np.int16)
+    result, no_data_value = step(cells, -32768)
+    assert result.dtype == np.int16
+    assert no_data_value == -32768
+    np.testing.assert_array_equal(result, [[2, -32768], [3, 4]])
@@ -0,0 +1,95 @@
+import threading
+
+import numpy as np
+
+from openeogeotrellis.result_cache import ResultCache, collection_ids, process_graph_key
+
+PROCESS_GRAPH = {
+    "process_graph": {
+        "loadco1": {"process_id": "load_collection", "arguments": {"id": "PROBAV_L3_S10_TOC_NDVI_333M"}},
+        "reduce1": {
+            "process_id": "reduce",
+            "arguments": {
+                "data": {"from_node": "loadco1"},
+                "reducer": {"callback": {
+                    "loadco2": {"process_id": "load_collection", "arguments": {"id": "S2_FAPAR_V102_WEBMERCATOR2"}}
+                }}
+            },
+            "result": True
+        }
+    }
+}
+
+METADATA = {
+    "PROBAV_L3_S10_TOC_NDVI_333M": {"id": "PROBAV_L3_S10_TOC_NDVI_333M", "_vito": {"data_id": "a"}},
+    "S2_FAPAR_V102_WEBMERCATOR2": {"id": "S2_FAPAR_V102_WEBMERCATOR2", "_vito": {"data_id": "b"}},
+}
+
+
+def test_collection_ids():
+    assert collection_ids(PROCESS_GRAPH) == {"PROBAV_L3_S10_TOC_NDVI_333M", "S2_FAPAR_V102_WEBMERCATOR2"}
+
+
+def test_process_graph_key():
+    key = process_graph_key(PROCESS_GRAPH, METADATA.get, "download", {"format": "GTiff"})
+
+    reordered = {"process_graph": dict(reversed(list(PROCESS_GRAPH["process_graph"].items())))}
+    assert process_graph_key(reordered, METADATA.get, "download", {"format": "GTiff"}) == key
+    assert process_graph_key(PROCESS_GRAPH, METADATA.get, "download", {"format": "NetCDF"}) != key
+
+    new_version = dict(METADATA, PROBAV_L3_S10_TOC_NDVI_333M={"id": "PROBAV_L3_S10_TOC_NDVI_333M", "version": 2})
+    assert process_graph_key(PROCESS_GRAPH, new_version.get, "download", {"format": "GTiff"}) != key
+
+
+def test_files_and_json(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=1000)
+    source = tmp_path / "result.tiff"
+    source.write_bytes(b"tiff")
+    target = str(tmp_path / "copy.tiff")
+
+    assert not cache.get_file("k1", target)
+    cache.put_file("k1", str(source))
+    assert cache.get_file("k1", target)
+    assert open(target, 'rb').read() == b"tiff"
+
+    assert cache.get_json("k2") is None
+    cache.put_json("k2", {"2017-09-25T00:00:00Z": [[np.float32(1.5), float('nan')]]})
+    timeseries = cache.get_json("k2")
+    assert timeseries["2017-09-25T00:00:00Z"][0][0] == 1.5
+    assert np.isnan(timeseries["2017-09-25T00:00:00Z"][0][1])
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=30)
+    for key in ["a", "b", "c"]:
+        cache.put_json(key, "x" * 8)  # 10 bytes
+    assert cache.get_json("a") is not None
+
+    cache.put_json("d", "x" * 8)
+
+    assert "b" not in cache
+    assert all(key in cache for key in ["a", "c", "d"])
+    assert cache.total_bytes == 30
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c", "d"]
+
+    # a new cache on the same directory picks up the entries
+    assert "a" in ResultCache(str(tmp_path), max_bytes=30)
+
+
+def test_concurrent_use(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=200)
+
+    def use(i):
+        for j in range(50):
+            cache.put_json("key{k}".format(k=(i + j) % 30), [i, j])
+            value = cache.get_json("key{k}".format(k=(i * j) % 30))
+            assert value is None or len(value) == 2
+
+    threads = [threading.Thread(target=use, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache.total_bytes <= 200
+    assert cache.total_bytes == sum(p.stat().st_size for p in tmp_path.iterdir())
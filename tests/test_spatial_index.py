@@ -0,0 +1,77 @@
+import pickle
+
+import numpy as np
+from geopyspark.geotrellis import Extent, LayoutDefinition, TileLayout
+from shapely.geometry import Polygon, box
+
+from openeogeotrellis import spatial_index
+from openeogeotrellis.spatial_index import MaskCache, PolygonKeyIndex
+
+# 2x2 tiles of 4x4 pixels of 0.5 by 0.5
+layout_definition = LayoutDefinition(Extent(0.0, 0.0, 4.0, 4.0), TileLayout(2, 2, 4, 4))
+
+
+def test_keys_and_polygons_for_key():
+    polygons = [
+        box(0.0, 0.0, 1.0, 1.0),  # bottom left tile
+        box(2.5, 2.5, 3.5, 3.5),  # top right tile
+        box(1.5, 1.5, 2.5, 2.5),  # all tiles
+        box(10.0, 10.0, 11.0, 11.0),  # outside of the layout
+    ]
+    index = PolygonKeyIndex(polygons, layout_definition)
+
+    assert index.keys() == {(0, 0), (1, 0), (0, 1), (1, 1)}
+    assert index.polygons_for(0, 1) == [0, 2]
+    assert index.polygons_for(1, 0) == [1, 2]
+    assert index.polygons_for(0, 0) == [2]
+    assert (0, 1) in index
+    assert index.polygons_for(5, 5) == []
+
+
+def test_keys_are_pruned():
+    index = PolygonKeyIndex([Polygon([(0.1, 3.9), (0.5, 3.9), (0.5, 3.5)])], layout_definition)
+    assert index.keys() == {(0, 0)}
+    assert (1, 1) not in index
+
+
+def test_mask():
+    index = PolygonKeyIndex([box(0.0, 0.0, 1.0, 1.0)], layout_definition)
+    expected = np.zeros((4, 4), dtype=bool)
+    expected[2:, :2] = True
+    np.testing.assert_array_equal(index.mask(0, 1, 0), expected)
+
+
+def test_pickle_without_tree():
+    index = pickle.loads(pickle.dumps(PolygonKeyIndex([box(0.0, 0.0, 1.0, 1.0)], layout_definition)))
+    assert index.keys() == {(0, 1)}
+    assert index.mask(0, 1, 0).sum() == 4
+
+
+def test_mask_cache_evicts_least_recently_used():
+    cache = MaskCache(max_bytes=4)
+    masks = [np.eye(4, dtype=bool), np.ones((4, 4), dtype=bool), np.zeros((4, 4), dtype=bool)]
+    cache.put('a', masks[0])
+    cache.put('b', masks[1])
+    np.testing.assert_array_equal(cache.get('a'), masks[0])
+
+    cache.put('c', masks[2])
+
+    assert cache.total_bytes == 4
+    assert cache.get('b') is None
+    np.testing.assert_array_equal(cache.get('a'), masks[0])
+    np.testing.assert_array_equal(cache.get('c'), masks[2])
+
+
+def test_masks_are_cached_per_polygon_and_layout(monkeypatch):
+    monkeypatch.setattr(spatial_index, '_mask_cache', MaskCache(max_bytes=1024))
+    polygon = box(0.0, 0.0, 1.0, 1.0)
+    index = PolygonKeyIndex([polygon], layout_definition, 'EPSG:4326')
+    expected = index.mask(0, 1, 0)
+
+    other = PolygonKeyIndex([box(0.0, 0.0, 1.0, 1.0)], layout_definition, 'EPSG:4326')
+    monkeypatch.setattr(other, '_rasterize', None)
+    np.testing.assert_array_equal(other.mask(0, 1, 0), expected)
+
+    other_crs = PolygonKeyIndex([polygon], layout_definition, 'EPSG:3857')
+    np.testing.assert_array_equal(other_crs.mask(0, 1, 0), expected)
+    assert len(spatial_index.get_mask_cache()) == 2
@@ -131,6 +131,18 @@ class TestTimeSeries(TestCase):
         for r in result:
             self.assertTrue(r in self.expected_spacetime_points_list)
 
+    def test_timeseries_points(self):
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: self.create_spacetime_layer()}),
+                                                              InMemoryServiceRegistry())
+
+        result = imagecollection.timeseries_points([1.0, 3.0, -10.0], [1.0, 3.0, 15.0])
+
+        self.assertEqual({(1.0, 1.0), (3.0, 3.0), (-10.0, 15.0)}, set(result.keys()))
+        self.assertEqual({self.now.isoformat(): [1.0, 2.0]}, result[(1.0, 1.0)])
+        self.assertEqual({self.now.isoformat(): [1.0, 2.0]}, result[(3.0, 3.0)])
+        self.assertEqual({}, result[(-10.0, 15.0)])
+        self.assertEqual(result[(3.0, 3.0)], imagecollection.timeseries(3.0, 3.0))
+
     def test_zonal_statistics(self):
         layer = self.create_spacetime_layer()
         imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
@@ -211,6 +223,23 @@ class TestTimeSeries(TestCase):
                     },
                 }
 
+    def test_zonal_statistics_multiple_statistics_datacube(self):
+        layer = self.create_spacetime_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
+        regions = GeometryCollection([
+            Polygon(shell=[(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0)]),
+            Polygon(shell=[(10.0, 10.0), (11.0, 10.0), (11.0, 11.0), (10.0, 11.0), (10.0, 10.0)])
+        ])
+
+        result = imagecollection.zonal_statistics(regions, ["mean", "sd", "median"])
+
+        assert result.data == {
+            '2017-09-25T11:37:00Z': [
+                {"count": [4, 4], "mean": [1.0, 2.0], "sd": [0.0, 0.0], "median": [1.0, 2.0]},
+                {}
+            ]
+        }
+
     def test_zonal_statistics_median_datacube(self):
         layer = self.create_spacetime_layer()
         imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
@@ -238,6 +267,79 @@ class TestTimeSeries(TestCase):
             }
         }
 
+    def test_zonal_statistics_approximate_median_datacube(self):
+        layer = self.create_spacetime_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
+        polygon = Polygon(shell=[(0.0, 0.0), (3.0, 0.0), (3.0, 3.0), (0.0, 3.0), (0.0, 0.0)])
+
+        result = imagecollection.zonal_statistics(polygon, "median", rank_error=0.01)
+        assert result.data == {'2017-09-25T11:37:00Z': [[1.0, 2.0]]}
+
+        result = imagecollection.zonal_statistics(polygon, ["p10", "p90"], rank_error=0.01)
+        assert result.data == {'2017-09-25T11:37:00Z': [{"count": [36, 36], "p10": [1.0, 2.0], "p90": [1.0, 2.0]}]}
+
+    def test_zonal_statistics_multiple_statistics_projected_vector_file(self):
+        import geopandas as gpd
+        from tempfile import TemporaryDirectory
+
+        layer = self.create_spacetime_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
+        polygon = Polygon(shell=[(0.0, 0.0), (3.0, 0.0), (3.0, 3.0), (0.0, 3.0), (0.0, 0.0)])
+
+        with TemporaryDirectory() as directory:
+            # in Web Mercator rather than EPSG:4326
+            vector_file = directory + "/regions.shp"
+            gpd.GeoDataFrame({'geometry': [polygon]}, crs={'init': 'epsg:4326'}).to_crs(epsg=3857).to_file(vector_file)
+
+            result = imagecollection.zonal_statistics(vector_file, ["mean"])
+
+        assert result.data == {'2017-09-25T11:37:00Z': [{"count": [36, 36], "mean": [1.0, 2.0]}]}
+
+    def test_zonal_statistics_single_statistic_datacube(self):
+        layer = self.create_spacetime_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
+        polygon = Polygon(shell=[(0.0, 0.0), (3.0, 0.0), (3.0, 3.0), (0.0, 3.0), (0.0, 0.0)])
+
+        assert imagecollection.zonal_statistics(polygon, "p90").data == {'2017-09-25T11:37:00Z': [[1.0, 2.0]]}
+        assert imagecollection.zonal_statistics(polygon, "max").data == {'2017-09-25T11:37:00Z': [[1.0, 2.0]]}
+        assert imagecollection.zonal_statistics(polygon, "count").data == {'2017-09-25T11:37:00Z': [[36, 36]]}
+
+        with self.assertRaises(ValueError):
+            imagecollection.zonal_statistics(polygon, "mode")
+
+    def test_zonal_statistics_histogram_datacube(self):
+        layer = self.create_spacetime_layer()
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: layer}), InMemoryServiceRegistry())
+        polygon = Polygon(shell=[(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0), (0.0, 0.0)])
+
+        result = imagecollection.zonal_statistics(polygon, "histogram")
+
+        # a histogram per band, with its bins as numbers rather than the strings of JSON keys
+        assert result.data == {'2017-09-25T11:37:00Z': [{1.0: 4}, {2.0: 4}]}
+        histograms, = result.data.values()
+        assert all(isinstance(value, float) for histogram in histograms for value in histogram)
+
+    def test_as_python(self):
+        jvm = gps.get_spark_context()._gateway.jvm
+        histogram = jvm.java.util.HashMap()
+        histogram.put(1.0, 3)
+        histogram.put(-2.5, 1)
+        values = jvm.java.util.ArrayList()
+        values.add(float('nan'))
+        values.add(histogram)
+        timeseries = jvm.java.util.HashMap()
+        timeseries.put("2017-09-25T11:37:00Z", values)
+
+        imagecollection = GeotrellisTimeSeriesImageCollection(gps.Pyramid({0: self.create_spacetime_layer()}),
+                                                              InMemoryServiceRegistry())
+        result = imagecollection._as_python(timeseries)
+
+        assert list(result.keys()) == ["2017-09-25T11:37:00Z"]
+        nan, histogram = result["2017-09-25T11:37:00Z"]
+        assert np.isnan(nan)
+        assert histogram == {1.0: 3, -2.5: 1}
+        assert all(isinstance(value, float) for value in histogram)
+
     def test_zonal_statistics_for_unsigned_byte_layer(self):
         layer = self.create_spacetime_unsigned_byte_layer()
         # layer.to_spatial_layer().save_stitched('/tmp/unsigned_byte_layer.tif')
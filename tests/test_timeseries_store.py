@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytz
+from shapely.geometry import box
+
+from openeogeotrellis import timeseries_store
+from openeogeotrellis.GeotrellisImageCollection import GeotrellisTimeSeriesImageCollection
+from openeogeotrellis.timeseries_store import FileTimeseriesStore, TimeseriesEntry, merge_intervals, \
+    missing_intervals, polygon_key, settled
+
+
+def _date(day: int) -> datetime:
+    return datetime(2019, 1, day, tzinfo=pytz.UTC)
+
+
+def test_missing_intervals():
+    assert missing_intervals((_date(1), _date(10)), []) == [(_date(1), _date(10))]
+    assert missing_intervals((_date(1), _date(10)), [(_date(1), _date(10))]) == []
+    assert missing_intervals((_date(1), _date(10)), [(_date(1), _date(7))]) == \
+           [(_date(7) + timeseries_store._RESOLUTION, _date(10))]
+    assert missing_intervals((_date(1), _date(10)), [(_date(3), _date(4)), (_date(20), _date(21))]) == [
+        (_date(1), _date(3) - timeseries_store._RESOLUTION), (_date(4) + timeseries_store._RESOLUTION, _date(10))]
+
+
+def test_merge_intervals():
+    assert merge_intervals([(_date(5), _date(8)), (_date(1), _date(3)), (_date(2), _date(4))]) == \
+           [(_date(1), _date(4)), (_date(5), _date(8))]
+    assert merge_intervals([(_date(1), _date(3)), (_date(3) + timeseries_store._RESOLUTION, _date(4))]) == \
+           [(_date(1), _date(4))]
+
+
+def test_settled():
+    assert settled((_date(1), _date(10)), timedelta(days=3), now=_date(20)) == (_date(1), _date(10))
+    assert settled((_date(1), _date(10)), timedelta(days=3), now=_date(8)) == (_date(1), _date(5))
+    assert settled((_date(6), _date(10)), timedelta(days=3), now=_date(8)) is None
+
+
+def test_file_store(tmp_path):
+    store = FileTimeseriesStore(str(tmp_path))
+    assert store.get("collection", "mean", "polygon") is None
+
+    entry = TimeseriesEntry({"2019-01-02T00:00:00Z": [[1.0, float('nan')]]}, [(_date(1), _date(3))])
+    store.put("collection", "mean", "polygon", entry)
+
+    stored = store.get("collection", "mean", "polygon")
+    assert stored.covered == [(_date(1), _date(3))]
+    assert stored.values.keys() == entry.values.keys()
+    assert stored.within((_date(3), _date(4))) == {}
+    assert store.get_many("collection", "sd", ["polygon"]) == {}
+
+    store.invalidate("other")
+    assert store.get("collection", "mean", "polygon") is not None
+    store.invalidate("collection")
+    assert store.get("collection", "mean", "polygon") is None
+
+
+def test_file_store_ttl(tmp_path):
+    store = FileTimeseriesStore(str(tmp_path), ttl=timedelta(days=1))
+    store.put("collection", "mean", "new", TimeseriesEntry({}, [(_date(1), _date(3))]))
+    store.put("collection", "mean", "old", TimeseriesEntry({}, [(_date(1), _date(3))],
+                                                            created=datetime.now(pytz.UTC) - timedelta(days=2)))
+
+    assert store.get("collection", "mean", "new") is not None
+    assert store.get("collection", "mean", "old") is None
+
+
+def test_collection_key_ignores_dates_and_polygons():
+    def request(temporal_extent, polygons):
+        return {"process_graph": {
+            "load": {"process_id": "load_collection",
+                     "arguments": {"id": "S2", "temporal_extent": temporal_extent, "bands": ["B04"]}},
+            "stats": {"process_id": "aggregate_polygon",
+                      "arguments": {"data": {"from_node": "load"}, "polygons": polygons, "reducer": "mean"},
+                      "result": True}
+        }}
+
+    strip = timeseries_store._without_dates_and_polygons
+    assert strip(request(["2019-01-01", "2019-01-10"], "a.geojson")) == \
+           strip(request(["2019-01-01", "2019-01-12"], "b.geojson"))
+    assert strip(request(["2019-01-01", "2019-01-10"], "a.geojson"))["process_graph"]["load"]["arguments"] == \
+           {"id": "S2", "bands": ["B04"]}
+
+
+def test_incremental_timeseries_only_computes_missing_dates(tmp_path, monkeypatch):
+    store = FileTimeseriesStore(str(tmp_path))
+    monkeypatch.setattr(timeseries_store, 'get_timeseries_store', lambda: store)
+    monkeypatch.setattr(timeseries_store, 'request_collection_key', lambda: "collection")
+    polygons = [box(0, 0, 1, 1), box(2, 2, 3, 3)]
+    computed = []
+
+    def collection(start: datetime, end: datetime):
+        bounds = SimpleNamespace(minKey=SimpleNamespace(instant=start), maxKey=SimpleNamespace(instant=end))
+        metadata = SimpleNamespace(bounds=bounds)
+        return SimpleNamespace(pyramid=SimpleNamespace(max_zoom=0, levels={0: SimpleNamespace(layer_metadata=metadata)}),
+                               date_range_filter=collection, interval=(start, end))
+
+    def compute(filtered, ps):
+        computed.append(filtered.interval)
+        days = range(filtered.interval[0].day, filtered.interval[1].day + 1)
+        # no data for the second polygon on the 2nd
+        def value(polygon, d):
+            if polygon.bounds[0] == 0:
+                return [float(d)]
+            return [] if d == 2 else [float(d) * 10]
+
+        return {_date(d).isoformat(): [value(p, d) for p in ps] for d in days}
+
+    def timeseries(start, end):
+        return GeotrellisTimeSeriesImageCollection._incremental_timeseries(
+            collection(start, end), polygons, 'mean', compute, list)
+
+    first = timeseries(_date(1), _date(3))
+    assert computed == [(_date(1), _date(3))]
+    assert first[_date(2).isoformat()] == [[2.0], []]
+
+    second = timeseries(_date(2), _date(5))
+    assert computed[1:] == [(_date(3) + timeseries_store._RESOLUTION, _date(5))]
+    assert sorted(second) == [_date(d).isoformat() for d in [2, 3, 4, 5]]
+    assert second[_date(5).isoformat()] == [[5.0], [50.0]]
+    assert second[_date(2).isoformat()] == [[2.0], []]
+
+    assert store.get("collection", "mean", polygon_key(polygons[0])).covered == [(_date(1), _date(5))]
+
+
+def test_incremental_timeseries_computes_unsettled_dates_again(tmp_path, monkeypatch):
+    store = FileTimeseriesStore(str(tmp_path))
+    monkeypatch.setattr(timeseries_store, 'get_timeseries_store', lambda: store)
+    monkeypatch.setattr(timeseries_store, 'request_collection_key', lambda: "collection")
+    monkeypatch.setenv("OPENEO_TIMESERIES_STORE_SETTLING_DAYS", "3")
+    today = datetime.now(pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
+    start, end = today - timedelta(days=10), today
+    computed = []
+
+    bounds = SimpleNamespace(minKey=SimpleNamespace(instant=start), maxKey=SimpleNamespace(instant=end))
+    collection = SimpleNamespace(
+        pyramid=SimpleNamespace(max_zoom=0, levels={0: SimpleNamespace(layer_metadata=SimpleNamespace(bounds=bounds))}),
+        date_range_filter=lambda s, e: (s, e))
+
+    def compute(interval, ps):
+        computed.append(interval)
+        return {interval[0].isoformat(): [[1.0] for _ in ps]}
+
+    for _ in range(2):
+        GeotrellisTimeSeriesImageCollection._incremental_timeseries(collection, [box(0, 0, 1, 1)], 'mean', compute,
+                                                                    list)
+
+    # the last 3 days are not settled yet
+    assert computed[0] == (start, end)
+    assert computed[1][0] > today - timedelta(days=3)
+    assert computed[1][1] == end
@@ -0,0 +1,29 @@
+import numpy as np
+from geopyspark import Tile, SpatialKey
+
+from openeogeotrellis.udf import TileBatch
+
+
+def test_tile_batch_from_tiles_keeps_native_cell_type():
+    tiles = [
+        (SpatialKey(0, 0), Tile(np.array([[[1, -1], [2, 3]]], dtype=np.int16), 'SHORT', -1)),
+        (SpatialKey(1, 0), Tile(np.array([[[4, 5], [-1, 7]]], dtype=np.int16), 'SHORT', -1)),
+    ]
+    batch = TileBatch.from_tiles(tiles)
+
+    assert len(batch) == 2
+    assert batch.cells.dtype == np.int16
+    assert batch.cells.shape == (2, 1, 2, 2)
+    assert batch.cells.flags['C_CONTIGUOUS']
+
+    for (key, tile), (expected_key, expected_tile) in zip(batch.tiles(), tiles):
+        assert key == expected_key
+        assert tile.cell_type == 'SHORT'
+        assert tile.no_data_value == -1
+        assert np.shares_memory(tile.cells, batch.cells)
+        np.testing.assert_array_equal(tile.cells, expected_tile.cells)
+
+
+def test_tile_batch_to_float64_masks_no_data():
+    batch = TileBatch([SpatialKey(0, 0)], np.array([[[[1, -1], [2, 3]]]], dtype=np.int16), 'SHORT', -1)
+    np.testing.assert_array_equal(batch.to_float64(), [[[[1.0, np.nan], [2.0, 3.0]]]])
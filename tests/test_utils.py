@@ -1,6 +1,7 @@
 import pytest
+from shapely.geometry import MultiPolygon, Polygon, box
 
-from openeogeotrellis.utils import dict_merge_recursive
+from openeogeotrellis.utils import dict_merge_recursive, get_transformer, reproject_bounds, reproject_polygons
 
 
 @pytest.mark.parametrize(["a", "b", "expected"], [
@@ -48,3 +49,33 @@ def test_merge_recursive_preserve_input():
     assert result == {1: {2: 3, 4: 5}}
     assert a == {1: {2: 3}}
     assert b == {1: {4: 5}}
+
+
+def test_get_transformer():
+    transformer = get_transformer("EPSG:4326", "EPSG:3857")
+
+    assert get_transformer("EPSG:4326", "EPSG:3857") is transformer
+    xs, ys = transformer.transform([0.0, 180.0], [0.0, 0.0])
+    assert list(xs) == pytest.approx([0.0, 20037508.34], abs=0.01)
+    assert list(ys) == pytest.approx([0.0, 0.0], abs=0.01)
+
+
+def test_reproject_bounds():
+    assert reproject_bounds((0.0, 0.0, 180.0, 0.0), "EPSG:4326", "EPSG:3857") == \
+           pytest.approx((0.0, 0.0, 20037508.34, 0.0), abs=0.01)
+
+
+def test_reproject_polygons():
+    with_hole = Polygon(box(0, 0, 10, 10).exterior, [box(2, 2, 4, 4).exterior])
+    multi = MultiPolygon([box(20, 20, 21, 21), box(30, 30, 31, 31)])
+
+    reprojected = reproject_polygons([with_hole, Polygon(), multi], "EPSG:4326", "EPSG:3857")
+
+    def expected(bounds):
+        return pytest.approx(reproject_bounds(bounds, "EPSG:4326", "EPSG:3857"))
+
+    assert len(reprojected[0].interiors) == 1
+    assert reprojected[0].bounds == expected((0, 0, 10, 10))
+    assert reprojected[0].interiors[0].bounds == expected((2, 2, 4, 4))
+    assert reprojected[1].is_empty
+    assert [p.bounds for p in reprojected[2].geoms] == [expected(p.bounds) for p in multi.geoms]
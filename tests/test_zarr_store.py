@@ -0,0 +1,97 @@
+import json
+import zipfile
+import zlib
+from datetime import datetime
+
+import numpy as np
+from geopyspark import SpaceTimeKey, SpatialKey
+from geopyspark.geotrellis import Bounds, Extent, LayoutDefinition, TileLayout
+
+from openeogeotrellis.zarr_store import ZarrCubeStore
+
+# 2x2 tiles of 4x4 pixels of 1 by 1
+layout_definition = LayoutDefinition(Extent(0.0, 0.0, 8.0, 8.0), TileLayout(2, 2, 4, 4))
+
+now = datetime(2017, 9, 25, 11, 37)
+later = datetime(2017, 9, 30, 11, 37)
+
+
+class LayerMetadata:
+    layout_definition = layout_definition
+    crs = '+proj=longlat +datum=WGS84 +no_defs '
+    bounds = Bounds(SpaceTimeKey(0, 0, now), SpaceTimeKey(1, 1, later))
+
+
+def _store(path, keys):
+    store = ZarrCubeStore.of_keys(str(path), keys, LayerMetadata())
+    for key in keys:
+        store.write_chunk(key, np.full((2, 4, 4), key.col * 10 + key.row, dtype=np.int16))
+    store.write_metadata(np.dtype(np.int16), ["B1", "B2"], nodata=-1)
+    return store
+
+
+def test_write_spacetime_cube(tmp_path):
+    keys = [SpaceTimeKey(1, 0, now), SpaceTimeKey(1, 1, now), SpaceTimeKey(1, 0, later)]
+    _store(tmp_path, keys)
+
+    with (tmp_path / "cells" / ".zarray").open() as f:
+        array = json.load(f)
+    assert array["shape"] == [2, 2, 8, 4]
+    assert array["chunks"] == [1, 2, 4, 4]
+    assert array["fill_value"] == -1
+    with (tmp_path / "cells" / ".zattrs").open() as f:
+        assert json.load(f) == {"_ARRAY_DIMENSIONS": ["t", "bands", "y", "x"]}
+
+    assert sorted(p.name for p in (tmp_path / "cells").iterdir() if not p.name.startswith('.')) == \
+        ["0.0.0.0", "0.0.1.0", "1.0.0.0"]
+    chunk = np.frombuffer(zlib.decompress((tmp_path / "cells" / "0.0.1.0").read_bytes()), dtype=np.int16)
+    assert np.all(chunk == 11)
+
+    t = np.frombuffer(zlib.decompress((tmp_path / "t" / "0").read_bytes()), dtype=np.int64)
+    assert list(t) == [1506339420, 1506771420]
+
+
+def test_to_netcdf(tmp_path):
+    from netCDF4 import Dataset
+
+    keys = [SpaceTimeKey(0, 0, now), SpaceTimeKey(1, 1, later)]
+    store = _store(tmp_path / "store", keys)
+    path = str(tmp_path / "cube.nc")
+
+    store.to_netcdf(path)
+
+    with Dataset(path) as dataset:
+        cells = dataset.variables["cells"]
+        assert cells.dimensions == ("t", "bands", "y", "x")
+        assert cells.shape == (2, 2, 8, 8)
+        assert list(dataset.variables["bands"][:]) == ["B1", "B2"]
+        assert np.all(cells[0, :, :4, :4] == 0)
+        assert np.all(cells[1, :, 4:, 4:] == 11)
+        assert cells[1, :, :4, :4].mask.all()
+
+
+def test_to_zip_spatial(tmp_path):
+    store = _store(tmp_path / "store", [SpatialKey(1, 0)])
+    path = str(tmp_path / "cube.zip")
+
+    store.to_zip(path)
+
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        assert {".zgroup", ".zmetadata", "cells/.zarray", "cells/0.0.0", "x/0", "y/0", "bands/0"} <= names
+        assert "t/0" not in names
+        assert json.loads(archive.read("cells/.zarray"))["shape"] == [2, 4, 4]
+
+
+def test_empty_cube_to_netcdf(tmp_path):
+    from netCDF4 import Dataset
+
+    store = _store(tmp_path / "store", [])
+    path = str(tmp_path / "cube.nc")
+
+    store.to_netcdf(path)
+
+    with Dataset(path) as dataset:
+        cells = dataset.variables["cells"]
+        assert cells.dimensions == ("t", "bands", "y", "x")
+        assert cells.shape == (0, 2, 0, 0)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from openeogeotrellis.zonal_statistics import PolygonStatistics, QuantileSketch, check_statistics
+
+
+def test_check_statistics():
+    assert check_statistics(['mean', 'median', 'p97.5']) == ['mean', 'median', 'p97.5']
+    with pytest.raises(ValueError):
+        check_statistics(['mean', 'mode'])
+    with pytest.raises(ValueError):
+        check_statistics([])
+    with pytest.raises(ValueError):
+        check_statistics(['p101'])
+
+
+def test_statistics_of_cells():
+    cells = np.array([[[1, 2], [3, -1]], [[10, 20], [30, 40]]], dtype=np.int16)
+    inside = np.array([[True, True], [True, True]])
+
+    result = PolygonStatistics.of_cells(cells, inside, no_data=-1, keep_values=True) \
+        .result(['count', 'sum', 'mean', 'sd', 'min', 'max', 'median'])
+
+    assert result['count'] == [3, 4]
+    assert result['sum'] == pytest.approx([6, 100])
+    assert result['mean'] == pytest.approx([2, 25])
+    assert result['sd'] == pytest.approx([np.std([1, 2, 3]), np.std([10, 20, 30, 40])])
+    assert result['min'] == [1, 10]
+    assert result['max'] == [3, 40]
+    assert result['median'] == [2, 25]
+
+
+def test_merged_statistics_equal_statistics_of_all_cells():
+    cells = np.random.uniform(-100, 100, (2, 16, 32))
+    cells[0, 3, 4] = np.nan
+    inside = np.random.uniform(size=(16, 32)) > 0.3
+    left, right = (PolygonStatistics.of_cells(cells[:, :, s], inside[:, s], no_data=None, keep_values=True)
+                   for s in [slice(0, 16), slice(16, 32)])
+    empty = PolygonStatistics.of_cells(cells[:, :, :16], np.zeros((16, 16), dtype=bool), None, keep_values=True)
+
+    result = left.merge(empty).merge(right).result(['count', 'mean', 'variance', 'min', 'max', 'median'])
+
+    expected = PolygonStatistics.of_cells(cells, inside, no_data=None, keep_values=True) \
+        .result(['count', 'mean', 'variance', 'min', 'max', 'median'])
+    assert result['count'] == expected['count']
+    for statistic in ['mean', 'variance', 'min', 'max', 'median']:
+        assert result[statistic] == pytest.approx(expected[statistic])
+    valid = cells[0][inside & ~np.isnan(cells[0])]
+    assert result['variance'][0] == pytest.approx(np.var(valid))
+    assert result['median'][0] == pytest.approx(np.median(valid))
+
+
+def test_statistics_without_valid_cells():
+    cells = np.full((1, 2, 2), np.nan, dtype=np.float32)
+
+    result = PolygonStatistics.of_cells(cells, np.ones((2, 2), dtype=bool), no_data=None) \
+        .result(['count', 'mean', 'min'])
+
+    assert result['count'] == [0]
+    assert np.isnan(result['mean'][0]) and np.isnan(result['min'][0])
+
+
+def test_quantile_sketch_rank_error():
+    values = np.random.RandomState(42).normal(size=200000)
+    sketches = [QuantileSketch(rank_error=0.01).update(chunk) for chunk in np.array_split(values, 50)]
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+
+    assert sketch.count == values.size
+    assert sum(level.size for level in sketch.levels) < 2000
+    ordered = np.sort(values)
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+        rank = np.searchsorted(ordered, sketch.quantile(q)) / values.size
+        assert abs(rank - q) <= 0.01
+
+
+@pytest.mark.parametrize("rank_error", [0.1, 0.05])
+def test_quantile_sketch_rank_error_merged_from_many_parts(rank_error):
+    values = np.random.RandomState(0).normal(size=100000)
+    sketches = [QuantileSketch(rank_error).update(chunk) for chunk in np.array_split(values, 1000)]
+    sketch = sketches[0]
+    for other in sketches[1:]:
+        sketch.merge(other)
+
+    ordered = np.sort(values)
+    for q in np.linspace(0.01, 0.99, 99):
+        rank = np.searchsorted(ordered, sketch.quantile(q)) / values.size
+        assert abs(rank - q) <= rank_error
+
+
+def test_quantile_sketch_small_and_empty():
+    assert QuantileSketch().update(np.array([3.0, 1.0, 2.0])).quantile(0.5) == 2.0
+    assert np.isnan(QuantileSketch().quantile(0.5))
+    with pytest.raises(ValueError):
+        QuantileSketch(rank_error=0)
+
+
+def test_approximate_percentiles():
+    cells = np.arange(10000, dtype=np.float32).reshape((1, 100, 100))
+    inside = np.ones((100, 100), dtype=bool)
+    parts = [PolygonStatistics.of_cells(cells[:, rows], inside[rows], None, keep_values=True, rank_error=0.005)
+             for rows in [slice(0, 30), slice(30, 100)]]
+
+    result = parts[0].merge(parts[1]).result(['median', 'p90'])
+
+    assert parts[0].values is None
+    assert result['median'][0] == pytest.approx(5000, abs=50)
+    assert result['p90'][0] == pytest.approx(9000, abs=50)